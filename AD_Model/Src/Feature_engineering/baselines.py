@@ -0,0 +1,247 @@
+"""
+Per-user behavioral baselines.
+
+The extracted features are absolute per-user counts, so a heavy but normal
+user looks just like an anomalous spike. This stage keeps, for every user and
+every daily feature (by default the *_1D window counts of all_features), an
+exponentially weighted mean and variance of the user's own history and emits
+how far each new day lies from it:
+
+    <feature>_z = (value today - baseline mean) / max(baseline std, min_std)
+
+The daily values are read from the day partitions of the feature store, and
+only the days published since the previous run are folded in, so a day costs
+time proportional to the users active on it. Days on which a user has no rows
+count as zero activity for that user; they are applied in closed form the
+next time the user is active. The state is snapshotted as float32 arrays
+indexed by the interned user code in one file under Data/Features/baselines,
+and the deviations are published to their own store table,
+baseline_deviations. When a day that was already folded in is republished
+with different rows, or the parameters change, the baselines are rebuilt.
+"""
+import os
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+from Src import config
+from Src.stage_cache import params_hash
+from Src.Preprocessing.interning import EntityInterner
+from Src.Feature_engineering.feature_store import FeatureStore, store_available
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = 'user_baselines.npz'
+
+DEVIATIONS_TABLE = 'baseline_deviations'
+
+
+def baselines_dir():
+    """Directory holding the baseline snapshot."""
+    return config.FEATURES_DIR / 'baselines'
+
+
+def baseline_params():
+    """Parameters the baselines and their deviations depend on."""
+    params = config.BASELINE_PARAMS
+    return {
+        'halflife_days': params.get('halflife_days', 14),
+        'min_days': params.get('min_days', 7),
+        'min_std': params.get('min_std', 1.0),
+        'features': params.get('features')
+    }
+
+
+def day_number(day):
+    """Days since the epoch of a date-like value."""
+    return int(np.datetime64(pd.Timestamp(day).normalize(), 'D').astype(np.int64))
+
+
+class UserBaselines:
+    """Exponentially weighted per-user mean and variance of daily features."""
+
+    def __init__(self, features=(), params=None):
+        self.params = params or baseline_params()
+        self.alpha = 1.0 - 0.5 ** (1.0 / self.params['halflife_days'])
+        self.features = list(features)
+        self.rebuilt = False
+        self.reset()
+
+    def reset(self):
+        """Drop all accumulated baselines."""
+        n_features = len(self.features)
+        self.n_users = 0
+        self.mean = np.zeros((0, n_features), dtype=np.float32)
+        self.var = np.zeros((0, n_features), dtype=np.float32)
+        self.last_day = np.zeros(0, dtype=np.int32)
+        self.days = np.zeros(0, dtype=np.int32)
+        self.consumed = {}
+
+    def _ensure(self, n_users):
+        """Grow every per-user array to at least n_users rows."""
+        if n_users <= self.n_users:
+            return
+        extra = n_users - self.n_users
+        self.mean = np.concatenate([self.mean, np.zeros((extra, len(self.features)), dtype=np.float32)])
+        self.var = np.concatenate([self.var, np.zeros((extra, len(self.features)), dtype=np.float32)])
+        self.last_day = np.concatenate([self.last_day, np.zeros(extra, dtype=np.int32)])
+        self.days = np.concatenate([self.days, np.zeros(extra, dtype=np.int32)])
+        self.n_users = n_users
+
+    def fold(self, day, users, values):
+        """Score one day of values (users x features) against the baselines, then fold it in.
+
+        users are unique user codes active on the day. Returns the z-scores,
+        0 for users with fewer than min_days days of history.
+        """
+        self._ensure(int(users.max()) + 1)
+        values = np.asarray(values, dtype=np.float64)
+        mean = self.mean[users].astype(np.float64)
+        var = self.var[users].astype(np.float64)
+        days = self.days[users]
+
+        # Idle days since the user's last active day, each a zero observation:
+        # k zero updates take mean to d * mean and var to d * (var + (1 - d) * mean^2)
+        idle = np.where(days > 0, day - self.last_day[users] - 1, 0)
+        decay = ((1.0 - self.alpha) ** idle)[:, None]
+        var = decay * (var + (1.0 - decay) * mean ** 2)
+        mean = decay * mean
+        days = days + idle
+
+        std = np.maximum(np.sqrt(var), self.params['min_std'])
+        scores = np.where((days >= self.params['min_days'])[:, None], (values - mean) / std, 0.0)
+
+        # A user's first day starts the baseline at its values
+        first = (days == 0)[:, None]
+        diff = values - mean
+        increment = self.alpha * diff
+        self.mean[users] = np.where(first, values, mean + increment)
+        self.var[users] = np.where(first, 0.0, (1.0 - self.alpha) * (var + diff * increment))
+        self.days[users] = days + 1
+        self.last_day[users] = day
+        return scores
+
+    def refresh(self, store=None):
+        """Fold in the store days published since the last refresh; returns their deviations.
+
+        The deviations are one row per active user and new day, with user
+        codes; an empty frame when no day is new.
+        """
+        store = store or FeatureStore('all_features')
+        partitions = store.manifest()['partitions']
+        features = self.params['features'] or [
+            column for column in store.manifest()['columns'] if column.endswith('_1D')
+        ]
+
+        changed = [label for label, digest in self.consumed.items() if partitions.get(label, {}).get('hash') != digest]
+        new = sorted(label for label in partitions if label not in self.consumed)
+        backfilled = bool(self.consumed and new and new[0] < max(self.consumed))
+        self.rebuilt = not self.consumed or features != self.features or bool(changed) or backfilled
+        if self.rebuilt:
+            if self.consumed:
+                logger.warning(f"Feature days or baseline features changed ({len(changed)} days republished); "
+                               f"rebuilding the baselines")
+            self.features = features
+            self.reset()
+            new = sorted(partitions)
+        if not new:
+            logger.info("Baselines are up to date")
+            return pd.DataFrame()
+
+        rows = store.scan(new[0], new[-1], columns=self.features)
+        rows[self.features] = rows[self.features].fillna(0)
+        rows['user'] = EntityInterner.load().encode('user', rows['user'], grow=False)
+        rows = rows[rows['user'] >= 0]
+
+        # One value per user and day: the day's window, wherever its row falls in the day
+        rows['day'] = rows[store.time_column].dt.normalize()
+        daily = rows.groupby(['day', 'user'], sort=True)[self.features].max()
+
+        frames = []
+        for day, values in daily.groupby(level='day', sort=True):
+            users = values.index.get_level_values('user').to_numpy(dtype=np.int64)
+            scores = self.fold(day_number(day), users, values.to_numpy())
+            frame = pd.DataFrame(scores.astype(np.float32), columns=[f'{column}_z' for column in self.features])
+            frame.insert(0, 'user', users)
+            frame.insert(1, 'timestamp', day)
+            frames.append(frame)
+        for label in new:
+            self.consumed[label] = partitions[label]['hash']
+        logger.info(f"Folded {len(new)} new days of {len(daily):,} user-days into the baselines "
+                    f"of {self.n_users:,} users")
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def save(self, directory=None):
+        """Snapshot the baselines to one file, replaced atomically."""
+        directory = directory or baselines_dir()
+        directory.mkdir(parents=True, exist_ok=True)
+        meta = {
+            'params': self.params,
+            'params_hash': params_hash(self.params),
+            'features': self.features,
+            'consumed': self.consumed,
+            'saved': pd.Timestamp.now().isoformat()
+        }
+        path = directory / STATE_FILE
+        tmp_path = directory / f'{STATE_FILE}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, meta=np.array(json.dumps(meta)), mean=self.mean, var=self.var,
+                                last_day=self.last_day, days=self.days)
+        os.replace(tmp_path, path)
+        logger.info(f"Saved baselines of {self.n_users:,} users to {path}")
+        return path
+
+    @classmethod
+    def load(cls, directory=None):
+        """Load the snapshot, or return empty baselines when there is none or the parameters changed."""
+        path = (directory or baselines_dir()) / STATE_FILE
+        if not path.exists():
+            return cls()
+        with np.load(path) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            if meta['params_hash'] != params_hash(baseline_params()):
+                logger.warning("Baseline parameters changed; rebuilding the baselines")
+                return cls()
+            baselines = cls(meta['features'])
+            baselines.mean = arrays['mean']
+            baselines.var = arrays['var']
+            baselines.last_day = arrays['last_day']
+            baselines.days = arrays['days']
+            baselines.n_users = len(baselines.days)
+            baselines.consumed = meta['consumed']
+        return baselines
+
+
+def refresh_baselines(directory=None):
+    """Load the baselines, fold in the newly published feature days, publish their deviations and snapshot.
+
+    Returns the new deviation rows (decoded users), or None when the
+    feature store is unavailable or baselines are disabled.
+    """
+    if not store_available() or not config.BASELINE_PARAMS.get('enabled', True):
+        return None
+    store = FeatureStore('all_features')
+    if not store.exists():
+        logger.warning("No feature days published; skipping the baselines")
+        return None
+
+    baselines = UserBaselines.load(directory)
+    deviations = baselines.refresh(store)
+    if not deviations.empty:
+        deviations['user'] = EntityInterner.load().decode('user', deviations['user'].to_numpy())
+        FeatureStore(DEVIATIONS_TABLE).publish(deviations, replace_all=baselines.rebuilt)
+    baselines.save(directory)
+    return deviations
+
+
+def join_deviations(features, deviations):
+    """Left-join deviation rows onto feature rows by user and timestamp; missing deviations are 0."""
+    if deviations.empty:
+        return features
+    columns = [column for column in deviations.columns if column.endswith('_z')]
+    features = features.merge(deviations, on=['user', 'timestamp'], how='left')
+    features[columns] = features[columns].fillna(0)
+    return features
@@ -0,0 +1,138 @@
+"""
+Sparse email communication graph.
+
+The recipient edge table (see Preprocessing/email_edges.py) holds one row per
+sender and to/cc/bcc recipient of every email, with interned user and address
+codes. This module turns it into sparse matrices without looping over edges:
+
+- a user x address matrix of edge counts, giving every sender's distinct
+  recipients (out-degree) and the share of them that are external
+- a user x user matrix through the users' own addresses, giving every user's
+  distinct internal senders (in-degree) and a weighted PageRank computed by
+  sparse power iteration
+
+It also flags the first edge of every sender -> recipient pair, from which
+the extractors count the new contacts of each window.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from Src import config
+
+logger = logging.getLogger(__name__)
+
+
+def pagerank_params():
+    """Damping, tolerance and iteration limit of the PageRank."""
+    params = config.FEATURE_PARAMS.get('pagerank', {})
+    return params.get('damping', 0.85), params.get('tol', 1e-10), params.get('max_iter', 100)
+
+
+def first_contacts(edges):
+    """Flag the earliest edge of every (sender, recipient) pair."""
+    recipients = edges['recipient_address'].to_numpy(dtype=np.int64)
+    pairs = edges['sender_id'].to_numpy(dtype=np.int64) * (int(recipients.max(initial=0)) + 1) + recipients
+    order = np.lexsort((edges['timestamp'].to_numpy(), pairs))
+    pairs = pairs[order]
+    starts = np.r_[True, pairs[1:] != pairs[:-1]]
+    first = np.zeros(len(edges), dtype=bool)
+    first[order[starts]] = True
+    return first
+
+
+def recipient_matrix(edges, n_users, n_addresses):
+    """User x address matrix of edge counts (CSR)."""
+    matrix = sparse.coo_matrix(
+        (np.ones(len(edges), dtype=np.float64),
+         (edges['sender_id'].to_numpy(dtype=np.int64), edges['recipient_address'].to_numpy(dtype=np.int64))),
+        shape=(n_users, n_addresses)
+    )
+    return matrix.tocsr()
+
+
+def user_matrix(recipients, address_users):
+    """User x user matrix of edge counts, through the address of every user.
+
+    address_users maps each address code to the user it belongs to (-1 for
+    external and unknown addresses). Self-addressed edges are dropped.
+    """
+    coo = recipients.tocoo()
+    targets = address_users[coo.col]
+    keep = (targets >= 0) & (targets != coo.row)
+    n_users = recipients.shape[0]
+    matrix = sparse.coo_matrix((coo.data[keep], (coo.row[keep], targets[keep])), shape=(n_users, n_users))
+    return matrix.tocsr()
+
+
+def pagerank(matrix, damping=0.85, tol=1e-10, max_iter=100):
+    """Weighted PageRank of a square sparse matrix of edge weights, by power iteration.
+
+    Rows without out-edges spread their rank uniformly. Returns ranks that
+    sum to 1.
+    """
+    n = matrix.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    strength = np.asarray(matrix.sum(axis=1)).ravel()
+    dangling = strength == 0
+    transition = sparse.diags(np.where(dangling, 0.0, 1.0 / np.maximum(strength, 1e-300))) @ matrix
+    transition = transition.T.tocsr()
+
+    ranks = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        spread = (damping * ranks[dangling].sum() + 1.0 - damping) / n
+        updated = damping * (transition @ ranks) + spread
+        change = np.abs(updated - ranks).sum()
+        ranks = updated
+        if change < tol:
+            break
+    else:
+        logger.warning(f"PageRank did not converge in {max_iter} iterations (L1 change {change:.2e})")
+    return ranks / ranks.sum()
+
+
+def graph_features(edges, users):
+    """Per-user degree, external share and PageRank of the communication graph.
+
+    edges is the recipient edge table and users the cleaned users table,
+    both with interned codes. Returns one row per user who sent or received
+    an email: out_degree (distinct recipients), in_degree (distinct internal
+    senders), external_contact_ratio (share of distinct recipients outside
+    the organisation) and email_pagerank.
+    """
+    edges = edges[(edges['sender_id'] >= 0) & (edges['recipient_address'] >= 0)]
+    user_ids = users['user_id'].to_numpy(dtype=np.int64)
+    user_addresses = users['email'].to_numpy(dtype=np.int64)
+    known = (user_ids >= 0) & (user_addresses >= 0)
+    n_users = int(max(edges['sender_id'].max() if len(edges) else -1, user_ids.max(initial=-1))) + 1
+    n_addresses = int(max(edges['recipient_address'].max() if len(edges) else -1,
+                          user_addresses.max(initial=-1))) + 1
+
+    address_users = np.full(n_addresses, -1, dtype=np.int64)
+    address_users[user_addresses[known]] = user_ids[known]
+    external = np.zeros(n_addresses)
+    external[edges.loc[edges['is_external'].fillna(False).astype(bool), 'recipient_address'].to_numpy()] = 1.0
+
+    recipients = recipient_matrix(edges, n_users, n_addresses)
+    contacts = recipients.copy()
+    contacts.data[:] = 1.0
+    out_degree = contacts.getnnz(axis=1)
+    external_contacts = contacts @ external
+
+    users_graph = user_matrix(recipients, address_users)
+    in_degree = users_graph.getnnz(axis=0)
+    damping, tol, max_iter = pagerank_params()
+    ranks = pagerank(users_graph, damping, tol, max_iter)
+    logger.info(f"Email graph: {recipients.nnz:,} sender-recipient pairs, "
+                f"{users_graph.nnz:,} internal user-user links")
+
+    active = (out_degree > 0) | (in_degree > 0)
+    return pd.DataFrame({
+        'user': np.flatnonzero(active),
+        'out_degree': out_degree[active],
+        'in_degree': in_degree[active],
+        'external_contact_ratio': np.where(out_degree > 0, external_contacts / np.maximum(out_degree, 1), 0.0)[active],
+        'email_pagerank': ranks[active]
+    })
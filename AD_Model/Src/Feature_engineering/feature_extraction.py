@@ -2,7 +2,23 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, time
 import os
+import time as timer
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from Src import config
+from Src import storage
+from Src import sketches
+from Src.sketches import SparseHyperLogLogArray
+from Src.Preprocessing.timestamps import TimestampParser
+from Src.Preprocessing.interning import EntityInterner
+from Src.Preprocessing.business_calendar import calendar_columns
+from Src.Preprocessing.sharding import usable_shards, shard_dir, shard_origins
+from Src.Feature_engineering import sessions, windows, email_graph
+from Src.Feature_engineering.sessions import load_sessions, session_statistics
+from Src.Feature_engineering.windows import WindowSpec, aggregate_windows, align_frames
+from Src.Feature_engineering.feature_store import FeatureStore, store_available
+from Src.Feature_engineering.feature_graph import FamilyCache
+from Src.Feature_engineering.email_graph import first_contacts, graph_features
+from Src.Feature_engineering.baselines import refresh_baselines
 import logging
 from pathlib import Path
 
@@ -10,95 +26,153 @@ from pathlib import Path
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Cleaned tables of each dataset loaded by load_cleaned_data
+CLEANED_TABLES = {
+    'users': 'users_cleaned',
+    'logon': 'logon_cleaned',
+    'device': 'device_cleaned',
+    'email': 'email_cleaned',
+    'file': 'file_cleaned',
+    'decoy': 'decoy_file_cleaned',
+    'email_edges': 'email_edges_cleaned'
+}
+
+# Feature families: extractor method, datasets it reads and FEATURE_PARAMS it
+# depends on. Each family is cached separately (see feature_graph.py)
+FEATURE_FAMILIES = {
+    'logon': ('extract_logon_features', ['logon'], ['time_windows']),
+    'session': ('extract_session_features', ['logon'], []),
+    'email': ('extract_email_features', ['email', 'email_edges'],
+              ['time_windows', 'distinct_counts', 'sketch_precision']),
+    'file': ('extract_file_access_features', ['file'], ['time_windows', 'distinct_counts', 'sketch_precision']),
+    'device': ('extract_device_usage_features', ['device'],
+               ['time_windows', 'distinct_counts', 'sketch_precision']),
+    'contacts': ('extract_contact_features', ['email_edges'], ['time_windows', 'distinct_counts', 'sketch_precision']),
+    'graph': ('extract_graph_features', ['email_edges', 'users'], ['pagerank']),
+    'decoy': ('extract_decoy_features', ['file', 'decoy'], [])
+}
+
+# Helper modules and functions that compute each family beyond its extractor
+# method; their source goes into the family key along with the method's
+WINDOW_CODE = ['windows', 'sketches', 'distinct_agg']
+FAMILY_CODE = {
+    'logon': WINDOW_CODE,
+    'session': ['sessions'],
+    'email': WINDOW_CODE,
+    'file': WINDOW_CODE,
+    'device': WINDOW_CODE,
+    'contacts': WINDOW_CODE + ['email_graph'],
+    'graph': ['email_graph'],
+    'decoy': []
+}
+
+# Families computed on the whole communication graph, which user shards split
+GLOBAL_FAMILIES = ['graph']
+
+# Saved feature sets and the families joined into each; the decoy family
+# only labels users and is kept out of the model features
+FEATURE_SETS = {
+    'user_activity': ['logon', 'session'],
+    'file_access': ['file'],
+    'email_activity': ['email'],
+    'device_usage': ['device'],
+    'email_graph': ['contacts', 'graph']
+}
+
+# Tables that are not sharded and always come from the cleaned data
+LOOKUP_TABLES = ['users', 'decoy']
+
+# Frames built by the extractors whose windows follow those of a cleaned dataset
+DERIVED_SOURCES = {'file_ops': 'file', 'device_events': 'device', 'contact_edges': 'email_edges'}
+
 class FeatureExtractor:
-    def __init__(self):
+    def __init__(self, cleaned_dir=None, origins=None, sessions_dir=None):
+        """cleaned_dir, origins and sessions_dir are set to extract one user
+        shard: its tables, the first timestamps of the whole datasets and
+        where the shard keeps its session table."""
+        self.cleaned_dir = cleaned_dir or config.CLEANED_DATA_DIR
+        self.origins = origins
+        self.sessions_dir = sessions_dir
         self.cleaned_data = {}
+        self.families = {}
         self.features = {}
         
-    def load_cleaned_data(self):
-        """Load cleaned data files."""
-        logger.info("Loading cleaned data...")
-        cleaned_files = {
-            'users': 'users_cleaned.csv',
-            'logon': 'logon_cleaned.csv',
-            'device': 'device_cleaned.csv',
-            'email': 'email_cleaned.csv',
-            'file': 'file_cleaned.csv',
-            'decoy': 'decoy_file_cleaned.csv'
+    def load_cleaned_data(self, names=None):
+        """Load cleaned data files (only the datasets in names, when given)."""
+        logger.info(f"Loading cleaned data from {self.cleaned_dir}...")
+        cleaned_tables = {
+            name: table for name, table in CLEANED_TABLES.items()
+            if names is None or name in names
         }
         
-        for name, filename in cleaned_files.items():
-            file_path = config.CLEANED_DATA_DIR / filename
-            if file_path.exists():
-                self.cleaned_data[name] = pd.read_csv(file_path, parse_dates=True, infer_datetime_format=True)
-                # Convert timestamp columns to datetime if they exist
+        for name, table in cleaned_tables.items():
+            directory = config.CLEANED_DATA_DIR if name in LOOKUP_TABLES else self.cleaned_dir
+            if storage.table_exists(directory, table):
+                self.cleaned_data[name] = storage.read_table(directory, table)
+                # Columnar tables keep datetimes typed; only CSV text needs parsing,
+                # and the parser leaves already-typed columns untouched
                 for col in self.cleaned_data[name].columns:
                     if 'time' in col.lower() or 'date' in col.lower():
-                        self.cleaned_data[name][col] = pd.to_datetime(self.cleaned_data[name][col])
+                        parser = TimestampParser(col)
+                        self.cleaned_data[name][col] = parser.parse(self.cleaned_data[name][col])
+                        if parser.coerced:
+                            parser.report(name)
                 logger.info(f"Loaded {name} with shape {self.cleaned_data[name].shape}")
             else:
-                logger.warning(f"Cleaned data file not found: {file_path}")
+                logger.warning(f"Cleaned data table not found: {directory / table}")
+    
+    def window_origins(self):
+        """Window origin of every source, or None to use each source's own first day."""
+        if self.origins is None:
+            return None
+        origins = dict(self.origins)
+        for derived, source in DERIVED_SOURCES.items():
+            if source in origins:
+                origins[derived] = origins[source]
+        return origins
     
-    def extract_user_activity_features(self):
-        """Extract user activity features from logon data."""
+    def aggregate(self, frames, specs, keys=None):
+        """aggregate_windows() with this extractor's window origins and sketch precision."""
+        return aggregate_windows(
+            frames, specs, keys=keys, origins=self.window_origins(),
+            sketch_precision=config.FEATURE_PARAMS.get('sketch_precision', 12)
+        )
+    
+    def extract_logon_features(self):
+        """Extract logon counts by time window."""
         if 'logon' not in self.cleaned_data:
             logger.error("Logon data not available for feature extraction")
             return
             
-        logon_df = self.cleaned_data['logon'].copy()
-        
-        # Set timestamp as index for time-based operations
-        logon_df = logon_df.set_index('timestamp').sort_index()
-        
-        # Feature 1: Logon counts by time window
-        features_list = []
-        for window in config.FEATURE_PARAMS['time_windows']:
-            # Count logons per user per time window
-            logon_counts = logon_df.groupby(['user', pd.Grouper(freq=window)])['action'].count().reset_index()
-            logon_counts = logon_counts.rename(columns={'action': f'logon_count_{window}'})
-            features_list.append(logon_counts)
-        
-        # Merge all features
-        features = features_list[0]
-        for df in features_list[1:]:
-            features = pd.merge(features, df, on=['user', 'timestamp'], how='outer')
+        specs = [
+            WindowSpec('logon', 'logon_type', 'count', window, f'logon_count_{window}')
+            for window in config.FEATURE_PARAMS['time_windows']
+        ]
+        features = self.aggregate(self.cleaned_data, specs)
         
         # Fill NaN values with 0
         features = features.fillna(0)
         
-        # Feature 2: Session duration statistics
-        # For each logon, find the next logoff for the same user
-        logon_events = logon_df[logon_df['action'] == 'Logon']
-        logoff_events = logon_df[logon_df['action'] == 'Logoff']
+        self.families['logon'] = features
+        logger.info(f"Extracted logon features: {features.shape}")
+    
+    def extract_session_features(self):
+        """Extract session duration statistics per user from logon data."""
+        if 'logon' not in self.cleaned_data:
+            logger.error("Logon data not available for feature extraction")
+            return
         
-        session_durations = []
-        for user in logon_events['user'].unique():
-            user_logons = logon_events[logon_events['user'] == user]
-            user_logoffs = logoff_events[logoff_events['user'] == user]
-            
-            for _, logon in user_logons.iterrows():
-                next_logoff = user_logoffs[user_logoffs.index > logon.name]
-                if not next_logoff.empty:
-                    duration = (next_logoff.index[0] - logon.name).total_seconds() / 60  # in minutes
-                    session_durations.append({
-                        'user': user,
-                        'timestamp': logon.name,
-                        'session_duration_min': duration
-                    })
-        
-        if session_durations:
-            session_df = pd.DataFrame(session_durations)
-            session_features = session_df.groupby('user')['session_duration_min'].agg(
-                ['mean', 'std', 'max', 'min']
-            ).reset_index()
-            session_features.columns = ['user', 'avg_session_duration', 'std_session_duration', 
-                                      'max_session_duration', 'min_session_duration']
-            
-            # Merge with existing features
-            features = pd.merge(features, session_features, on='user', how='left')
+        # Each logon is paired with the logoff that follows it on the same PC
+        # (see sessions.py); the session table is reused while logons are unchanged
+        sessions = load_sessions(
+            self.cleaned_data['logon'], directory=self.sessions_dir, source_dir=self.cleaned_dir
+        )
+        if sessions.empty:
+            return
         
-        self.features['user_activity'] = features
-        logger.info(f"Extracted user activity features: {features.shape}")
+        features = session_statistics(sessions)
+        self.families['session'] = features
+        logger.info(f"Extracted session features: {features.shape}")
     
     def extract_file_access_features(self):
         """Extract file access patterns."""
@@ -106,40 +180,30 @@ class FeatureExtractor:
             logger.error("File access data not available for feature extraction")
             return
             
-        file_df = self.cleaned_data['file'].copy()
-        file_df['timestamp'] = pd.to_datetime(file_df['timestamp'])
-        file_df = file_df.set_index('timestamp').sort_index()
-        
-        features_list = []
+        file_df = self.cleaned_data['file']
         
         # Feature 1: File access counts by time window
-        for window in config.FEATURE_PARAMS['time_windows']:
-            # Count file operations per user per time window
-            file_counts = file_df.groupby(['user', pd.Grouper(freq=window)])['action'].count().reset_index()
-            file_counts = file_counts.rename(columns={'action': f'file_ops_count_{window}'})
-            features_list.append(file_counts)
+        specs = [
+            WindowSpec('file', 'activity_type', 'count', window, f'file_ops_count_{window}')
+            for window in config.FEATURE_PARAMS['time_windows']
+        ]
         
         # Feature 2: Unique files accessed
-        unique_files = file_df.groupby(['user', pd.Grouper(freq='1D')])['filename'].nunique().reset_index()
-        unique_files = unique_files.rename(columns={'filename': 'unique_files_accessed'})
-        features_list.append(unique_files)
+        specs.append(WindowSpec('file', 'filename', distinct_agg(), '1D', 'unique_files_accessed'))
         
         # Feature 3: File operation types
-        op_types = pd.get_dummies(file_df['action'], prefix='file_op')
-        op_types['user'] = file_df['user'].values
-        op_types['timestamp'] = file_df.index
-        op_aggregated = op_types.groupby(['user', pd.Grouper(key='timestamp', freq='1D')]).sum().reset_index()
-        features_list.append(op_aggregated)
+        op_types = pd.get_dummies(file_df['activity_type'], prefix='file_op')
+        op_columns = list(op_types.columns)
+        op_types['user_id'] = file_df['user_id'].values
+        op_types['timestamp'] = file_df['timestamp'].values
+        specs.extend(WindowSpec('file_ops', column, 'sum', '1D', column) for column in op_columns)
         
-        # Merge all features
-        features = features_list[0]
-        for df in features_list[1:]:
-            features = pd.merge(features, df, on=['user', 'timestamp'], how='outer')
+        features = self.aggregate({'file': file_df, 'file_ops': op_types}, specs)
         
         # Fill NaN values with 0
         features = features.fillna(0)
         
-        self.features['file_access'] = features
+        self.families['file'] = features
         logger.info(f"Extracted file access features: {features.shape}")
     
     def extract_email_features(self):
@@ -148,48 +212,44 @@ class FeatureExtractor:
             logger.error("Email data not available for feature extraction")
             return
             
-        email_df = self.cleaned_data['email'].copy()
-        email_df['timestamp'] = pd.to_datetime(email_df['timestamp'])
-        email_df = email_df.set_index('timestamp').sort_index()
-        
-        features_list = []
+        email_df = self.cleaned_data['email']
         
         # Feature 1: Email counts by time window
-        for window in config.FEATURE_PARAMS['time_windows']:
-            email_counts = email_df.groupby(['from', pd.Grouper(freq=window)])['to'].count().reset_index()
-            email_counts = email_counts.rename(columns={
-                'from': 'user',
-                'to': f'emails_sent_{window}'
-            })
-            features_list.append(email_counts)
-        
-        # Feature 2: Unique recipients
-        email_df['recipients'] = email_df['to'] + ',' + email_df['cc'].fillna('') + ',' + email_df['bcc'].fillna('')
-        email_df['num_recipients'] = email_df['recipients'].apply(lambda x: len([r for r in str(x).split(',') if r.strip()]))
-        
-        recipient_stats = email_df.groupby(['from', pd.Grouper(freq='1D')])['num_recipients'].agg(
-            ['sum', 'mean', 'max']
-        ).reset_index()
-        recipient_stats.columns = ['user', 'timestamp', 'total_recipients', 'avg_recipients', 'max_recipients']
-        features_list.append(recipient_stats)
+        specs = [
+            WindowSpec('email', 'recipient_id', 'count', window, f'emails_sent_{window}')
+            for window in config.FEATURE_PARAMS['time_windows']
+        ]
+        
+        # Feature 2: Recipients per email (counted when the edge table was built)
+        specs.extend([
+            WindowSpec('email', 'recipient_count', 'sum', '1D', 'total_recipients'),
+            WindowSpec('email', 'recipient_count', 'mean', '1D', 'avg_recipients'),
+            WindowSpec('email', 'recipient_count', 'max', '1D', 'max_recipients')
+        ])
+        
+        # Unique recipients and external share from the sender -> recipient edges
+        if 'email_edges' in self.cleaned_data:
+            specs.extend([
+                WindowSpec('email_edges', 'recipient_address', distinct_agg(), '1D', 'unique_recipients'),
+                WindowSpec('email_edges', 'is_external', 'mean', '1D', 'external_recipient_ratio')
+            ])
         
         # Feature 3: Email sizes
-        if 'size' in email_df.columns:
-            size_stats = email_df.groupby(['from', pd.Grouper(freq='1D')])['size'].agg(
-                ['sum', 'mean', 'max']
-            ).reset_index()
-            size_stats.columns = ['user', 'timestamp', 'total_email_size', 'avg_email_size', 'max_email_size']
-            features_list.append(size_stats)
-        
-        # Merge all features
-        features = features_list[0]
-        for df in features_list[1:]:
-            features = pd.merge(features, df, on=['user', 'timestamp'], how='outer')
+        if 'email_size' in email_df.columns:
+            specs.extend([
+                WindowSpec('email', 'email_size', 'sum', '1D', 'total_email_size'),
+                WindowSpec('email', 'email_size', 'mean', '1D', 'avg_email_size'),
+                WindowSpec('email', 'email_size', 'max', '1D', 'max_email_size')
+            ])
+        
+        features = self.aggregate(
+            self.cleaned_data, specs, keys={'email': 'sender_id', 'email_edges': 'sender_id'}
+        )
         
         # Fill NaN values with 0
         features = features.fillna(0)
         
-        self.features['email_activity'] = features
+        self.families['email'] = features
         logger.info(f"Extracted email activity features: {features.shape}")
     
     def extract_device_usage_features(self):
@@ -198,80 +258,134 @@ class FeatureExtractor:
             logger.error("Device data not available for feature extraction")
             return
             
-        device_df = self.cleaned_data['device'].copy()
-        device_df['timestamp'] = pd.to_datetime(device_df['timestamp'])
-        device_df = device_df.set_index('timestamp').sort_index()
+        device_df = self.cleaned_data['device']
         
         # Feature 1: Device connect/disconnect counts
-        device_events = pd.get_dummies(device_df['action'])
-        device_events['user'] = device_df['user'].values
-        device_events['timestamp'] = device_df.index
+        device_events = pd.get_dummies(device_df['activity_type'])
+        activities = list(device_events.columns)
+        device_events['user_id'] = device_df['user_id'].values
+        device_events['timestamp'] = device_df['timestamp'].values
         
         # Aggregate by user and time window
-        features_list = []
-        for window in config.FEATURE_PARAMS['time_windows']:
-            device_agg = device_events.groupby(['user', pd.Grouper(key='timestamp', freq=window)]).sum().reset_index()
-            device_agg = device_agg.rename(columns={
-                'Connect': f'device_connects_{window}',
-                'Disconnect': f'device_disconnects_{window}'
-            })
-            features_list.append(device_agg)
+        names = {'Connect': 'device_connects', 'Disconnect': 'device_disconnects'}
+        specs = [
+            WindowSpec('device_events', activity, 'sum', window,
+                       f"{names.get(activity, f'device_{activity}')}_{window}")
+            for window in config.FEATURE_PARAMS['time_windows']
+            for activity in activities
+        ]
         
         # Feature 2: Unique devices used
-        unique_devices = device_df.groupby(['user', pd.Grouper(freq='1D')])['device'].nunique().reset_index()
-        unique_devices = unique_devices.rename(columns={
-            'device': 'unique_devices_used'
-        })
-        features_list.append(unique_devices)
+        specs.append(WindowSpec('device', 'device_id', distinct_agg(), '1D', 'unique_devices_used'))
         
-        # Merge all features
-        features = features_list[0]
-        for df in features_list[1:]:
-            features = pd.merge(features, df, on=['user', 'timestamp'], how='outer')
+        features = self.aggregate({'device': device_df, 'device_events': device_events}, specs)
         
         # Fill NaN values with 0
         features = features.fillna(0)
         
-        self.features['device_usage'] = features
+        self.families['device'] = features
         logger.info(f"Extracted device usage features: {features.shape}")
     
+    def extract_contact_features(self):
+        """Extract the distinct and new recipients of every sender by time window.
+        
+        A recipient is new in the window holding the sender's first edge to
+        them; new_contact_rate is the share of the window's distinct
+        recipients that are new.
+        """
+        if 'email_edges' not in self.cleaned_data:
+            logger.error("Email edge data not available for feature extraction")
+            return
+        
+        edges = self.cleaned_data['email_edges']
+        contact_edges = edges[['sender_id', 'timestamp', 'recipient_address']].copy()
+        contact_edges['is_new_contact'] = first_contacts(edges).astype(np.int8)
+        time_windows = config.FEATURE_PARAMS['time_windows']
+        specs = [
+            spec for window in time_windows for spec in (
+                WindowSpec('contact_edges', 'recipient_address', distinct_agg(), window, f'contacts_{window}'),
+                WindowSpec('contact_edges', 'is_new_contact', 'sum', window, f'new_contacts_{window}')
+            )
+        ]
+        features = self.aggregate({'contact_edges': contact_edges}, specs, keys={'contact_edges': 'sender_id'})
+        features = features.fillna(0)
+        for window in time_windows:
+            contacts = features[f'contacts_{window}']
+            # Approximate distinct counts can fall below the exact new-contact count
+            rate = features[f'new_contacts_{window}'] / contacts.where(contacts > 0)
+            features[f'new_contact_rate_{window}'] = rate.fillna(0).clip(upper=1)
+        
+        self.families['contacts'] = features
+        logger.info(f"Extracted contact features: {features.shape}")
+    
+    def extract_graph_features(self):
+        """Extract degrees, external share and PageRank from the email communication graph."""
+        if 'email_edges' not in self.cleaned_data or 'users' not in self.cleaned_data:
+            logger.error("Email edge or users data not available for graph features")
+            return
+        
+        features = graph_features(self.cleaned_data['email_edges'], self.cleaned_data['users'])
+        self.families['graph'] = features
+        logger.info(f"Extracted email graph features: {features.shape}")
+    
+    def extract_decoy_features(self):
+        """Count the accesses of every user to decoy files.
+        
+        The decoy table only lists files and PCs, so users come from the file
+        access events. This family labels users for training and is not a
+        model feature.
+        """
+        if 'file' not in self.cleaned_data or 'decoy' not in self.cleaned_data:
+            logger.warning("File or decoy data not available; no decoy accesses extracted")
+            return
+        
+        file_df = self.cleaned_data['file']
+        decoy = file_df['filename'].isin(self.cleaned_data['decoy']['decoy_filename'])
+        counts = file_df.loc[decoy].groupby('user_id', observed=True).size()
+        features = pd.DataFrame({'user': counts.index.to_numpy(), 'decoy_accesses': counts.to_numpy()})
+        self.families['decoy'] = features
+        logger.info(f"Found {len(features)} users who accessed decoy files")
+    
+    def build_feature_sets(self):
+        """Join the families into the saved feature sets."""
+        self.features = {}
+        for name, families in FEATURE_SETS.items():
+            frames = [self.families[family] for family in families if family in self.families]
+            if not frames:
+                continue
+            features = frames[0]
+            # Per-user families (no window start) are merged onto every window of the user
+            for frame in frames[1:]:
+                features = pd.merge(features, frame, on='user', how='left')
+            self.features[name] = features
+    
     def combine_all_features(self):
         """Combine all extracted features into a single DataFrame."""
         if not self.features:
             logger.error("No features extracted yet")
             return
         
-        # Start with user activity features as base
-        if 'user_activity' in self.features:
-            all_features = self.features['user_activity']
-        else:
+        # User activity features are the base
+        if 'user_activity' not in self.features:
             logger.error("User activity features not available")
             return
         
-        # Merge with other feature sets
-        for feature_name, feature_df in self.features.items():
-            if feature_name != 'user_activity':
-                all_features = pd.merge(
-                    all_features,
-                    feature_df,
-                    on=['user', 'timestamp'],
-                    how='outer'
-                )
+        # Align all feature sets on (user, timestamp) in one pass
+        all_features = align_frames([self.features['user_activity']] + [
+            feature_df for feature_name, feature_df in self.features.items()
+            if feature_name != 'user_activity'
+        ])
         
         # Fill NaN values with appropriate defaults
         numeric_cols = all_features.select_dtypes(include=[np.number]).columns
         all_features[numeric_cols] = all_features[numeric_cols].fillna(0)
         
-        # Sort by user and timestamp
-        all_features = all_features.sort_values(['user', 'timestamp'])
-        
-        # Add time-based features
-        all_features['hour_of_day'] = all_features['timestamp'].dt.hour
-        all_features['day_of_week'] = all_features['timestamp'].dt.dayofweek
-        all_features['is_weekend'] = all_features['day_of_week'].isin([5, 6]).astype(int)
-        
-        # Mark business hours (9 AM to 5 PM)
-        all_features['is_business_hours'] = all_features['hour_of_day'].between(9, 17).astype(int)
+        # Add time-based features of the window start, on the shared business calendar
+        calendar = calendar_columns(all_features['timestamp'])
+        all_features['hour_of_day'] = calendar['hour']
+        all_features['day_of_week'] = calendar['day_of_week']
+        all_features['is_weekend'] = calendar['is_weekend']
+        all_features['is_business_hours'] = ((calendar['hour'] >= 0) & (calendar['is_after_hours'] == 0)).astype(np.int8)
         
         self.combined_features = all_features
         logger.info(f"Combined all features: {all_features.shape}")
@@ -285,36 +399,241 @@ class FeatureExtractor:
         # Create features directory if it doesn't exist
         config.FEATURES_DIR.mkdir(parents=True, exist_ok=True)
         
+        # Features are grouped on interned user codes; decode them only here
+        interner = EntityInterner.load()
+        user_columns = {'user': 'user', 'user_id': 'user'}
+        
         # Save combined features
-        output_path = config.FEATURES_DIR / "all_features.csv"
-        self.combined_features.to_csv(output_path, index=False)
+        combined = interner.decode_frame(self.combined_features.copy(), user_columns)
+        output_path = storage.write_table(combined, config.FEATURES_DIR, "all_features")
         logger.info(f"Saved combined features to {output_path}")
         
+        # Publish them by day for range and point-in-time reads
+        if store_available():
+            FeatureStore("all_features").publish(combined, replace_all=True)
+        
         # Also save individual feature sets for reference
         for name, df in self.features.items():
-            output_path = config.FEATURES_DIR / f"{name}_features.csv"
-            df.to_csv(output_path, index=False)
+            df = interner.decode_frame(df.copy(), user_columns)
+            output_path = storage.write_table(df, config.FEATURES_DIR, f"{name}_features")
             logger.info(f"Saved {name} features to {output_path}")
+        
+        # Decoy accesses label the users for training
+        if 'decoy' in self.families:
+            decoy = interner.decode_frame(self.families['decoy'].copy(), user_columns)
+            output_path = storage.write_table(decoy, config.FEATURES_DIR, "decoy_access")
+            logger.info(f"Saved decoy accesses to {output_path}")
+        else:
+            storage.remove_table(config.FEATURES_DIR, "decoy_access")
+    
+    def extract_families(self, names):
+        """Extract the given families from the whole cleaned tables in this process."""
+        sources = {source for name in names for source in FEATURE_FAMILIES[name][1]}
+        self.load_cleaned_data(sources)
+        for name in names:
+            getattr(self, FEATURE_FAMILIES[name][0])()
+    
+    def extract_parallel(self, n_workers, names):
+        """Run the extractors of the given families in worker processes.
+        
+        Each worker reads only its own cleaned tables from disk, so no
+        DataFrames are pickled to the workers; the families come back
+        keyed by interned user code and are joined in build_feature_sets().
+        Largest inputs are submitted first, so the extraction takes about as
+        long as the slowest family.
+        """
+        def input_size(name):
+            return sum(storage.table_size(config.CLEANED_DATA_DIR, CLEANED_TABLES[source])
+                       for source in FEATURE_FAMILIES[name][1])
+        
+        names = sorted(names, key=input_size, reverse=True)
+        logger.info(f"Extracting {len(names)} feature families with {n_workers} worker processes...")
+        failed = []
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(extract_family, name): name for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    features, seconds = future.result()
+                except Exception as e:
+                    failed.append(name)
+                    logger.error(f"✗ {name}: {str(e)}")
+                    continue
+                if features is not None:
+                    self.families[name] = features
+                    logger.info(f"✓ {name}: {features.shape} in {seconds:.1f}s")
+        
+        if failed:
+            raise RuntimeError(f"Feature extraction failed for: {', '.join(sorted(failed))}")
+    
+    def extract_sharded(self, manifest, names, n_workers=None):
+        """Extract the given families shard by shard from the user shards.
+        
+        All features are per user and the shards partition the users, so the
+        families of the shards are simply concatenated. Each worker holds
+        only its shard of every dataset; windows are aligned on the first
+        timestamps of the whole datasets recorded when sharding.
+        """
+        n_shards = manifest['n_shards']
+        origins = shard_origins(manifest)
+        n_workers = extraction_workers(n_shards, n_workers)
+        logger.info(f"Extracting features from {n_shards} user shards with {n_workers} worker processes...")
+        
+        shard_families = []
+        if n_workers > 1:
+            failed = []
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = {
+                    executor.submit(extract_shard, shard, origins, names): shard for shard in range(n_shards)
+                }
+                for future in as_completed(futures):
+                    shard = futures[future]
+                    try:
+                        families, seconds = future.result()
+                    except Exception as e:
+                        failed.append(shard)
+                        logger.error(f"✗ shard {shard}: {str(e)}")
+                        continue
+                    shard_families.append(families)
+                    logger.info(f"✓ shard {shard} in {seconds:.1f}s")
+            if failed:
+                raise RuntimeError(f"Feature extraction failed for shards: {sorted(failed)}")
+        else:
+            for shard in range(n_shards):
+                families, seconds = extract_shard(shard, origins, names)
+                shard_families.append(families)
+                logger.info(f"✓ shard {shard} in {seconds:.1f}s")
+        
+        for name in names:
+            parts = [families[name] for families in shard_families if name in families]
+            if parts:
+                self.families[name] = concat_shard_features(parts)
+                logger.info(f"Extracted {name} features: {self.families[name].shape}")
     
-    def run(self):
-        """Run the feature extraction pipeline."""
-        self.load_cleaned_data()
+    def run(self, n_workers=None):
+        """Run the feature extraction pipeline.
+        
+        Families whose cleaned tables, parameters and extractor code are
+        unchanged are reused from the family cache (see feature_graph.py);
+        only the others are extracted. When the cleaned tables have
+        up-to-date user shards (see Preprocessing/sharding.py), families are
+        extracted per shard; otherwise from the whole tables.
+        """
+        if distinct_agg() == 'approx_nunique':
+            logger.info(f"Distinct counts are approximate: HyperLogLog relative standard error "
+                        f"{distinct_error():.1%}")
+        
+        # Reuse the families whose key is unchanged
+        cache = FamilyCache()
+        keys = {name: family_key(cache, name) for name in FEATURE_FAMILIES}
+        for name, key in keys.items():
+            features = cache.load(name, key)
+            if features is not None:
+                self.families[name] = features
+        stale = [name for name in FEATURE_FAMILIES if name not in self.families]
+        
+        manifest = usable_shards() if stale else None
+        
+        family_workers = extraction_workers(len(stale), n_workers)
+        if not stale:
+            logger.info("All feature families are up to date")
+        elif manifest is not None:
+            sharded = [name for name in stale if name not in GLOBAL_FAMILIES]
+            if sharded:
+                self.extract_sharded(manifest, sharded, n_workers)
+            # Graph-wide families need the edges of every user at once
+            if len(sharded) < len(stale):
+                self.extract_families([name for name in stale if name in GLOBAL_FAMILIES])
+        elif family_workers > 1:
+            self.extract_parallel(family_workers, stale)
+        else:
+            self.extract_families(stale)
         
-        # Extract different types of features
-        self.extract_user_activity_features()
-        self.extract_file_access_features()
-        self.extract_email_features()
-        self.extract_device_usage_features()
+        for name in stale:
+            if name in self.families:
+                cache.save(name, keys[name], self.families[name])
         
-        # Combine all features
+        # Join the families into feature sets and combine them
+        self.build_feature_sets()
         self.combine_all_features()
         
         # Save features to disk
         self.save_features()
         
+        # Score the newly published days against each user's own baseline
+        refresh_baselines()
+        
         logger.info("Feature extraction completed successfully!")
         return self.combined_features
 
+
+def distinct_agg():
+    """Window aggregation of the unique_* features per FEATURE_PARAMS['distinct_counts']."""
+    return 'approx_nunique' if config.FEATURE_PARAMS.get('distinct_counts') == 'approx' else 'nunique'
+
+
+def distinct_error():
+    """Relative standard error of the unique_* features (0 when counted exactly)."""
+    if config.FEATURE_PARAMS.get('distinct_counts') != 'approx':
+        return 0.0
+    return SparseHyperLogLogArray(config.FEATURE_PARAMS.get('sketch_precision', 12)).error
+
+
+def extraction_workers(n_tasks, n_workers=None):
+    """Worker processes for feature extraction (1 = run in this process)."""
+    n_workers = n_workers or config.FEATURE_PARAMS.get('n_workers') or os.cpu_count() or 1
+    return max(1, min(n_tasks, n_workers))
+
+
+def family_key(cache, name):
+    """Cache key of a family from its tables, FEATURE_PARAMS and extractor code."""
+    method, sources, params = FEATURE_FAMILIES[name]
+    return cache.key(
+        name, [CLEANED_TABLES[source] for source in sources],
+        params={param: config.FEATURE_PARAMS.get(param) for param in params},
+        method=getattr(FeatureExtractor, method),
+        dependencies=[globals()[code] for code in FAMILY_CODE[name]]
+    )
+
+
+def extract_family(name):
+    """Extract one family from its cleaned tables, returning (features, seconds).
+    
+    This is the entry point of the worker processes in parallel mode: it
+    builds its own FeatureExtractor and loads only the tables it reads.
+    """
+    start = timer.time()
+    extractor = FeatureExtractor()
+    extractor.extract_families([name])
+    return extractor.families.get(name), timer.time() - start
+
+
+def extract_shard(shard, origins, names):
+    """Extract the given families of one user shard, returning ({name: features}, seconds)."""
+    start = timer.time()
+    extractor = FeatureExtractor(
+        cleaned_dir=shard_dir(shard), origins=origins,
+        sessions_dir=config.FEATURES_DIR / 'shards' / shard_dir(shard).name
+    )
+    extractor.extract_families(names)
+    return extractor.families, timer.time() - start
+
+
+def concat_shard_features(parts):
+    """Concatenate the per-shard frames of one family, ordered by user (and time).
+    
+    Indicator columns of activity types that never occur in a shard are
+    missing from its frame and filled with 0.
+    """
+    columns = list(dict.fromkeys(col for part in parts for col in part.columns))
+    parts = [
+        part.reindex(columns=columns, fill_value=0) if len(part.columns) < len(columns) else part[columns]
+        for part in parts
+    ]
+    features = pd.concat(parts, ignore_index=True)
+    keys = [col for col in ('user', 'timestamp') if col in features.columns]
+    return features.sort_values(keys, kind='stable', ignore_index=True)
+
 if __name__ == "__main__":
     extractor = FeatureExtractor()
     features = extractor.run()
@@ -0,0 +1,83 @@
+"""
+Cached outputs of the feature families.
+
+FeatureExtractor declares its features as families (logon, session, email,
+file, device, contacts, graph, decoy), each computed by one extractor method
+from a few cleaned tables, and the feature sets it saves as joins of families:
+
+    cleaned tables --> families --> feature sets --> all_features
+
+Every family's output is stored as a table under Data/Features/families and
+in the stage cache, keyed by the fingerprint of its cleaned tables, the
+config parameters it reads and the source code of its extractor method and of
+the helper modules that compute it (window aggregation, sessions, ...). A
+run only recomputes the families whose key changed and then redoes the
+joins, so changing one feature or one dataset does not recompute the others.
+"""
+import inspect
+import logging
+
+from Src import config
+from Src import storage
+from Src import stage_cache
+from Src.stage_cache import StageCache
+
+logger = logging.getLogger(__name__)
+
+
+def families_dir():
+    """Directory holding the current output of every family."""
+    return config.FEATURES_DIR / 'families'
+
+
+class FamilyCache:
+    """Family outputs kept in place and in the stage cache, by family key."""
+
+    def __init__(self, directory=None, enabled=None):
+        self.directory = directory or families_dir()
+        if enabled is None:
+            enabled = config.CACHE_PARAMS.get('enabled', True)
+        self.cache = StageCache() if enabled else None
+
+    @staticmethod
+    def stage(name):
+        """Stage cache name of a family."""
+        return f'feature-family-{name}'
+
+    def outputs(self, name):
+        """Paths of a family's stored table."""
+        return [storage.parquet_path(self.directory, name), storage.csv_path(self.directory, name)]
+
+    def key(self, name, tables, params=None, method=None, dependencies=()):
+        """Key of a family from its cleaned tables, config parameters and code.
+
+        The code is the source of the extractor method and of dependencies,
+        the modules and functions it calls to compute the features.
+        """
+        inputs = []
+        for table in tables:
+            inputs.extend([storage.parquet_path(config.CLEANED_DATA_DIR, table),
+                           storage.csv_path(config.CLEANED_DATA_DIR, table)])
+        code = [inspect.getsource(obj) for obj in ([method] if method is not None else []) + list(dependencies)]
+        return stage_cache.stage_key(self.stage(name), inputs=inputs, params={'params': params, 'code': code})
+
+    def load(self, name, key):
+        """The cached output of a family for this key, or None when it must be computed."""
+        if self.cache is None:
+            return None
+        stage, outputs = self.stage(name), self.outputs(name)
+        if not self.cache.is_current(stage, key, outputs):
+            if not self.cache.contains(stage, key):
+                return None
+            self.cache.restore(stage, key)
+            self.cache.mark_current(stage, key, outputs)
+        logger.info(f"Feature family {name}: inputs, parameters and code unchanged; reusing it")
+        return storage.read_table(self.directory, name)
+
+    def save(self, name, key, features):
+        """Store the output of a family computed for this key."""
+        storage.write_table(features, self.directory, name)
+        if self.cache is not None:
+            stage, outputs = self.stage(name), self.outputs(name)
+            self.cache.store(stage, key, outputs)
+            self.cache.mark_current(stage, key, outputs)
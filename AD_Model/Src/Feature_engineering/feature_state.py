@@ -0,0 +1,395 @@
+"""
+Online per-user feature state.
+
+quick_features.py recomputes its per-user aggregates from the full history
+on every run. This state keeps the same aggregates as one compact record per
+user, stored column-wise in arrays indexed by the interned user code:
+
+- counters: event counts and sums of flags and sizes
+- running maxima
+- Welford mean/variance accumulators, merged batch by batch
+- HyperLogLog distinct-count sketches (one HyperLogLogArray per feature)
+- per-activity counters, one per observed activity value
+
+refresh() folds in only the cleaned table parts written since the previous
+refresh, so a daily refresh costs time proportional to the new events. The
+state is snapshotted to a single file under Data/Features/state and emits the
+ml_features schema of quick_features on demand; distinct counts are
+approximate within the sketch error recorded in the snapshot. When a cleaned
+table was rebuilt instead of appended to, or the decoy list changed, the
+state is rebuilt from scratch.
+"""
+import os
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+from Src import config
+from Src import storage
+from Src.stage_cache import params_hash
+from Src.sketches import HyperLogLogArray
+from Src.Preprocessing.business_calendar import CALENDAR_COLUMNS, ensure_calendar_columns, known_hours
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = 'user_feature_state.npz'
+
+# Cleaned tables folded into the state: user column and columns read
+SOURCES = {
+    'logon_cleaned': ('user_id', ['user_id', 'logon_id', 'device_id', 'logon_type', 'timestamp'] + CALENDAR_COLUMNS),
+    'email_cleaned': ('sender_id', ['sender_id', 'email_id', 'has_attachments', 'email_size', 'timestamp'] +
+                      CALENDAR_COLUMNS),
+    'email_edges_cleaned': ('sender_id', ['sender_id', 'recipient_address', 'is_external']),
+    'file_cleaned': ('user_id', ['user_id', 'file_event_id', 'filename', 'device_id', 'activity_type',
+                                 'to_removable_media', 'from_removable_media', 'timestamp'] + CALENDAR_COLUMNS),
+    'device_cleaned': ('user_id', ['user_id', 'device_event_id', 'device_id', 'activity_type'])
+}
+
+# Decoy list, named after the raw decoy_file.csv by both quick_clean and the full cleaner
+DECOY_TABLE = 'decoy_file_cleaned'
+
+# ml_features columns of quick_features.py, in order
+ML_FEATURES = [
+    'total_logons', 'unique_devices_logon', 'weekend_logons', 'after_hours_logons',
+    'avg_logon_hour', 'std_logon_hour',
+    'total_emails_sent', 'emails_with_attachments', 'avg_email_size', 'total_email_size',
+    'max_email_size', 'unique_recipients', 'external_recipient_ratio', 'after_hours_emails',
+    'total_file_ops', 'unique_files', 'unique_devices_file', 'files_to_removable',
+    'files_from_removable', 'after_hours_file_ops',
+    'total_device_events', 'unique_devices_used',
+    'accessed_decoy'
+]
+
+# Per-activity count and share columns of quick_features: source table ->
+# (category column, column prefix, ML_FEATURES column they follow)
+ACTIVITY_COLUMNS = {
+    'logon_cleaned': ('logon_type', 'logon_type', 'std_logon_hour'),
+    'file_cleaned': ('activity_type', 'file_activity', 'after_hours_file_ops'),
+    'device_cleaned': ('activity_type', 'device_activity', 'unique_devices_used')
+}
+
+
+def state_dir():
+    """Directory holding the state snapshot."""
+    return config.FEATURES_DIR / 'state'
+
+
+def present(df, column):
+    """Non-missing flags of a column, all True when the table lacks it."""
+    if column not in df.columns:
+        return np.ones(len(df), dtype=bool)
+    return df[column].notna().to_numpy()
+
+
+class UserFeatureState:
+    """Per-user counters, maxima, moments and distinct sketches of the cleaned events."""
+
+    def __init__(self, precision=None):
+        self.precision = precision or config.FEATURE_STATE_PARAMS.get('sketch_precision', 10)
+        self.reset()
+
+    def reset(self):
+        """Drop all accumulated state."""
+        self.n_users = 0
+        self.counters = {}
+        self.maxima = {}
+        self.moments = {}
+        self.sketches = {}
+        self.consumed = {}
+        self.decoy = None
+
+    def _ensure(self, n_users):
+        """Grow every per-user array to at least n_users rows."""
+        if n_users <= self.n_users:
+            return
+        extra = n_users - self.n_users
+        for name, column in self.counters.items():
+            self.counters[name] = np.concatenate([column, np.zeros(extra)])
+        for name, column in self.maxima.items():
+            self.maxima[name] = np.concatenate([column, np.full(extra, -np.inf)])
+        for name, column in self.moments.items():
+            self.moments[name] = np.concatenate([column, np.zeros((3, extra))], axis=1)
+        for sketch in self.sketches.values():
+            sketch.grow(n_users)
+        self.n_users = n_users
+
+    def add_count(self, name, users, weights=None):
+        """Add one per event (or its weight) to a per-user counter."""
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+        column = self.counters.setdefault(name, np.zeros(self.n_users))
+        column += np.bincount(users, weights, minlength=self.n_users)
+
+    def add_max(self, name, users, values):
+        """Fold event values into a per-user running maximum, skipping NaN."""
+        column = self.maxima.setdefault(name, np.full(self.n_users, -np.inf))
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        np.maximum.at(column, users[valid], values[valid])
+
+    def add_moments(self, name, users, values):
+        """Merge the mean and variance of a batch into per-user Welford accumulators."""
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        users, values = users[valid], values[valid]
+        moments = self.moments.setdefault(name, np.zeros((3, self.n_users)))
+        count, mean, m2 = moments
+
+        batch_count = np.bincount(users, minlength=self.n_users).astype(np.float64)
+        batch_mean = np.bincount(users, values, minlength=self.n_users) / np.maximum(batch_count, 1)
+        batch_m2 = np.bincount(users, (values - batch_mean[users]) ** 2, minlength=self.n_users)
+
+        # Chan et al.'s pairwise update
+        total = count + batch_count
+        delta = batch_mean - mean
+        scale = np.where(total > 0, batch_count / np.maximum(total, 1), 0.0)
+        moments[1] = mean + delta * scale
+        moments[2] = m2 + batch_m2 + delta ** 2 * count * scale
+        moments[0] = total
+
+    def add_activity(self, prefix, users, values):
+        """Count events per user and value in '<prefix>=<value>' counters."""
+        codes, uniques = pd.factorize(values)
+        for code, value in enumerate(uniques):
+            self.add_count(f'{prefix}={value}', users, codes == code)
+
+    def add_distinct(self, name, users, values):
+        """Add event values to per-user distinct-count sketches."""
+        sketch = self.sketches.setdefault(name, HyperLogLogArray(self.precision, self.n_users))
+        sketch.update(users, values)
+
+    def fold(self, table, df, decoy_names=()):
+        """Fold one batch of a cleaned table into the state."""
+        user_column = SOURCES[table][0]
+        df = df[df[user_column].notna() & (df[user_column] >= 0)]
+        if df.empty:
+            return
+        users = df[user_column].to_numpy(dtype=np.int64)
+        self._ensure(int(users.max()) + 1)
+
+        if 'timestamp' in df.columns:
+            # Calendar columns of the cleaned table; older tables lack them
+            df = ensure_calendar_columns(df)
+            late = df['is_after_hours'].to_numpy()
+
+        if table == 'logon_cleaned':
+            self.add_count('total_logons', users, present(df, 'logon_id'))
+            self.add_distinct('unique_devices_logon', users, df['device_id'])
+            self.add_count('weekend_logons', users, df['is_weekend'].to_numpy())
+            self.add_count('after_hours_logons', users, late)
+            self.add_moments('logon_hour', users, known_hours(df))
+
+        elif table == 'email_cleaned':
+            sizes = pd.to_numeric(df['email_size'], errors='coerce').to_numpy(dtype=np.float64)
+            self.add_count('total_emails_sent', users, present(df, 'email_id'))
+            self.add_count('emails_with_attachments', users,
+                           pd.to_numeric(df['has_attachments'], errors='coerce').fillna(0).to_numpy())
+            self.add_count('total_email_size', users, np.nan_to_num(sizes))
+            self.add_count('sized_emails', users, ~np.isnan(sizes))
+            self.add_max('max_email_size', users, sizes)
+            self.add_count('after_hours_emails', users, late)
+
+        elif table == 'email_edges_cleaned':
+            self.add_distinct('unique_recipients', users, df['recipient_address'])
+            self.add_count('recipient_edges', users)
+            self.add_count('external_edges', users, df['is_external'].fillna(False).to_numpy(dtype=bool))
+
+        elif table == 'file_cleaned':
+            self.add_count('total_file_ops', users, present(df, 'file_event_id'))
+            self.add_distinct('unique_files', users, df['filename'])
+            self.add_distinct('unique_devices_file', users, df['device_id'])
+            for column, name in [('to_removable_media', 'files_to_removable'),
+                                 ('from_removable_media', 'files_from_removable')]:
+                if column in df.columns:
+                    self.add_count(name, users, pd.to_numeric(df[column], errors='coerce').fillna(0).to_numpy())
+            self.add_count('after_hours_file_ops', users, late)
+            self.add_count('decoy_accesses', users, df['filename'].isin(decoy_names).to_numpy())
+
+        elif table == 'device_cleaned':
+            self.add_count('total_device_events', users, present(df, 'device_event_id'))
+            self.add_distinct('unique_devices_used', users, df['device_id'])
+
+        if table in ACTIVITY_COLUMNS and ACTIVITY_COLUMNS[table][0] in df.columns:
+            column, prefix, _ = ACTIVITY_COLUMNS[table]
+            self.add_activity(prefix, users, df[column])
+
+    def refresh(self, directory=None):
+        """Fold in the cleaned parts written since the last refresh; returns the new rows."""
+        directory = directory or config.CLEANED_DATA_DIR
+        decoy_names = load_decoy_names(directory)
+        decoy = params_hash(sorted(decoy_names))
+        tables = {table: storage.part_stats(directory, table) for table in SOURCES}
+
+        rebuilt = [table for table, parts in tables.items()
+                   if parts[:len(self.consumed.get(table, []))] != self.consumed.get(table, [])]
+        if self.consumed and (rebuilt or decoy != self.decoy):
+            logger.warning(f"Cleaned tables rebuilt ({', '.join(rebuilt) or 'decoy list'}); "
+                           f"rebuilding the feature state")
+            self.reset()
+        self.decoy = decoy
+
+        new_rows = 0
+        for table, parts in tables.items():
+            user_column, columns = SOURCES[table]
+            for part in parts[len(self.consumed.get(table, [])):]:
+                path = directory / part[0]
+                if path.suffix == '.csv':
+                    df = storage.read_table(directory, table, columns=columns, parse_dates=['timestamp'])
+                else:
+                    df = storage.read_part(path, columns=columns)
+                self.fold(table, df, decoy_names)
+                new_rows += len(df)
+            self.consumed[table] = parts
+        logger.info(f"Folded {new_rows:,} new events into the state of {self.n_users:,} users")
+        return new_rows
+
+    def features(self, users=None):
+        """Per-user features in the all_features / ml_features layout of quick_features.
+
+        users are the user codes to emit, by default those of the users table.
+        Returns (all_features, ml_features); users without events get zeros.
+        """
+        if users is None:
+            users = load_user_codes()
+        users = np.asarray(users, dtype=np.int64)
+        known = (users >= 0) & (users < self.n_users)
+        rows = np.where(known, users, 0)
+
+        def take(values, default=0.0):
+            values = np.asarray(values, dtype=np.float64)
+            if len(values) == 0:
+                return np.full(len(users), default)
+            return np.where(known, values[rows], default)
+
+        def counter(name):
+            return take(self.counters.get(name, np.zeros(self.n_users)))
+
+        def distinct(name):
+            sketch = self.sketches.get(name)
+            return take(sketch.counts() if sketch is not None else np.zeros(self.n_users))
+
+        count, mean, m2 = self.moments.get('logon_hour', np.zeros((3, self.n_users)))
+        hour_count = take(count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std_hour = np.where(hour_count > 1, np.sqrt(take(m2) / np.maximum(hour_count - 1, 1)), 0.0)
+            avg_size = np.where(counter('sized_emails') > 0,
+                                counter('total_email_size') / np.maximum(counter('sized_emails'), 1), 0.0)
+            external = np.where(counter('recipient_edges') > 0,
+                                counter('external_edges') / np.maximum(counter('recipient_edges'), 1), 0.0)
+        max_size = take(self.maxima.get('max_email_size', np.full(self.n_users, -np.inf)), -np.inf)
+
+        columns = {name: counter(name) for name in ML_FEATURES}
+        columns.update({
+            'unique_devices_logon': distinct('unique_devices_logon'),
+            'avg_logon_hour': np.where(hour_count > 0, take(mean), 0.0),
+            'std_logon_hour': std_hour,
+            'avg_email_size': avg_size,
+            'max_email_size': np.where(np.isinf(max_size), 0.0, max_size),
+            'unique_recipients': distinct('unique_recipients'),
+            'external_recipient_ratio': external,
+            'unique_files': distinct('unique_files'),
+            'unique_devices_file': distinct('unique_devices_file'),
+            'unique_devices_used': distinct('unique_devices_used'),
+            'accessed_decoy': (counter('decoy_accesses') > 0).astype(np.int64)
+        })
+        ratios = {'avg_logon_hour', 'std_logon_hour', 'avg_email_size', 'external_recipient_ratio'}
+
+        # Activity counts and shares, placed after the columns of their source
+        activity = {}
+        for _, prefix, after in ACTIVITY_COLUMNS.values():
+            names = sorted(name for name in self.counters if name.startswith(f'{prefix}='))
+            counts = {name: counter(name) for name in names}
+            total = sum(counts.values(), np.zeros(len(users)))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                shares = {f'{name}_ratio': np.where(total > 0, counts[name] / np.maximum(total, 1), 0.0)
+                          for name in names}
+            columns.update(counts)
+            columns.update(shares)
+            ratios.update(shares)
+            activity[after] = names + list(shares)
+        ordered = [column for name in ML_FEATURES for column in [name] + activity.get(name, [])]
+
+        ml_features = pd.DataFrame({name: columns[name] for name in ordered})
+        for name in ordered:
+            if name not in ratios:
+                ml_features[name] = ml_features[name].round().astype(np.int64)
+
+        all_features = ml_features.copy()
+        all_features.insert(0, 'user_id', users.astype(np.int32))
+        return all_features, ml_features
+
+    def save(self, directory=None):
+        """Snapshot the state to one file, replaced atomically."""
+        directory = directory or state_dir()
+        directory.mkdir(parents=True, exist_ok=True)
+        meta = {
+            'precision': self.precision,
+            'n_users': self.n_users,
+            'consumed': self.consumed,
+            'decoy': self.decoy,
+            'sketch_error': round(float(1.04 / np.sqrt(1 << self.precision)), 4),
+            'saved': pd.Timestamp.now().isoformat()
+        }
+        arrays = {'meta': np.array(json.dumps(meta))}
+        arrays.update({f'counter:{name}': column for name, column in self.counters.items()})
+        arrays.update({f'max:{name}': column for name, column in self.maxima.items()})
+        arrays.update({f'moments:{name}': column for name, column in self.moments.items()})
+        arrays.update({f'sketch:{name}': sketch.registers for name, sketch in self.sketches.items()})
+
+        path = directory / STATE_FILE
+        tmp_path = directory / f'{STATE_FILE}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+        logger.info(f"Saved feature state of {self.n_users:,} users to {path}")
+        return path
+
+    @classmethod
+    def load(cls, directory=None):
+        """Load the snapshot, or return an empty state when there is none."""
+        path = (directory or state_dir()) / STATE_FILE
+        if not path.exists():
+            return cls()
+        with np.load(path) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            state = cls(meta['precision'])
+            state.n_users = meta['n_users']
+            state.consumed = meta['consumed']
+            state.decoy = meta['decoy']
+            for key in arrays.files:
+                kind, _, name = key.partition(':')
+                if kind == 'counter':
+                    state.counters[name] = arrays[key]
+                elif kind == 'max':
+                    state.maxima[name] = arrays[key]
+                elif kind == 'moments':
+                    state.moments[name] = arrays[key]
+                elif kind == 'sketch':
+                    sketch = HyperLogLogArray(state.precision)
+                    sketch.registers = arrays[key]
+                    state.sketches[name] = sketch
+        return state
+
+
+def load_decoy_names(directory=None):
+    """Decoy filenames of the cleaned decoy list (empty when there is none)."""
+    directory = directory or config.CLEANED_DATA_DIR
+    if not storage.table_exists(directory, DECOY_TABLE):
+        return set()
+    names = storage.read_table(directory, DECOY_TABLE, columns=['decoy_filename'])['decoy_filename']
+    return set(names.dropna())
+
+
+def load_user_codes(directory=None):
+    """User codes of the users table."""
+    directory = directory or config.CLEANED_DATA_DIR
+    return storage.read_table(directory, 'users_cleaned', columns=['user_id'])['user_id'].to_numpy()
+
+
+def refresh_state(directory=None):
+    """Load the state, fold in new cleaned events and snapshot it again."""
+    state = UserFeatureState.load(directory)
+    state.refresh()
+    state.save(directory)
+    return state
@@ -0,0 +1,222 @@
+"""
+Point-in-time feature store partitioned by day.
+
+The time-keyed feature table (one row per user and window start) is stored
+as one Parquet file per day, sorted by user so that row-group statistics let
+reads skip other users, together with a per-user index of the days on which
+each user has rows:
+
+    Features/store/<table>/
+        manifest.json                       current file of every day, index file
+        date=2010-01-02/part-000007.parquet
+        index-000007.parquet                (user, date, rows)
+
+Range scans read only the days in the range (and, given users, only the days
+on which those users have rows); point-in-time reads find the last day with
+rows for each user on or before a date through the index. Publishing writes
+new day files and a new index next to the current ones and then swaps the
+manifest atomically, so readers see either the old or the new version of
+every day; days whose rows are unchanged are not rewritten.
+"""
+import os
+import json
+import shutil
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from Src import config
+from Src.storage import pa, pq
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def store_dir():
+    """Directory holding the feature store."""
+    return config.FEATURES_DIR / 'store'
+
+
+def store_available():
+    """Whether the feature store can be used (it needs pyarrow and is enabled in config)."""
+    return pq is not None and config.FEATURE_STORE_PARAMS.get('enabled', True)
+
+
+def to_day(date):
+    """Normalize a date-like value to a midnight Timestamp."""
+    return pd.Timestamp(date).normalize()
+
+
+class FeatureStore:
+    """Day-partitioned store of one feature table keyed by (key, time_column)."""
+
+    def __init__(self, name='all_features', directory=None, key='user', time_column='timestamp'):
+        self.name = name
+        self.path = Path(directory or store_dir()) / name
+        self.key = key
+        self.time_column = time_column
+
+    def manifest(self):
+        """The current manifest, or an empty one when nothing was published."""
+        path = self.path / MANIFEST_FILE
+        if not path.exists():
+            return {'version': 0, 'partitions': {}, 'index': None, 'columns': []}
+        with open(path) as f:
+            return json.load(f)
+
+    def exists(self):
+        """Whether any day has been published."""
+        return bool(self.manifest()['partitions'])
+
+    def dates(self, start=None, end=None):
+        """Published days within [start, end], in order."""
+        days = sorted(pd.Timestamp(day) for day in self.manifest()['partitions'])
+        return [day for day in days
+                if (start is None or day >= to_day(start)) and (end is None or day <= to_day(end))]
+
+    def index(self, manifest=None):
+        """The per-user index: one (key, date, rows) row per user and day."""
+        manifest = manifest or self.manifest()
+        if manifest['index'] is None:
+            return pd.DataFrame({self.key: pd.Series(dtype=object), 'date': pd.Series(dtype='datetime64[ns]'),
+                                 'rows': pd.Series(dtype=np.int64)})
+        return pq.read_table(self.path / manifest['index']).to_pandas()
+
+    def publish(self, df, replace_all=False):
+        """Publish the rows of df as the new content of the days they cover.
+
+        Days not in df keep their current files unless replace_all is True,
+        in which case they are dropped. Returns the days that were written.
+        """
+        if df.empty:
+            logger.warning(f"Feature store {self.name}: nothing to publish")
+            return []
+        manifest = self.manifest()
+        version = manifest['version'] + 1
+        partitions = dict(manifest['partitions'])
+        days = df[self.time_column].dt.normalize()
+        order = np.lexsort((df[self.time_column].to_numpy(), df[self.key].to_numpy(), days.to_numpy()))
+        df, days = df.iloc[order].reset_index(drop=True), days.iloc[order].reset_index(drop=True)
+
+        written = []
+        index_parts = []
+        self.path.mkdir(parents=True, exist_ok=True)
+        bounds = np.flatnonzero(np.r_[True, days.to_numpy()[1:] != days.to_numpy()[:-1], True])
+        for begin, stop in zip(bounds[:-1], bounds[1:]):
+            day = days.iloc[begin]
+            label = day.strftime('%Y-%m-%d')
+            rows = df.iloc[begin:stop]
+            digest = str(int(pd.util.hash_pandas_object(rows, index=False).sum()))
+            counts = rows.groupby(self.key, sort=True).size()
+            index_parts.append(pd.DataFrame({self.key: counts.index, 'date': day, 'rows': counts.to_numpy()}))
+            current = partitions.get(label)
+            if current is not None and current['hash'] == digest:
+                continue
+
+            part = Path(f'date={label}') / f'part-{version:06d}.parquet'
+            (self.path / part).parent.mkdir(parents=True, exist_ok=True)
+            pq.write_table(
+                pa.Table.from_pandas(rows, preserve_index=False), self.path / part,
+                row_group_size=config.FEATURE_STORE_PARAMS.get('row_group_rows', 65536),
+                compression=config.STORAGE_PARAMS.get('compression', 'snappy')
+            )
+            partitions[label] = {'file': str(part), 'rows': len(rows), 'users': len(counts), 'hash': digest}
+            written.append(day)
+
+        published = {day.strftime('%Y-%m-%d') for day in days.drop_duplicates()}
+        if replace_all:
+            partitions = {label: partition for label, partition in partitions.items() if label in published}
+        if not written and partitions.keys() == manifest['partitions'].keys():
+            logger.info(f"Feature store {self.name}: no changed days to publish")
+            return written
+
+        # Index rows of the days that were not republished stay as they were
+        index = self.index(manifest)
+        kept = index[~index['date'].dt.strftime('%Y-%m-%d').isin(published) &
+                     index['date'].dt.strftime('%Y-%m-%d').isin(partitions.keys())]
+        index = pd.concat([kept] + index_parts, ignore_index=True)
+        index = index.sort_values([self.key, 'date'], ignore_index=True)
+        index_file = f'index-{version:06d}.parquet'
+        pq.write_table(pa.Table.from_pandas(index, preserve_index=False), self.path / index_file)
+
+        new_manifest = {
+            'version': version,
+            'partitions': dict(sorted(partitions.items())),
+            'index': index_file,
+            'columns': [str(col) for col in df.columns],
+            'published': pd.Timestamp.now().isoformat()
+        }
+        tmp_path = self.path / f'{MANIFEST_FILE}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(new_manifest, f, indent=2)
+        os.replace(tmp_path, self.path / MANIFEST_FILE)
+        self._remove_unreferenced(new_manifest)
+        logger.info(f"Feature store {self.name}: published {len(written)} of {len(published)} days "
+                    f"(version {version})")
+        return written
+
+    def _remove_unreferenced(self, manifest):
+        """Delete day files and indexes that the manifest no longer references."""
+        referenced = {partition['file'] for partition in manifest['partitions'].values()}
+        for path in self.path.glob('date=*/*.parquet'):
+            if str(path.relative_to(self.path)) not in referenced:
+                path.unlink()
+        for directory in self.path.glob('date=*'):
+            if directory.is_dir() and not any(directory.iterdir()):
+                shutil.rmtree(directory)
+        for path in self.path.glob('index-*.parquet'):
+            if path.name != manifest['index']:
+                path.unlink()
+
+    def _read_days(self, manifest, labels, users=None, columns=None):
+        """Read the files of the given days, keeping only rows of users when given."""
+        filters = None
+        if users is not None:
+            filters = [(self.key, 'in', list(users))]
+        if columns is not None:
+            columns = list(dict.fromkeys([self.key, self.time_column] + list(columns)))
+        frames = [
+            pq.read_table(self.path / manifest['partitions'][label]['file'], columns=columns,
+                          filters=filters).to_pandas()
+            for label in labels
+        ]
+        if not frames:
+            return pd.DataFrame(columns=columns or manifest['columns'])
+        return pd.concat(frames, ignore_index=True)
+
+    def scan(self, start=None, end=None, users=None, columns=None):
+        """Rows of the days in [start, end], optionally only of some users and columns.
+
+        Only the files of those days are opened; with users, only the days
+        on which the index lists rows of them.
+        """
+        manifest = self.manifest()
+        labels = [day.strftime('%Y-%m-%d') for day in self.dates(start, end)]
+        if users is not None:
+            index = self.index(manifest)
+            listed = index.loc[index[self.key].isin(users), 'date'].dt.strftime('%Y-%m-%d')
+            labels = [label for label in labels if label in set(listed)]
+        logger.info(f"Feature store {self.name}: reading {len(labels)} of {len(manifest['partitions'])} days")
+        return self._read_days(manifest, labels, users, columns)
+
+    def as_of(self, date, users=None, columns=None):
+        """Latest row of every user (or of the given users) on or before the end of date.
+
+        Users without rows up to date are left out.
+        """
+        manifest = self.manifest()
+        index = self.index(manifest)
+        index = index[index['date'] <= to_day(date)]
+        if users is not None:
+            index = index[index[self.key].isin(users)]
+        latest = index.groupby(self.key, sort=False)['date'].max()
+        frames = []
+        for day, day_users in latest.groupby(latest):
+            frames.append(self._read_days(manifest, [day.strftime('%Y-%m-%d')], day_users.index, columns))
+        if not frames:
+            return self._read_days(manifest, [], columns=columns)
+        rows = pd.concat(frames, ignore_index=True)
+        rows = rows.sort_values([self.key, self.time_column], ignore_index=True)
+        return rows.groupby(self.key, sort=False).tail(1).reset_index(drop=True)
@@ -0,0 +1,208 @@
+"""
+Peer-group deviations of the per-user features.
+
+The users table describes where everyone sits in the organisation (role,
+department, team, business unit, supervisor), which makes a user's peers the
+natural reference for what is normal for them. For every per-user feature and
+every peer attribute in config.PEER_GROUP_PARAMS this stage emits a robust
+z-score against the user's peer group:
+
+    <feature>_peer_<attribute>_z = (value - group median) / max(1.4826 * group MAD, min_scale)
+
+Groups smaller than min_group_size and users without the attribute get 0.
+The group medians and MADs are computed with vectorized groupby medians,
+never a loop over users. The stage keeps the inputs and group statistics of
+its previous run under Data/Features/peers; when the users table is unchanged
+and only activity changed, only the groups that contain a user whose features
+changed have their statistics recomputed.
+"""
+import os
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+from Src import config
+from Src import storage
+from Src.stage_cache import params_hash
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = 'peer_groups.npz'
+
+# Scale of the median absolute deviation of a normal distribution
+MAD_SCALE = 1.4826
+
+# Per-user columns that are labels rather than behaviour
+EXCLUDED_COLUMNS = ['user_id', 'accessed_decoy']
+
+
+def peers_dir():
+    """Directory holding the peer-group snapshot."""
+    return config.FEATURES_DIR / 'peers'
+
+
+def peer_params():
+    """Parameters the peer deviations depend on."""
+    params = config.PEER_GROUP_PARAMS
+    return {
+        'attributes': list(params.get('attributes', ['role', 'department', 'team'])),
+        'min_group_size': params.get('min_group_size', 5),
+        'min_scale': params.get('min_scale', 1.0),
+        'features': params.get('features')
+    }
+
+
+def load_org(attributes, directory=None):
+    """Peer attributes of every user, from the cleaned users table."""
+    directory = directory or config.CLEANED_DATA_DIR
+    return storage.read_table(directory, 'users_cleaned', columns=['user_id'] + list(attributes))
+
+
+def group_statistics(values, codes, groups):
+    """Median and MAD of every feature over the members of the given groups.
+
+    Returns two (len(groups), features) arrays, in the order of groups.
+    """
+    members = np.isin(codes, groups)
+    member_codes = codes[members]
+    member_values = values[members]
+    medians = pd.DataFrame(member_values).groupby(member_codes).median()
+    deviations = np.abs(member_values - medians.loc[member_codes].to_numpy())
+    mads = pd.DataFrame(deviations).groupby(member_codes).median()
+    return medians.reindex(groups).to_numpy(), mads.reindex(groups).to_numpy()
+
+
+class PeerGroups:
+    """Peer-group medians and MADs of the per-user features, refreshed by changed group."""
+
+    def __init__(self, params=None):
+        self.params = params or peer_params()
+        self.reset()
+
+    def reset(self):
+        """Drop the previous inputs and group statistics."""
+        self.users = np.zeros(0, dtype=np.int64)
+        self.columns = []
+        self.values = np.zeros((0, 0))
+        self.org = None
+        self.codes = {}
+        self.medians = {}
+        self.mads = {}
+
+    def refresh(self, features, org):
+        """Peer deviations of per-user features (one row per user_id), in the row order of features."""
+        columns = self.params['features'] or [
+            column for column in features.select_dtypes(include=[np.number]).columns
+            if column not in EXCLUDED_COLUMNS
+        ]
+        users = features['user_id'].to_numpy(dtype=np.int64)
+        values = features[columns].fillna(0).to_numpy(dtype=np.float64)
+        org = org.set_index('user_id').reindex(users)
+        org_digest = str(int(pd.util.hash_pandas_object(org, index=True).sum()))
+
+        rebuild = (org_digest != self.org or columns != self.columns or not np.array_equal(users, self.users))
+        if rebuild:
+            self.reset()
+            self.org = org_digest
+            self.columns = columns
+            self.users = users
+        changed = np.ones(len(users), dtype=bool) if rebuild else (values != self.values).any(axis=1)
+
+        for attribute in self.params['attributes']:
+            if attribute not in org.columns:
+                logger.warning(f"Users table has no {attribute} column; skipping its peer groups")
+                continue
+            if rebuild:
+                codes, uniques = pd.factorize(org[attribute])
+                self.codes[attribute] = codes.astype(np.int32)
+                self.medians[attribute] = np.zeros((len(uniques), len(columns)))
+                self.mads[attribute] = np.zeros((len(uniques), len(columns)))
+            codes = self.codes[attribute]
+            stale = np.unique(codes[changed & (codes >= 0)])
+            if len(stale):
+                medians, mads = group_statistics(values, codes, stale)
+                self.medians[attribute][stale] = medians
+                self.mads[attribute][stale] = mads
+            logger.info(f"Peer groups by {attribute}: recomputed {len(stale)} of "
+                        f"{len(self.medians[attribute])} groups")
+        self.values = values
+        return self.deviations(features['user_id'])
+
+    def deviations(self, user_ids):
+        """Robust z-scores of the current values against every peer group."""
+        result = {'user_id': user_ids.to_numpy()}
+        for attribute, codes in self.codes.items():
+            sizes = np.bincount(codes[codes >= 0], minlength=len(self.medians[attribute]))
+            rows = np.maximum(codes, 0)
+            valid = ((codes >= 0) & (sizes[rows] >= self.params['min_group_size']))[:, None]
+            scale = np.maximum(MAD_SCALE * self.mads[attribute][rows], self.params['min_scale'])
+            scores = np.where(valid, (self.values - self.medians[attribute][rows]) / scale, 0.0)
+            for i, column in enumerate(self.columns):
+                result[f'{column}_peer_{attribute}_z'] = scores[:, i].astype(np.float32)
+        return pd.DataFrame(result, index=user_ids.index)
+
+    def save(self, directory=None):
+        """Snapshot the inputs and group statistics to one file, replaced atomically."""
+        directory = directory or peers_dir()
+        directory.mkdir(parents=True, exist_ok=True)
+        meta = {
+            'params': self.params,
+            'params_hash': params_hash(self.params),
+            'columns': self.columns,
+            'org': self.org,
+            'attributes': list(self.codes),
+            'saved': pd.Timestamp.now().isoformat()
+        }
+        arrays = {'meta': np.array(json.dumps(meta)), 'users': self.users, 'values': self.values}
+        for attribute in self.codes:
+            arrays[f'codes:{attribute}'] = self.codes[attribute]
+            arrays[f'median:{attribute}'] = self.medians[attribute]
+            arrays[f'mad:{attribute}'] = self.mads[attribute]
+
+        path = directory / STATE_FILE
+        tmp_path = directory / f'{STATE_FILE}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+        logger.info(f"Saved peer groups of {len(self.users):,} users to {path}")
+        return path
+
+    @classmethod
+    def load(cls, directory=None):
+        """Load the snapshot, or return empty peer groups when there is none or the parameters changed."""
+        path = (directory or peers_dir()) / STATE_FILE
+        if not path.exists():
+            return cls()
+        with np.load(path) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            if meta['params_hash'] != params_hash(peer_params()):
+                logger.warning("Peer group parameters changed; recomputing every group")
+                return cls()
+            peers = cls()
+            peers.columns = meta['columns']
+            peers.org = meta['org']
+            peers.users = arrays['users']
+            peers.values = arrays['values']
+            for attribute in meta['attributes']:
+                peers.codes[attribute] = arrays[f'codes:{attribute}']
+                peers.medians[attribute] = arrays[f'median:{attribute}']
+                peers.mads[attribute] = arrays[f'mad:{attribute}']
+        return peers
+
+
+def refresh_peer_groups(features, directory=None):
+    """Load the peer groups, refresh them with per-user features and snapshot them.
+
+    Returns the deviation columns aligned to the rows of features, or None
+    when peer groups are disabled or there is no users table.
+    """
+    if not config.PEER_GROUP_PARAMS.get('enabled', True):
+        return None
+    if not storage.table_exists(config.CLEANED_DATA_DIR, 'users_cleaned'):
+        logger.warning("No users table; skipping the peer-group features")
+        return None
+    peers = PeerGroups.load(directory)
+    deviations = peers.refresh(features, load_org(peers.params['attributes']))
+    peers.save(directory)
+    return deviations
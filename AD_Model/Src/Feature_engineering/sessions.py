@@ -0,0 +1,154 @@
+"""
+Logon/logoff sessionization.
+
+The logon events are sorted once by (user, pc, timestamp) and every Logon is
+paired with the event that directly follows it on the same user and PC: a
+Logoff closes the session, while another Logon or the end of the group
+leaves it orphaned (the logoff was never recorded). A Logoff that does not
+follow a Logon is kept as an orphaned session without a start. Everything is
+done with shifted numpy arrays, so the whole logon file is sessionized in one
+vectorized pass instead of one scan per logon.
+
+The session table is stored with the feature tables, together with the
+fingerprint of the cleaned logon table it was built from, and rebuilt only
+when the logon table changes.
+"""
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+from Src import config
+from Src import storage
+from Src import stage_cache
+
+logger = logging.getLogger(__name__)
+
+SESSIONS_TABLE = 'logon_sessions'
+SOURCE_TABLE = 'logon_cleaned'
+
+SESSION_COLUMNS = ['user_id', 'device_id', 'start', 'end', 'duration_min', 'orphaned']
+
+
+def build_sessions(logon_df):
+    """Build the session table of a cleaned logon frame.
+
+    Returns one row per session with the user and PC codes, the start and
+    end timestamps (missing for orphaned ends), the duration in minutes and
+    the orphaned flag, ordered by user, PC and time.
+    """
+    activity = logon_df['logon_type'].astype(object).to_numpy()
+    events = logon_df.loc[(activity == 'Logon') | (activity == 'Logoff'),
+                          ['user_id', 'device_id', 'timestamp', 'logon_type']]
+    if events.empty:
+        return empty_sessions()
+
+    users = events['user_id'].to_numpy()
+    pcs = events['device_id'].to_numpy()
+    times = events['timestamp'].to_numpy(dtype='datetime64[ns]')
+    order = np.lexsort((times, pcs, users))
+    users, pcs, times = users[order], pcs[order], times[order]
+    is_logon = events['logon_type'].astype(object).to_numpy()[order] == 'Logon'
+
+    # Whether the next event belongs to the same (user, pc)
+    same_next = np.zeros(len(order), dtype=bool)
+    same_next[:-1] = (users[1:] == users[:-1]) & (pcs[1:] == pcs[:-1])
+    next_is_logoff = np.zeros(len(order), dtype=bool)
+    next_is_logoff[:-1] = same_next[:-1] & ~is_logon[1:]
+
+    # Logoffs closing a session are consumed by the preceding Logon
+    closed = is_logon & next_is_logoff
+    closing = np.zeros(len(order), dtype=bool)
+    closing[1:] = closed[:-1]
+    stray_logoff = ~is_logon & ~closing
+
+    starts = np.flatnonzero(is_logon)
+    ends = np.where(closed[starts], starts + 1, -1)
+    stray = np.flatnonzero(stray_logoff)
+    nat = np.datetime64('NaT', 'ns')
+
+    sessions = pd.DataFrame({
+        'user_id': np.concatenate([users[starts], users[stray]]),
+        'device_id': np.concatenate([pcs[starts], pcs[stray]]),
+        'start': np.concatenate([times[starts], np.full(len(stray), nat)]),
+        'end': np.concatenate([np.where(ends >= 0, times[np.maximum(ends, 0)], nat), times[stray]]),
+        'orphaned': np.concatenate([ends < 0, np.ones(len(stray), dtype=bool)])
+    })
+    sessions['duration_min'] = ((sessions['end'] - sessions['start']).dt.total_seconds() / 60).astype(np.float32)
+
+    # Ordered by user, pc and the session's first known timestamp
+    anchor = sessions['start'].fillna(sessions['end']).to_numpy()
+    order = np.lexsort((anchor, sessions['device_id'].to_numpy(), sessions['user_id'].to_numpy()))
+    return sessions.iloc[order][SESSION_COLUMNS].reset_index(drop=True)
+
+
+def empty_sessions():
+    """A session table without rows."""
+    return pd.DataFrame({
+        'user_id': pd.Series(dtype=np.int32),
+        'device_id': pd.Series(dtype=np.int32),
+        'start': pd.Series(dtype='datetime64[ns]'),
+        'end': pd.Series(dtype='datetime64[ns]'),
+        'duration_min': pd.Series(dtype=np.float32),
+        'orphaned': pd.Series(dtype=bool)
+    })
+
+
+def source_path(directory=None):
+    """Sidecar file recording the logon table a stored session table was built from."""
+    directory = directory or config.FEATURES_DIR
+    return directory / f'{SESSIONS_TABLE}_source.json'
+
+
+def source_fingerprint(source_dir=None):
+    """Fingerprint of the cleaned logon table (or of a shard of it)."""
+    directory = source_dir or config.CLEANED_DATA_DIR
+    return stage_cache.outputs_hash([
+        storage.parquet_path(directory, SOURCE_TABLE), storage.csv_path(directory, SOURCE_TABLE)
+    ])
+
+
+def write_sessions(sessions, directory=None, source_dir=None):
+    """Store a session table along with the fingerprint of its logon table."""
+    directory = directory or config.FEATURES_DIR
+    output_path = storage.write_table(sessions, directory, SESSIONS_TABLE)
+    with open(source_path(directory), 'w') as f:
+        json.dump({'source': SOURCE_TABLE, 'fingerprint': source_fingerprint(source_dir)}, f)
+    return output_path
+
+
+def load_sessions(logon_df=None, directory=None, rebuild=False, source_dir=None):
+    """Return the session table of the stored logon table.
+
+    The stored table is reused while the logon table is unchanged; otherwise
+    the sessions are rebuilt from logon_df (read from disk when not given)
+    and stored again. source_dir is the directory of the logon table, the
+    cleaned data by default or a user shard of it.
+    """
+    directory = directory or config.FEATURES_DIR
+    if not rebuild and storage.table_exists(directory, SESSIONS_TABLE) and source_path(directory).exists():
+        with open(source_path(directory)) as f:
+            stored = json.load(f)
+        if stored.get('fingerprint') == source_fingerprint(source_dir):
+            logger.info("Logon table unchanged; reusing stored sessions")
+            return storage.read_table(directory, SESSIONS_TABLE, parse_dates=['start', 'end'])
+
+    if logon_df is None:
+        logon_df = storage.read_table(
+            source_dir or config.CLEANED_DATA_DIR, SOURCE_TABLE, columns=['user_id', 'device_id', 'timestamp', 'logon_type'],
+            parse_dates=['timestamp']
+        )
+    sessions = build_sessions(logon_df)
+    logger.info(f"Built {len(sessions):,} sessions ({int(sessions['orphaned'].sum()):,} orphaned)")
+    write_sessions(sessions, directory, source_dir)
+    return sessions
+
+
+def session_statistics(sessions):
+    """Duration statistics of the closed sessions of every user."""
+    closed = sessions[~sessions['orphaned']]
+    stats = closed.groupby('user_id', observed=True)['duration_min'].agg(['mean', 'std', 'max', 'min'])
+    stats = stats.astype(np.float64).reset_index()
+    stats.columns = ['user', 'avg_session_duration', 'std_session_duration',
+                     'max_session_duration', 'min_session_duration']
+    return stats
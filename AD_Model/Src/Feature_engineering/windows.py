@@ -0,0 +1,283 @@
+"""
+One-pass multi-window aggregation.
+
+Time-windowed features are declared as WindowSpecs: (source, column,
+aggregation, window, name). The events of each source are sorted once by
+(user, timestamp). The finest window is aggregated from the events, and
+every coarser window is derived from the buckets of a finer window that
+divides it (counts and sums are added, maxima and minima folded, distinct
+count sketches merged) instead of grouping the events again. The results of
+all windows and sources are then scattered into one wide table keyed by
+(user, window start) in a single sort, without chains of outer merges.
+
+As with pd.Grouper, window starts are counted from midnight of the first day
+of each source (or of a given origin), and only (user, window) pairs that
+hold events get a row.
+"""
+import logging
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from Src.sketches import SparseHyperLogLogArray
+
+logger = logging.getLogger(__name__)
+
+# name: output column (default: <column>_<agg>_<window>)
+WindowSpec = namedtuple('WindowSpec', ['source', 'column', 'agg', 'window', 'name'], defaults=(None,))
+
+# Partial aggregates kept per bucket for each aggregation; exact nunique is
+# not derivable from finer buckets and is counted from the events of each
+# window, while approx_nunique keeps a HyperLogLog sketch per bucket
+PARTIALS = {
+    'count': ('count',),
+    'sum': ('sum',),
+    'mean': ('sum', 'count'),
+    'max': ('max',),
+    'min': ('min',),
+    'nunique': (),
+    'approx_nunique': ()
+}
+
+REDUCERS = {
+    'count': np.add,
+    'sum': np.add,
+    'max': np.maximum,
+    'min': np.minimum
+}
+
+
+def spec_name(spec):
+    """Output column of a spec."""
+    return spec.name or f'{spec.column}_{spec.agg}_{spec.window}'
+
+
+def window_delta(window):
+    """Length of a fixed window such as '1H', '1D' or '7D' in nanoseconds."""
+    # pandas 2.2+ spells hours 'h'; the config still uses the older 'H'
+    delta = pd.Timedelta(str(window).replace('H', 'h'))
+    if delta <= pd.Timedelta(0):
+        raise ValueError(f"Window must be a positive fixed duration: {window}")
+    return delta.value
+
+
+def _group_starts(users, buckets):
+    """Start positions of the runs of equal (user, bucket) in sorted arrays."""
+    change = np.ones(len(users), dtype=bool)
+    change[1:] = (users[1:] != users[:-1]) | (buckets[1:] != buckets[:-1])
+    return np.flatnonzero(change)
+
+
+def _run_numbers(n, starts):
+    """Run number of each of n sorted positions, given the run starts."""
+    group = np.zeros(n, dtype=np.int64)
+    group[starts[1:]] = 1
+    return np.cumsum(group)
+
+
+def _event_partials(values, kinds):
+    """Per-event partial aggregates of one column."""
+    partials = {}
+    present = pd.notna(values)
+    if 'count' in kinds:
+        partials['count'] = present.astype(np.int64)
+    if kinds & {'sum', 'max', 'min'}:
+        numbers = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=np.float64)
+        missing = np.isnan(numbers)
+        if 'sum' in kinds:
+            partials['sum'] = np.where(missing, 0.0, numbers)
+        if 'max' in kinds:
+            partials['max'] = np.where(missing, -np.inf, numbers)
+        if 'min' in kinds:
+            partials['min'] = np.where(missing, np.inf, numbers)
+    return partials
+
+
+class _Level:
+    """Partial aggregates of one window, sorted by (user, bucket).
+
+    Buckets are counted in units of `unit` nanoseconds from the origin; the
+    event level has a unit of one nanosecond. sketches holds one distinct
+    count sketch per column, with one sketch row per bucket.
+    """
+
+    def __init__(self, unit, users, buckets, partials, sketches=None):
+        self.unit = unit
+        self.users = users
+        self.buckets = buckets
+        self.partials = partials
+        self.sketches = sketches or {}
+
+    def coarsen(self, unit):
+        """Aggregate this level into windows of `unit` nanoseconds."""
+        buckets = self.buckets // (unit // self.unit)
+        starts = _group_starts(self.users, buckets)
+        partials = {
+            key: REDUCERS[key[1]].reduceat(values, starts)
+            for key, values in self.partials.items()
+        }
+        sketches = {}
+        if self.sketches:
+            groups = _run_numbers(len(self.users), starts)
+            sketches = {column: sketch.regroup(groups) for column, sketch in self.sketches.items()}
+        return _Level(unit, self.users[starts], buckets[starts], partials, sketches)
+
+
+def _source_blocks(df, specs, key, time_column, origin=None, sketch_precision=12):
+    """Aggregate the specs of one source; returns one block per window.
+
+    Windows are counted from midnight of origin, by default the first
+    timestamp of the source.
+    """
+    df = df[df[time_column].notna() & df[key].notna()]
+    if df.empty:
+        return []
+
+    users = df[key].to_numpy()
+    times = df[time_column].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    order = np.lexsort((times, users))
+    users, times = users[order], times[order]
+    if origin is None:
+        origin = times.min()
+    origin = int(pd.Timestamp(origin).normalize().value)
+
+    # Partial aggregates needed per column
+    kinds = {}
+    for spec in specs:
+        kinds.setdefault(spec.column, set()).update(PARTIALS[spec.agg])
+    partials = {}
+    for column, column_kinds in kinds.items():
+        values = df[column].to_numpy()[order]
+        for kind, array in _event_partials(values, column_kinds).items():
+            partials[(column, kind)] = array
+    sketches = {
+        spec.column: SparseHyperLogLogArray.from_values(
+            np.arange(len(users)), df[spec.column].to_numpy()[order], sketch_precision
+        )
+        for spec in specs if spec.agg == 'approx_nunique'
+    }
+    levels = [_Level(1, users, times - origin, partials, sketches)]
+
+    blocks = []
+    for window in sorted({spec.window for spec in specs}, key=window_delta):
+        unit = window_delta(window)
+        # Coarsest finer window that divides this one, or the events
+        base = next(level for level in reversed(levels) if unit % level.unit == 0)
+        level = base.coarsen(unit)
+        levels.append(level)
+
+        columns = {}
+        for spec in specs:
+            if spec.window != window:
+                continue
+            if spec.agg == 'nunique':
+                columns[spec_name(spec)] = _window_nunique(
+                    users, (times - origin) // unit, df[spec.column].to_numpy()[order]
+                )
+            elif spec.agg == 'approx_nunique':
+                columns[spec_name(spec)] = level.sketches[spec.column].counts(len(level.users))
+            elif spec.agg == 'mean':
+                count = level.partials[(spec.column, 'count')]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    columns[spec_name(spec)] = np.where(
+                        count > 0, level.partials[(spec.column, 'sum')] / np.maximum(count, 1), np.nan
+                    )
+            elif spec.agg in ('max', 'min'):
+                values = level.partials[(spec.column, spec.agg)]
+                columns[spec_name(spec)] = np.where(np.isinf(values), np.nan, values)
+            else:
+                columns[spec_name(spec)] = level.partials[(spec.column, spec.agg)]
+        blocks.append((level.users, origin + level.buckets * unit, columns))
+    return blocks
+
+
+def _window_nunique(users, buckets, values):
+    """Distinct non-missing values per (user, bucket) run of sorted events."""
+    starts = _group_starts(users, buckets)
+    group = _run_numbers(len(users), starts)
+    codes, uniques = pd.factorize(values)
+    present = codes >= 0
+    pairs = np.unique(group[present] * (len(uniques) + 1) + codes[present])
+    return np.bincount(pairs // (len(uniques) + 1), minlength=len(starts)).astype(np.int64)
+
+
+def align_blocks(blocks, key='user', time_column='timestamp'):
+    """Scatter blocks of (users, window starts, columns) into one wide table.
+
+    Rows are the union of all (user, window start) keys, sorted; a column is
+    missing on the rows its block does not hold.
+    """
+    names = [name for _, _, columns in blocks for name in columns]
+    duplicated = sorted({name for name in names if names.count(name) > 1})
+    if duplicated:
+        raise ValueError(f"Duplicate feature columns: {duplicated}")
+    if not blocks:
+        return pd.DataFrame(columns=[key, time_column])
+
+    users = np.concatenate([block_users for block_users, _, _ in blocks])
+    times = np.concatenate([np.asarray(block_times, dtype=np.int64) for _, block_times, _ in blocks])
+    order = np.lexsort((times, users))
+    sorted_users, sorted_times = users[order], times[order]
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = (sorted_users[1:] != sorted_users[:-1]) | (sorted_times[1:] != sorted_times[:-1])
+    rows = np.empty(len(order), dtype=np.int64)
+    rows[order] = np.cumsum(new) - 1
+    n_rows = int(new.sum())
+
+    result = {
+        key: sorted_users[new],
+        time_column: sorted_times[new].astype('datetime64[ns]')
+    }
+    offset = 0
+    for block_users, _, columns in blocks:
+        block_rows = rows[offset:offset + len(block_users)]
+        offset += len(block_users)
+        for name, values in columns.items():
+            values = np.asarray(values)
+            if values.dtype.kind in 'biuf':
+                column = np.full(n_rows, np.nan)
+            else:
+                column = np.full(n_rows, None, dtype=object)
+            column[block_rows] = values
+            result[name] = column
+    return pd.DataFrame(result)
+
+
+def align_frames(frames, key='user', time_column='timestamp'):
+    """Outer-align feature frames on (key, time_column) without merge chains."""
+    blocks = []
+    for df in frames:
+        columns = {col: df[col].to_numpy() for col in df.columns if col not in (key, time_column)}
+        times = df[time_column].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+        blocks.append((df[key].to_numpy(), times, columns))
+    return align_blocks(blocks, key, time_column)
+
+
+def aggregate_windows(frames, specs, keys=None, time_column='timestamp', key='user', origins=None,
+                      sketch_precision=12):
+    """Compute window specs over their sources as one wide table.
+
+    frames maps each source to its cleaned DataFrame and keys maps it to its
+    user column (default 'user_id'). origins optionally maps a source to the
+    timestamp its windows are counted from, so that a subset of the events
+    (such as a user shard) gets the same windows as the whole source.
+    approx_nunique specs use HyperLogLog sketches with 2**sketch_precision
+    registers. Returns a DataFrame with the key and window start columns
+    followed by one column per spec, in spec order.
+    """
+    keys = keys or {}
+    origins = origins or {}
+    blocks = []
+    for source in dict.fromkeys(spec.source for spec in specs):
+        if source not in frames:
+            logger.warning(f"No data for window features of {source}")
+            continue
+        source_specs = [spec for spec in specs if spec.source == source]
+        blocks.extend(_source_blocks(
+            frames[source], source_specs, keys.get(source, 'user_id'), time_column, origins.get(source),
+            sketch_precision
+        ))
+
+    table = align_blocks(blocks, key, time_column)
+    ordered = [spec_name(spec) for spec in specs if spec_name(spec) in table.columns]
+    return table[[key, time_column] + ordered]
@@ -0,0 +1,93 @@
+"""
+Calendar columns of the cleaned event tables.
+
+The cleaning stage decomposes every event timestamp once into int8 columns:
+
+- hour: hour of day, 0-23
+- day_of_week: Monday = 0 ... Sunday = 6
+- is_weekend: 1 on the weekend days of the business calendar
+- is_after_hours: 1 outside the business hours of the business calendar
+
+Missing timestamps get hour and day_of_week -1 and both flags 0. The feature
+extractors and the model read these columns instead of decomposing the
+timestamps again, and all of them share the one business calendar declared in
+config.CALENDAR_PARAMS.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+from Src import config
+
+logger = logging.getLogger(__name__)
+
+CALENDAR_COLUMNS = ['hour', 'day_of_week', 'is_weekend', 'is_after_hours']
+
+NS_PER_HOUR = 3600 * 10**9
+
+# 1970-01-01 was a Thursday
+EPOCH_DAY_OF_WEEK = 3
+
+
+def business_hours():
+    """First and last business hour of the calendar, inclusive."""
+    start, end = config.CALENDAR_PARAMS.get('business_hours', (8, 18))
+    return int(start), int(end)
+
+
+def after_hours_table():
+    """After-hours flag of every hour 0-23, followed by 0 for missing hours (-1)."""
+    start, end = business_hours()
+    hours = np.arange(24)
+    return np.append((hours < start) | (hours > end), False).astype(np.int8)
+
+
+def weekend_table():
+    """Weekend flag of every day of the week, followed by 0 for missing days (-1)."""
+    weekend = np.zeros(8, dtype=np.int8)
+    weekend[list(config.CALENDAR_PARAMS.get('weekend_days', (5, 6)))] = 1
+    return weekend
+
+
+def calendar_columns(timestamps):
+    """The calendar columns of a datetime series, as a dict of int8 arrays."""
+    if not pd.api.types.is_datetime64_any_dtype(timestamps):
+        timestamps = pd.to_datetime(timestamps, errors='coerce')
+    if getattr(timestamps.dt, 'tz', None) is not None:
+        timestamps = timestamps.dt.tz_localize(None)
+    values = timestamps.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    missing = np.isnat(values.view('datetime64[ns]'))
+
+    # Whole hours since the epoch; floor division keeps pre-1970 times right
+    hours = np.floor_divide(values, NS_PER_HOUR)
+    hour = np.where(missing, -1, hours % 24).astype(np.int8)
+    day_of_week = np.where(missing, -1, (hours // 24 + EPOCH_DAY_OF_WEEK) % 7).astype(np.int8)
+    return {
+        'hour': hour,
+        'day_of_week': day_of_week,
+        'is_weekend': weekend_table()[day_of_week],
+        'is_after_hours': after_hours_table()[hour]
+    }
+
+
+def add_calendar_columns(df, column='timestamp'):
+    """Add the calendar columns of a frame's timestamp column in place; returns df."""
+    if column not in df.columns:
+        return df
+    for name, values in calendar_columns(df[column]).items():
+        df[name] = values
+    return df
+
+
+def ensure_calendar_columns(df, column='timestamp'):
+    """Add the calendar columns only when the frame lacks them (tables cleaned before they existed)."""
+    if all(name in df.columns for name in CALENDAR_COLUMNS):
+        return df
+    return add_calendar_columns(df, column)
+
+
+def known_hours(df):
+    """Event hours as floats with missing hours (-1) as NaN, for averaging."""
+    hours = df['hour'].to_numpy(dtype=np.float64)
+    hours[hours < 0] = np.nan
+    return hours
@@ -1,282 +1,242 @@
 import os
+import time
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 from pathlib import Path
 from Src import config
+from Src import storage
+from Src.Preprocessing.schema import apply_schema, memory_per_row
+from Src.Preprocessing.interning import EntityInterner, ENTITY_COLUMNS
+from Src.Preprocessing import parallel_reader
+from Src.Preprocessing.email_edges import build_email_edges
+from Src.Preprocessing.business_calendar import add_calendar_columns
+from Src.Preprocessing.sharding import update_user_shards
+from Src.Preprocessing.ingestion import clear_watermarks
 import logging
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Define column mappings for each file type
-COLUMN_MAPPINGS = {
-    'users': {
-        'id': 'user_id',
-        'email': 'email',
-        'role': 'role',
-        'projects': 'projects',
-        'business_unit': 'business_unit',
-        'functional_unit': 'functional_unit',
-        'department': 'department',
-        'team': 'team',
-        'supervisor': 'supervisor_id',
-        'start_date': 'start_date',
-        'end_date': 'end_date'
-    },
-    'logon': {
-        'id': 'logon_id',
-        'date': 'timestamp',
-        'user': 'user_id',
-        'pc': 'device_id',
-        'activity': 'logon_type'
-    },
-    'device': {
-        'id': 'device_event_id',
-        'date': 'timestamp',
-        'user': 'user_id',
-        'pc': 'device_id',
-        'file_tree': 'file_path',
-        'activity': 'activity_type'
-    },
-    'email': {
-        'id': 'email_id',
-        'date': 'timestamp',
-        'user': 'sender_id',
-        'to': 'recipient_id',
-        'cc': 'cc_recipients',
-        'bcc': 'bcc_recipients',
-        'subject': 'subject',
-        'body': 'body',
-        'attachments': 'has_attachments',
-        'size': 'email_size',
-        'sensitivity': 'sensitivity',
-        'importance': 'importance'
-    },
-    'file': {
-        'id': 'file_event_id',
-        'date': 'timestamp',
-        'user': 'user_id',
-        'pc': 'device_id',
-        'filename': 'filename',
-        'file_path': 'file_path',
-        'activity': 'activity_type',
-        'size': 'file_size',
-        'sensitivity': 'sensitivity'
-    },
-    'decoy_file': {
-        'decoy_filename': 'decoy_filename',
-        'pc': 'device_id'
-    }
+# Raw file keys whose cleaned output uses a different name
+CLEANED_NAMES = {
+    'decoy': 'decoy_file'
 }
 
+
+def clean_users_frame(df, parsers=None):
+    """Apply the users cleaning rules to a raw users frame."""
+    # Rename, type and fill columns from the schema registry
+    return apply_schema(df, 'users', parsers)
+
+
+def clean_logon_frame(df, parsers=None):
+    """Apply the logon cleaning rules to a raw logon frame."""
+    df = apply_schema(df, 'logon', parsers)
+    
+    # Hour, weekday, weekend and after-hours flags, decomposed once here
+    return add_calendar_columns(df)
+
+
+def clean_device_frame(df, parsers=None):
+    """Apply the device cleaning rules to a raw device frame."""
+    df = apply_schema(df, 'device', parsers)
+    return add_calendar_columns(df)
+
+
+def clean_email_frame(df, parsers=None):
+    """Apply the email cleaning rules to a raw email frame."""
+    df = apply_schema(df, 'email', parsers)
+    
+    # Email size in MB
+    df['email_size_mb'] = (df['email_size'] / (1024 * 1024)).astype(np.float32)
+    
+    return add_calendar_columns(df)
+
+
+def clean_file_frame(df, parsers=None):
+    """Apply the file access cleaning rules to a raw file frame."""
+    df = apply_schema(df, 'file', parsers)
+    
+    # Extract file extension
+    if 'filename' in df.columns:
+        df['file_extension'] = df['filename'].str.extract(r'\.(\w+)$', expand=False).astype('category')
+    
+    # File size in MB
+    df['file_size_mb'] = (df['file_size'] / (1024 * 1024)).astype(np.float32)
+    
+    return add_calendar_columns(df)
+
+
+def clean_decoy_frame(df, parsers=None):
+    """Apply the decoy file cleaning rules to a raw decoy frame."""
+    df = apply_schema(df, 'decoy_file', parsers)
+    
+    # Mark all accesses as suspicious
+    df['is_suspicious'] = True
+    
+    return df
+
+
+def read_raw_file(path, n_workers=None):
+    """Read a whole raw CSV file into memory, in parallel shards if it is large."""
+    # Read CSV with optimized settings for faster loading
+    return parallel_reader.read_csv(
+        path, 
+        n_workers=n_workers,
+        low_memory=False,
+        engine='c',  # Use faster C engine
+        na_filter=True,  # Enable NA filtering
+        dtype_backend='numpy_nullable'  # Use nullable dtypes
+    )
+
+
+def clean_source(name, path, streaming=False, read_workers=1):
+    """Clean and save one raw source, returning (rows, seconds).
+    
+    This is the entry point of the worker processes in parallel mode, so it
+    builds its own DataCleaner and shares nothing with the caller. Entity
+    columns are left as strings; the parent interns them once every worker
+    has finished so that all tables share one dictionary.
+    """
+    start = time.time()
+    cleaner = DataCleaner(intern=False, read_workers=read_workers)
+    if streaming:
+        rows = cleaner.clean_streaming(name, path)
+    else:
+        key = CLEANED_NAMES.get(name, name)
+        cleaner.raw_data[key] = read_raw_file(path, read_workers)
+        cleaner._clean_dataset(key)
+        cleaner.save_cleaned_data()
+        rows = len(cleaner.cleaned_data[key])
+    return rows, time.time() - start
+
+
+def intern_table(name):
+    """Encode the entity columns of a saved cleaned table with the saved dictionaries."""
+    interner = EntityInterner.load()
+    table = f'{name}_cleaned'
+    with storage.TableWriter(config.CLEANED_DATA_DIR, f'{table}_interning') as writer:
+        for df in storage.iter_table(config.CLEANED_DATA_DIR, table):
+            writer.write(interner.encode_frame(df, name, grow=False))
+    storage.replace_table(config.CLEANED_DATA_DIR, f'{table}_interning', table)
+    return writer.rows
+
+
+# Frame-level cleaning function for each cleaned dataset. Each takes the raw
+# frame and an optional dict of TimestampParsers keyed by column, so that
+# chunks of one file share format detection and NaT counts.
+FRAME_CLEANERS = {
+    'users': clean_users_frame,
+    'logon': clean_logon_frame,
+    'device': clean_device_frame,
+    'email': clean_email_frame,
+    'file': clean_file_frame,
+    'decoy_file': clean_decoy_frame
+}
+
+# Tables derived from a cleaned dataset at clean time, as {dataset: {table:
+# builder}}. A builder takes the cleaned frame and returns the derived frame.
+DERIVED_TABLES = {
+    'email': {'email_edges': build_email_edges}
+}
+
+
+def with_derived(names):
+    """Cleaned dataset names followed by the tables derived from them."""
+    names = list(names)
+    return names + [table for name in names for table in DERIVED_TABLES.get(name, {})]
+
+
 class DataCleaner:
-    def __init__(self):
+    def __init__(self, intern=True, read_workers=None):
         self.raw_data = {}
         self.cleaned_data = {}
+        # Parser processes per raw file (None = CLEANING_PARAMS / CPU count)
+        self.read_workers = read_workers
+        # Entity columns are replaced by int32 codes from this dictionary
+        self.interner = EntityInterner() if intern else None
     
     def load_data(self):
         """Load all raw data files."""
         logger.info("Loading raw data...")
         for name, path in config.RAW_FILES.items():
             if path.exists():
+                key = CLEANED_NAMES.get(name, name)
                 try:
-                    # Read CSV with optimized settings for faster loading
-                    self.raw_data[name] = pd.read_csv(
-                        path, 
-                        low_memory=False,
-                        engine='c',  # Use faster C engine
-                        na_filter=True,  # Enable NA filtering
-                        dtype_backend='numpy_nullable'  # Use nullable dtypes
-                    )
-                    logger.info(f"Loaded {name} with shape {self.raw_data[name].shape}")
+                    self.raw_data[key] = read_raw_file(path, self.read_workers)
+                    logger.info(f"Loaded {name} with shape {self.raw_data[key].shape}")
                 except Exception as e:
                     logger.error(f"Error loading {name}: {str(e)}")
                     raise
             else:
                 logger.warning(f"File not found: {path}")
     
-    def clean_users_data(self):
-        """Clean and preprocess users data."""
-        if 'users' not in self.raw_data:
-            logger.warning("No users data to clean")
+    def _clean_dataset(self, name, label=None):
+        """Clean one loaded raw dataset with its frame cleaner."""
+        label = label or name
+        if name not in self.raw_data:
+            logger.warning(f"No {label} data to clean")
             return
             
-        df = self.raw_data['users'].copy()
-        logger.info("Cleaning users data...")
+        logger.info(f"Cleaning {label} data...")
         
         try:
-            # Rename columns to standard format
-            df.rename(columns=COLUMN_MAPPINGS['users'], inplace=True)
-            
-            # Convert date columns
-            df['start_date'] = pd.to_datetime(df['start_date'], errors='coerce')
-            df['end_date'] = pd.to_datetime(df['end_date'], errors='coerce')
-            
-            # Handle missing values
-            df['end_date'].fillna(pd.Timestamp('2100-01-01'), inplace=True)
-            df['role'] = df['role'].fillna('Employee')
-            
-            # Add any additional processing needed for users data
-            
-            self.cleaned_data['users'] = df
-            logger.info(f"Cleaned users data: {df.shape}")
+            parsers = {}
+            raw_bytes = memory_per_row(self.raw_data[name])
+            df = FRAME_CLEANERS[name](self.raw_data[name], parsers)
+            for parser in parsers.values():
+                parser.report(name)
+            self.cleaned_data.update(self.build_derived(name, df))
+            if self.interner is not None:
+                self.interner.encode_frame(df, name)
+            self.cleaned_data[name] = df
+            logger.info(f"Cleaned {label} data: {df.shape} "
+                        f"({raw_bytes:,.0f} -> {memory_per_row(df):,.0f} bytes/row)")
             
         except Exception as e:
-            logger.error(f"Error cleaning users data: {str(e)}")
+            logger.error(f"Error cleaning {label} data: {str(e)}")
             raise
     
+    def build_derived(self, name, df):
+        """Build and intern the tables derived from a cleaned frame."""
+        derived = {}
+        for table, builder in DERIVED_TABLES.get(name, {}).items():
+            derived[table] = builder(df)
+            if self.interner is not None:
+                self.interner.encode_frame(derived[table], table)
+            logger.debug(f"Built {table} from {name}: {derived[table].shape}")
+        return derived
+    
+    def clean_users_data(self):
+        """Clean and preprocess users data."""
+        self._clean_dataset('users', 'users')
+    
     def clean_logon_data(self):
         """Clean logon data."""
-        if 'logon' not in self.raw_data:
-            logger.warning("No logon data to clean")
-            return
-            
-        df = self.raw_data['logon'].copy()
-        logger.info("Cleaning logon data...")
-        
-        try:
-            # Rename columns to standard format
-            df.rename(columns=COLUMN_MAPPINGS['logon'], inplace=True)
-            
-            # Convert timestamp
-            df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-            
-            # Handle missing values
-            df['logon_type'] = df['logon_type'].fillna('Unknown')
-            
-            # Add any additional processing needed for logon data
-            
-            self.cleaned_data['logon'] = df
-            logger.info(f"Cleaned logon data: {df.shape}")
-            
-        except Exception as e:
-            logger.error(f"Error cleaning logon data: {str(e)}")
-            raise
+        self._clean_dataset('logon', 'logon')
     
     def clean_device_data(self):
         """Clean device access data."""
-        if 'device' not in self.raw_data:
-            logger.warning("No device data to clean")
-            return
-            
-        df = self.raw_data['device'].copy()
-        logger.info("Cleaning device data...")
-        
-        try:
-            # Rename columns to standard format
-            df.rename(columns=COLUMN_MAPPINGS['device'], inplace=True)
-            
-            # Convert timestamp
-            df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-            
-            # Handle missing values
-            df['activity_type'] = df['activity_type'].fillna('Unknown')
-            df['file_path'] = df['file_path'].fillna('Unknown')
-            
-            # Add any additional processing needed for device data
-            
-            self.cleaned_data['device'] = df
-            logger.info(f"Cleaned device data: {df.shape}")
-            
-        except Exception as e:
-            logger.error(f"Error cleaning device data: {str(e)}")
-            raise
+        self._clean_dataset('device', 'device')
     
     def clean_email_data(self):
         """Clean email data."""
-        if 'email' not in self.raw_data:
-            logger.warning("No email data to clean")
-            return
-            
-        df = self.raw_data['email'].copy()
-        logger.info("Cleaning email data...")
-        
-        try:
-            # Rename columns to standard format
-            df.rename(columns=COLUMN_MAPPINGS['email'], inplace=True)
-            
-            # Convert timestamp
-            df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-            
-            # Handle missing values
-            df['cc_recipients'] = df['cc_recipients'].fillna('')
-            df['bcc_recipients'] = df['bcc_recipients'].fillna('')
-            df['has_attachments'] = df['has_attachments'].fillna(False)
-            df['sensitivity'] = df['sensitivity'].fillna('Normal')
-            df['importance'] = df['importance'].fillna('Normal')
-            
-            # Convert email size to MB if the column exists
-            if 'email_size' in df.columns:
-                df['email_size_mb'] = pd.to_numeric(df['email_size'], errors='coerce') / (1024 * 1024)
-            
-            self.cleaned_data['email'] = df
-            logger.info(f"Cleaned email data: {df.shape}")
-            
-        except Exception as e:
-            logger.error(f"Error cleaning email data: {str(e)}")
-            raise
+        self._clean_dataset('email', 'email')
     
     def clean_file_data(self):
         """Clean file access data."""
-        if 'file' not in self.raw_data:
-            logger.warning("No file access data to clean")
-            return
-            
-        df = self.raw_data['file'].copy()
-        logger.info("Cleaning file access data...")
-        
-        try:
-            # Rename columns to standard format
-            df.rename(columns=COLUMN_MAPPINGS['file'], inplace=True)
-            
-            # Convert timestamp
-            df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-            
-            # Handle missing values
-            df['activity_type'] = df['activity_type'].fillna('Unknown')
-            df['sensitivity'] = df['sensitivity'].fillna('Normal')
-            
-            # Extract file extension
-            df['file_extension'] = df['filename'].str.extract(r'\.(\w+)$', expand=False)
-            
-            # Convert file size to MB if the column exists
-            if 'file_size' in df.columns:
-                df['file_size_mb'] = pd.to_numeric(df['file_size'], errors='coerce') / (1024 * 1024)
-            
-            self.cleaned_data['file'] = df
-            logger.info(f"Cleaned file access data: {df.shape}")
-            
-        except Exception as e:
-            logger.error(f"Error cleaning file data: {str(e)}")
-            raise
+        self._clean_dataset('file', 'file access')
     
     def clean_decoy_data(self):
         """Clean decoy file access data."""
-        if 'decoy_file' not in self.raw_data:
-            logger.warning("No decoy file data to clean")
-            return
-            
-        df = self.raw_data['decoy_file'].copy()
-        logger.info("Cleaning decoy file data...")
-        
-        try:
-            # Rename columns to standard format
-            df.rename(columns=COLUMN_MAPPINGS['decoy_file'], inplace=True)
-            
-            # Mark all accesses as suspicious
-            df['is_suspicious'] = True
-            
-            self.cleaned_data['decoy_file'] = df
-            logger.info(f"Cleaned decoy file data: {df.shape}")
-            
-        except Exception as e:
-            logger.error(f"Error cleaning decoy file data: {str(e)}")
-            raise
+        self._clean_dataset('decoy_file', 'decoy file')
     
     def save_cleaned_data(self):
-        """Save all cleaned data to CSV files."""
+        """Save all cleaned data to the cleaned table store."""
         if not self.cleaned_data:
             logger.warning("No cleaned data to save")
             return
@@ -289,12 +249,13 @@ class DataCleaner:
             
             for name, df in self.cleaned_data.items():
                 if df is not None and not df.empty:
-                    output_path = os.path.join(config.CLEANED_DATA_DIR, f'{name}_cleaned.csv')
-                    # Use faster CSV writing with optimized settings
-                    df.to_csv(output_path, index=False, chunksize=100000)
+                    output_path = storage.write_table(df, config.CLEANED_DATA_DIR, f'{name}_cleaned')
                     logger.info(f"Saved {name} data to {output_path} (shape: {df.shape})")
                 else:
                     logger.warning(f"No data to save for {name}")
+            
+            if self.interner is not None:
+                self.interner.save()
                     
             logger.info("Finished saving all cleaned data")
             
@@ -302,32 +263,218 @@ class DataCleaner:
             logger.error(f"Error saving cleaned data: {str(e)}")
             raise
     
-    def run(self):
-        """Run the data cleaning pipeline."""
+    def get_chunk_rows(self, path, chunk_rows=None, memory_budget_mb=None):
+        """Work out how many rows to read per chunk when streaming a raw file.
+        
+        A memory budget takes precedence over a fixed row count. The budget is
+        converted to rows from the in-memory size of a small probe read, with
+        headroom for the raw and cleaned copy of a chunk being alive together.
+        """
+        if memory_budget_mb is None:
+            memory_budget_mb = config.CLEANING_PARAMS.get('memory_budget_mb')
+        if chunk_rows is None:
+            chunk_rows = config.CLEANING_PARAMS.get('chunk_rows', 250000)
+        
+        if memory_budget_mb:
+            probe = pd.read_csv(path, nrows=1000, low_memory=False)
+            if len(probe) > 0:
+                bytes_per_row = probe.memory_usage(index=True, deep=True).sum() / len(probe)
+                # Raw chunk and cleaned chunk are held at the same time
+                chunk_rows = int(memory_budget_mb * 1024 * 1024 // (2 * bytes_per_row))
+        
+        return max(1, int(chunk_rows))
+    
+    def clean_streaming(self, name, path, chunk_rows=None, memory_budget_mb=None):
+        """Clean one raw file chunk by chunk, appending to its cleaned table.
+        
+        Only one chunk is held in memory at a time, so peak memory is bounded
+        by the chunk size rather than the file size. Returns the number of
+        rows written.
+        """
+        cleaned_name = CLEANED_NAMES.get(name, name)
+        cleaner = FRAME_CLEANERS[cleaned_name]
+        rows = self.get_chunk_rows(path, chunk_rows, memory_budget_mb)
+        
+        logger.info(f"Streaming {name} in chunks of {rows:,} rows...")
+        
+        # Nullable dtypes are not used here: a chunk where a column is entirely
+        # empty would be inferred as Int64 and reject the string fill values
+        reader = parallel_reader.iter_csv(path, rows, self.read_workers, low_memory=False, engine='c')
+        parsers = {}
+        with ExitStack() as stack:
+            writer = stack.enter_context(
+                storage.TableWriter(config.CLEANED_DATA_DIR, f'{cleaned_name}_cleaned'))
+            derived_writers = {
+                table: stack.enter_context(storage.TableWriter(config.CLEANED_DATA_DIR, f'{table}_cleaned'))
+                for table in DERIVED_TABLES.get(cleaned_name, {})
+            }
+            for i, chunk in enumerate(reader):
+                df = cleaner(chunk, parsers)
+                for table, derived in self.build_derived(cleaned_name, df).items():
+                    derived_writers[table].write(derived)
+                if self.interner is not None:
+                    self.interner.encode_frame(df, cleaned_name)
+                writer.write(df)
+                logger.info(f"  {name}: chunk {i + 1} cleaned ({writer.rows:,} rows so far)")
+        for parser in parsers.values():
+            parser.report(cleaned_name)
+        
+        logger.info(f"Saved {cleaned_name} data to {config.CLEANED_DATA_DIR} ({writer.rows:,} rows)")
+        return writer.rows
+    
+    def run_streaming(self, chunk_rows=None, memory_budget_mb=None):
+        """Run the data cleaning pipeline in bounded-memory streaming mode."""
+        os.makedirs(config.CLEANED_DATA_DIR, exist_ok=True)
+        
+        row_counts = {}
+        for name, path in config.RAW_FILES.items():
+            if not path.exists():
+                logger.warning(f"File not found: {path}")
+                continue
+            try:
+                row_counts[name] = self.clean_streaming(name, path, chunk_rows, memory_budget_mb)
+            except Exception as e:
+                logger.error(f"Error streaming {name}: {str(e)}")
+                raise
+        
+        if self.interner is not None:
+            self.interner.save()
+        return row_counts
+    
+    def run_parallel(self, n_workers=None, streaming=False):
+        """Clean and save each dataset in its own worker process.
+        
+        Datasets are independent, so the stage takes about as long as the
+        largest one. Largest files are submitted first. A failure in one
+        dataset does not stop the others; every dataset gets a status entry
+        and a RuntimeError listing the failures is raised at the end.
+        """
+        sources = {}
+        for name, path in config.RAW_FILES.items():
+            if path.exists():
+                sources[name] = path
+            else:
+                logger.warning(f"File not found: {path}")
+        if not sources:
+            return {}
+        
+        n_workers = n_workers or config.CLEANING_PARAMS.get('n_workers') or \
+            min(len(sources), os.cpu_count() or 1)
+        logger.info(f"Cleaning {len(sources)} datasets with {n_workers} worker processes...")
+        
+        os.makedirs(config.CLEANED_DATA_DIR, exist_ok=True)
+        results = {}
+        by_size = sorted(sources, key=lambda name: sources[name].stat().st_size, reverse=True)
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # Spare cores go to the parsers inside each worker
+            read_workers = max(1, (os.cpu_count() or 1) // n_workers)
+            futures = {
+                executor.submit(clean_source, name, sources[name], streaming, read_workers): name
+                for name in by_size
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    rows, seconds = future.result()
+                    results[name] = {'status': 'ok', 'rows': rows, 'seconds': seconds}
+                    logger.info(f"✓ {name}: {rows:,} rows in {seconds:.1f}s")
+                except Exception as e:
+                    results[name] = {'status': 'failed', 'error': str(e)}
+                    logger.error(f"✗ {name}: {str(e)}")
+        
+        failed = [name for name, result in results.items() if result['status'] != 'ok']
+        if failed:
+            raise RuntimeError(f"Cleaning failed for: {', '.join(sorted(failed))}")
+        
+        if self.interner is not None:
+            self.intern_cleaned_tables(with_derived(CLEANED_NAMES.get(name, name) for name in results), n_workers)
+        return results
+    
+    def intern_cleaned_tables(self, names, n_workers=None):
+        """Intern the entity columns of cleaned tables written without interning.
+        
+        The dictionaries are built in the parent from the entity columns only,
+        in a fixed dataset order so codes are reproducible, then each table is
+        re-encoded in its own worker process.
+        """
+        ordered = [name for name in ENTITY_COLUMNS if name in names]
+        for name in ordered:
+            columns = list(ENTITY_COLUMNS.get(name, {}))
+            if not columns:
+                continue
+            for df in storage.iter_table(config.CLEANED_DATA_DIR, f'{name}_cleaned', columns=columns):
+                self.interner.encode_frame(df, name)
+        self.interner.save()
+        
+        to_encode = [name for name in ordered if ENTITY_COLUMNS.get(name)]
+        with ProcessPoolExecutor(max_workers=n_workers or min(len(to_encode), os.cpu_count() or 1)) as executor:
+            for name, rows in zip(to_encode, executor.map(intern_table, to_encode)):
+                logger.info(f"Interned entity columns of {name} ({rows:,} rows)")
+    
+    def run_incremental(self):
+        """Clean only rows appended to the raw files since the last run.
+        
+        Entity codes must stay stable across runs, so the saved dictionaries
+        are loaded and extended rather than rebuilt.
+        """
+        from Src.Preprocessing.ingestion import IncrementalIngestor
+        
+        self.interner = EntityInterner.load_or_new()
+        return IncrementalIngestor(self).run()
+    
+    def run(self, streaming=False, parallel=False, n_workers=None, incremental=False):
+        """Run the data cleaning pipeline.
+        
+        With streaming=True each raw file is cleaned in chunks and written
+        straight to disk. With parallel=True each dataset is cleaned in its
+        own process. With incremental=True only rows appended since the last
+        run are cleaned, falling back to a rebuild for rewritten files. These
+        modes return per-dataset results instead of the cleaned frames.
+        """
         try:
             logger.info("Starting data cleaning pipeline...")
             
-            # Load raw data
-            self.load_data()
+            # A rebuild replaces the tables the incremental watermarks describe
+            if not incremental:
+                clear_watermarks()
             
-            # Clean each dataset
-            self.clean_users_data()
-            self.clean_logon_data()
-            self.clean_device_data()
-            self.clean_email_data()
-            self.clean_file_data()
-            self.clean_decoy_data()
-            
-            # Save cleaned data
-            self.save_cleaned_data()
+            if incremental:
+                results = self.run_incremental()
+            elif parallel:
+                results = self.run_parallel(n_workers, streaming=streaming)
+            elif streaming:
+                results = self.run_streaming()
+            else:
+                # Load raw data
+                self.load_data()
+                
+                # Clean each dataset
+                self.clean_users_data()
+                self.clean_logon_data()
+                self.clean_device_data()
+                self.clean_email_data()
+                self.clean_file_data()
+                self.clean_decoy_data()
+                
+                # Save cleaned data
+                self.save_cleaned_data()
+                results = self.cleaned_data
+            
+            # Partition the event tables by user for sharded feature extraction
+            update_user_shards()
             
             logger.info("Data cleaning completed successfully!")
-            return self.cleaned_data
+            return results
             
         except Exception as e:
             logger.error(f"Error during data cleaning: {str(e)}", exc_info=True)
             raise
 
 if __name__ == "__main__":
+    import sys
     cleaner = DataCleaner()
-    cleaned_data = cleaner.run()
+    cleaned_data = cleaner.run(
+        streaming='--streaming' in sys.argv,
+        parallel='--parallel' in sys.argv,
+        incremental='--incremental' in sys.argv
+    )
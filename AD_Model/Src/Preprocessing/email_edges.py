@@ -0,0 +1,120 @@
+"""
+Sender -> recipient edge table for the email source.
+
+Recipients arrive as separator-joined address strings in the to, cc and bcc
+columns. At clean time they are exploded once into one row per
+(email, recipient) with the sender's user code, the recipient's address code
+from the shared 'address' dictionary, an edge-type code and an external
+flag. Recipient counts, unique recipients and external-domain ratios are then
+plain groupbys over integer columns instead of per-row string splitting.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+from Src import config
+from Src.sketches import HyperLogLogArray
+
+logger = logging.getLogger(__name__)
+
+# Edge-type code of each recipient column of the cleaned email table
+EDGE_TYPES = {
+    'recipient_id': 0,  # to
+    'cc_recipients': 1,
+    'bcc_recipients': 2
+}
+
+EDGE_TYPE_NAMES = {0: 'to', 1: 'cc', 2: 'bcc'}
+
+# CERT joins addresses with ';'; ',' is accepted as well
+RECIPIENT_SEPARATORS = r'[;,]'
+
+
+def internal_domains():
+    """Lower-cased email domains treated as internal."""
+    return {domain.lower() for domain in config.EMAIL_PARAMS.get('internal_domains', [])}
+
+
+def is_external(addresses):
+    """Flag addresses whose domain is not internal; evaluated once per distinct address."""
+    codes, uniques = pd.factorize(pd.Series(addresses, dtype=object))
+    domains = pd.Series(uniques, dtype=object).str.rsplit('@', n=1).str[-1].str.lower()
+    flags = np.append(~domains.isin(internal_domains()).to_numpy(), False)
+    return flags[codes]
+
+
+def explode_recipients(email_df):
+    """One row per (email row, recipient address) with its edge type.
+
+    Returns a frame with the positional email row, the recipient address
+    string and the int8 edge type, ordered by email row.
+    """
+    pieces = []
+    for column, edge_type in EDGE_TYPES.items():
+        if column not in email_df.columns:
+            continue
+        split = email_df[column].astype(object).str.split(RECIPIENT_SEPARATORS, regex=True)
+        split.index = np.arange(len(email_df))
+        exploded = split.explode().str.strip()
+        exploded = exploded[exploded.notna() & (exploded != '')]
+        pieces.append(pd.DataFrame({
+            'row': exploded.index.to_numpy(dtype=np.int64),
+            'recipient_address': exploded.to_numpy(dtype=object),
+            'edge_type': np.int8(edge_type)
+        }))
+
+    if not pieces:
+        return pd.DataFrame({
+            'row': pd.Series(dtype=np.int64),
+            'recipient_address': pd.Series(dtype=object),
+            'edge_type': pd.Series(dtype=np.int8)
+        })
+    edges = pd.concat(pieces, ignore_index=True)
+    return edges.sort_values(['row', 'edge_type'], kind='stable').reset_index(drop=True)
+
+
+def build_email_edges(email_df):
+    """Build the edge table of a cleaned email frame.
+
+    Also records the number of recipients of every email as the int16
+    recipient_count column of email_df. Must run before the email frame is
+    interned, while the recipient columns still hold the address strings.
+    """
+    edges = explode_recipients(email_df)
+    rows = edges['row'].to_numpy()
+    email_df['recipient_count'] = np.bincount(rows, minlength=len(email_df)).astype(np.int16)
+
+    return pd.DataFrame({
+        'timestamp': email_df['timestamp'].to_numpy()[rows],
+        'sender_id': email_df['sender_id'].to_numpy()[rows],
+        'recipient_address': edges['recipient_address'].to_numpy(dtype=object),
+        'edge_type': edges['edge_type'].to_numpy(dtype=np.int8),
+        'is_external': is_external(edges['recipient_address'])
+    })
+
+
+def recipient_summary(edges, keys, sketch_precision=None):
+    """Edge count, unique recipients and external ratio per group of keys.
+
+    keys are columns of the edge table or pd.Grouper objects. With
+    sketch_precision set, unique recipients are HyperLogLog estimates
+    instead of exact counts.
+    """
+    grouped = edges.groupby(keys, observed=True)
+    if sketch_precision is None:
+        return grouped.agg(
+            recipient_edges=('recipient_address', 'size'),
+            unique_recipients=('recipient_address', 'nunique'),
+            external_recipient_ratio=('is_external', 'mean')
+        ).reset_index()
+
+    summary = grouped.agg(
+        recipient_edges=('recipient_address', 'size'),
+        external_recipient_ratio=('is_external', 'mean')
+    ).reset_index()
+    groups = grouped.ngroup().to_numpy()
+    grouped_rows = groups >= 0
+    sketch = HyperLogLogArray(sketch_precision, len(summary))
+    sketch.update(groups[grouped_rows], edges['recipient_address'].to_numpy()[grouped_rows])
+    summary.insert(summary.columns.get_loc('recipient_edges') + 1, 'unique_recipients', sketch.counts())
+    return summary
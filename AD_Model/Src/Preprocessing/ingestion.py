@@ -0,0 +1,264 @@
+"""
+Incremental, append-only ingestion of the raw CERT logs.
+
+The raw files only ever grow at the end. For every source a watermark records
+how far it has been cleaned: the byte offset of the end of the last consumed
+line, the last timestamp seen, and fingerprints of the start of the file and
+of the bytes just before the offset. A later run cleans only the bytes past
+the offset and appends them to the cleaned table as a new part. If the file
+shrank or the fingerprinted bytes changed, the file was truncated or
+rewritten and the source is rebuilt from scratch.
+"""
+import io
+import os
+import csv
+import json
+import hashlib
+import logging
+from contextlib import ExitStack
+
+import pandas as pd
+from Src import config
+from Src import storage
+
+logger = logging.getLogger(__name__)
+
+WATERMARKS_FILE = 'watermarks.json'
+
+# Bytes hashed at the start of the file and just before the watermark offset
+FINGERPRINT_BYTES = 65536
+
+
+def watermarks_path():
+    """Location of the watermark file for the cleaned store."""
+    return config.CLEANED_DATA_DIR / WATERMARKS_FILE
+
+
+def load_watermarks():
+    """Load all source watermarks, or an empty dict on the first run."""
+    path = watermarks_path()
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_watermarks(watermarks):
+    """Write the watermarks atomically so a crash never leaves a partial file."""
+    path = watermarks_path()
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def clear_watermarks():
+    """Forget every source watermark after a rebuild replaced the cleaned tables.
+
+    The next incremental run then builds each source from scratch instead of
+    appending past offsets that no longer describe the cleaned tables.
+    """
+    path = watermarks_path()
+    if path.exists():
+        logger.info(f"Cleaned tables rebuilt; removing {path}")
+        path.unlink()
+
+
+def hash_range(path, start, end):
+    """Hash the bytes of path in [start, end)."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        digest.update(f.read(max(0, end - start)))
+    return digest.hexdigest()
+
+
+def complete_end(path, size):
+    """Offset just past the last newline, so a line still being written is left for later."""
+    with open(path, 'rb') as f:
+        pos = size
+        while pos > 0:
+            step = min(FINGERPRINT_BYTES, pos)
+            f.seek(pos - step)
+            block = f.read(step)
+            idx = block.rfind(b'\n')
+            if idx != -1:
+                return pos - step + idx + 1
+            pos -= step
+    return 0
+
+
+def read_header(path):
+    """Return the header line of a CSV file."""
+    with open(path, 'rb') as f:
+        return f.readline().decode('utf-8').rstrip('\r\n')
+
+
+class RangeReader(io.RawIOBase):
+    """Read-only file object exposing the bytes of a file in [start, end)."""
+
+    def __init__(self, path, start, end):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        data = self._file.read(size)
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class IncrementalIngestor:
+    """Clean only the rows appended to each raw source since the last run."""
+
+    def __init__(self, cleaner):
+        # The cleaner provides the chunk sizing and the loaded entity dictionaries
+        self.cleaner = cleaner
+        self.watermarks = load_watermarks()
+
+    def fingerprint(self, path, offset):
+        """Fingerprints that must be unchanged for an append to be valid."""
+        return {
+            'head_hash': hash_range(path, 0, min(offset, FINGERPRINT_BYTES)),
+            'tail_hash': hash_range(path, max(0, offset - FINGERPRINT_BYTES), offset)
+        }
+
+    def check(self, name, path):
+        """Classify a source as 'new', 'unchanged', 'append' or 'rebuild'."""
+        mark = self.watermarks.get(name)
+        if mark is None:
+            return 'new'
+
+        size = path.stat().st_size
+        if size < mark['offset']:
+            logger.warning(f"{name}: file shrank below its watermark; rebuilding")
+            return 'rebuild'
+        if read_header(path) != mark['header'] or \
+                self.fingerprint(path, mark['offset']) != {k: mark[k] for k in ('head_hash', 'tail_hash')}:
+            logger.warning(f"{name}: already ingested bytes changed; rebuilding")
+            return 'rebuild'
+        if complete_end(path, size) <= mark['offset']:
+            return 'unchanged'
+        return 'append'
+
+    def discard_uncommitted_parts(self, cleaned_name, mark):
+        """Drop parts written after the last committed watermark (e.g. by a crashed run)."""
+        committed = {cleaned_name: mark.get('parts'), **mark.get('derived_parts', {})}
+        for table, n_parts in committed.items():
+            parts = storage.list_parts(config.CLEANED_DATA_DIR, f'{table}_cleaned')
+            for part in parts[len(parts) if n_parts is None else n_parts:]:
+                logger.warning(f"Removing uncommitted part {part}")
+                part.unlink()
+
+    def ingest_range(self, name, path, start, end, header, append):
+        """Clean bytes [start, end) of a raw file into its cleaned table."""
+        from Src.Preprocessing.data_cleaning import CLEANED_NAMES, FRAME_CLEANERS, DERIVED_TABLES
+
+        cleaned_name = CLEANED_NAMES.get(name, name)
+        cleaner = FRAME_CLEANERS[cleaned_name]
+        rows = self.cleaner.get_chunk_rows(path)
+        parsers = {}
+        last_timestamp = None
+
+        read_args = {'chunksize': rows, 'low_memory': False, 'engine': 'c'}
+        if start > 0:
+            # Appended bytes carry no header line
+            read_args.update(header=None, names=next(csv.reader([header])))
+
+        with ExitStack() as stack:
+            raw = stack.enter_context(RangeReader(path, start, end))
+            writer = stack.enter_context(
+                storage.TableWriter(config.CLEANED_DATA_DIR, f'{cleaned_name}_cleaned', append=append))
+            derived_writers = {
+                table: stack.enter_context(
+                    storage.TableWriter(config.CLEANED_DATA_DIR, f'{table}_cleaned', append=append))
+                for table in DERIVED_TABLES.get(cleaned_name, {})
+            }
+            for chunk in pd.read_csv(io.BufferedReader(raw), **read_args):
+                df = cleaner(chunk, parsers)
+                for table, derived in self.cleaner.build_derived(cleaned_name, df).items():
+                    derived_writers[table].write(derived)
+                self.cleaner.interner.encode_frame(df, cleaned_name)
+                if 'timestamp' in df.columns and df['timestamp'].notna().any():
+                    chunk_max = df['timestamp'].max()
+                    last_timestamp = chunk_max if last_timestamp is None else max(last_timestamp, chunk_max)
+                writer.write(df)
+
+        for parser in parsers.values():
+            parser.report(cleaned_name)
+        return writer.rows, last_timestamp
+
+    def ingest(self, name, path):
+        """Bring one source up to date, returning the number of rows cleaned."""
+        from Src.Preprocessing.data_cleaning import CLEANED_NAMES, DERIVED_TABLES
+
+        cleaned_name = CLEANED_NAMES.get(name, name)
+        status = self.check(name, path)
+        if status == 'unchanged':
+            logger.info(f"{name}: no new rows")
+            return 0
+
+        end = complete_end(path, path.stat().st_size)
+        header = read_header(path)
+        mark = self.watermarks.get(name, {})
+
+        if status == 'append':
+            self.discard_uncommitted_parts(cleaned_name, mark)
+            start, append = mark['offset'], True
+            logger.info(f"{name}: cleaning {end - start:,} new bytes")
+        else:
+            start, append = 0, False
+            logger.info(f"{name}: full build ({end:,} bytes)")
+
+        rows, last_timestamp = self.ingest_range(name, path, start, end, header, append)
+
+        previous = mark.get('last_timestamp') if append else None
+        if last_timestamp is not None and previous is not None and \
+                last_timestamp < pd.Timestamp(previous):
+            logger.warning(f"{name}: appended rows end before the previous watermark timestamp")
+        if last_timestamp is None and previous is not None:
+            last_timestamp = pd.Timestamp(previous)
+
+        # Persist the dictionaries before committing the watermark that relies on them
+        self.cleaner.interner.save()
+        self.watermarks[name] = {
+            'offset': end,
+            'header': header,
+            'last_timestamp': None if last_timestamp is None else last_timestamp.isoformat(),
+            'rows': (mark.get('rows', 0) if append else 0) + rows,
+            'parts': len(storage.list_parts(config.CLEANED_DATA_DIR, f'{cleaned_name}_cleaned')),
+            'derived_parts': {
+                table: len(storage.list_parts(config.CLEANED_DATA_DIR, f'{table}_cleaned'))
+                for table in DERIVED_TABLES.get(cleaned_name, {})
+            },
+            **self.fingerprint(path, end)
+        }
+        save_watermarks(self.watermarks)
+        logger.info(f"{name}: {rows:,} rows cleaned, watermark at byte {end:,}")
+        return rows
+
+    def run(self):
+        """Ingest every raw source, returning the rows cleaned per source."""
+        os.makedirs(config.CLEANED_DATA_DIR, exist_ok=True)
+        row_counts = {}
+        for name, path in config.RAW_FILES.items():
+            if not path.exists():
+                logger.warning(f"File not found: {path}")
+                continue
+            try:
+                row_counts[name] = self.ingest(name, path)
+            except Exception as e:
+                logger.error(f"Error ingesting {name}: {str(e)}")
+                raise
+        return row_counts
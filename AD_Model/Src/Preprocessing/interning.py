@@ -0,0 +1,122 @@
+"""
+Entity interning: dense int32 codes for users, PCs and email addresses.
+
+Entity IDs are long strings that would otherwise be re-hashed by every
+groupby, merge and isin downstream. During cleaning each entity column is
+replaced by an int32 code from a shared, append-only dictionary per entity
+space, and the dictionaries are stored next to the cleaned tables. Later
+stages group and join on the codes and decode them only when writing
+human-facing output.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+from Src import config
+from Src import storage
+from Src.Preprocessing.schema import entity_columns
+
+logger = logging.getLogger(__name__)
+
+# Code used for missing entity values
+NULL_CODE = -1
+
+# Entity space of every interned column, per cleaned dataset
+ENTITY_COLUMNS = entity_columns()
+
+ENTITY_SPACES = ['user', 'pc', 'address']
+
+
+def entities_dir():
+    """Directory holding the interning dictionaries."""
+    return config.CLEANED_DATA_DIR / 'entities'
+
+
+class EntityInterner:
+    """Append-only dictionaries mapping entity strings to dense int32 codes.
+
+    Codes are positions in the dictionary, so they never change once issued
+    and tables encoded in different runs stay joinable.
+    """
+
+    def __init__(self, vocab=None):
+        self.vocab = {space: pd.Index([], dtype=object) for space in ENTITY_SPACES}
+        if vocab:
+            self.vocab.update(vocab)
+
+    def __len__(self):
+        return sum(len(values) for values in self.vocab.values())
+
+    def encode(self, space, values, grow=True):
+        """Encode values to int32 codes, adding unseen values unless grow=False.
+
+        Without grow, unseen values are encoded as NULL_CODE.
+        """
+        local_codes, uniques = pd.factorize(values)
+        vocab = self.vocab[space]
+        positions = vocab.get_indexer(uniques)
+
+        unseen = positions == -1
+        if unseen.any() and grow:
+            vocab = vocab.append(pd.Index(np.asarray(uniques[unseen], dtype=object), dtype=object))
+            self.vocab[space] = vocab
+            positions = vocab.get_indexer(uniques)
+
+        # Local code -1 (missing) maps onto the trailing NULL_CODE
+        lookup = np.append(positions, NULL_CODE).astype(np.int32)
+        return lookup[local_codes]
+
+    def decode(self, space, codes):
+        """Map codes back to their entity strings (missing for NULL_CODE)."""
+        codes = np.asarray(codes)
+        values = np.append(self.vocab[space].to_numpy(dtype=object), None)
+        return pd.Series(values[np.where(codes < 0, len(values) - 1, codes)], dtype=object)
+
+    def encode_frame(self, df, name, grow=True):
+        """Replace the entity columns of a cleaned dataset with their codes."""
+        for column, space in ENTITY_COLUMNS.get(name, {}).items():
+            if column in df.columns and not pd.api.types.is_integer_dtype(df[column]):
+                df[column] = self.encode(space, df[column], grow=grow)
+        return df
+
+    def decode_frame(self, df, columns):
+        """Decode the given {column: space} code columns of a frame in place."""
+        for column, space in columns.items():
+            if column in df.columns and pd.api.types.is_integer_dtype(df[column]):
+                decoded = self.decode(space, df[column].to_numpy())
+                decoded.index = df.index
+                df[column] = decoded
+        return df
+
+    def save(self, directory=None):
+        """Persist every dictionary as a (code, value) table."""
+        directory = directory or entities_dir()
+        for space, values in self.vocab.items():
+            table = pd.DataFrame({
+                'code': np.arange(len(values), dtype=np.int32),
+                'value': values.to_numpy(dtype=object)
+            })
+            storage.write_table(table, directory, space)
+        logger.info(f"Saved entity dictionaries to {directory} "
+                    f"({', '.join(f'{s}: {len(v):,}' for s, v in self.vocab.items())})")
+
+    @classmethod
+    def load(cls, directory=None):
+        """Load the dictionaries written by save()."""
+        directory = directory or entities_dir()
+        vocab = {}
+        for space in ENTITY_SPACES:
+            if storage.table_exists(directory, space):
+                table = storage.read_table(directory, space)
+                if 'code' in table.columns:
+                    table = table.sort_values('code')
+                    vocab[space] = pd.Index(table['value'].to_numpy(dtype=object), dtype=object)
+        return cls(vocab)
+
+    @classmethod
+    def load_or_new(cls, directory=None):
+        """Load saved dictionaries, or start empty if there are none."""
+        directory = directory or entities_dir()
+        if any(storage.table_exists(directory, space) for space in ENTITY_SPACES):
+            return cls.load(directory)
+        return cls()
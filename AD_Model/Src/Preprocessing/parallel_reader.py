@@ -0,0 +1,198 @@
+"""
+Byte-range parallel CSV reader for the large raw CERT files.
+
+The file is memory-mapped and cut into shards at newline boundaries. A
+newline only ends a record when an even number of quote characters precedes
+it, so split points are chosen with the quote parity of the bytes before them
+and quoted fields, including multi-line email bodies, are never cut. Each
+shard is parsed by pandas' C parser in a worker process, and the shards come
+back in file order either as one frame or as an iterator.
+"""
+import io
+import os
+import mmap
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from Src import config
+
+logger = logging.getLogger(__name__)
+
+QUOTE = ord('"')
+NEWLINE = ord('\n')
+
+# Bytes examined at a time when counting quotes or searching for a split point
+SCAN_BLOCK_BYTES = 16 * 1024 * 1024
+
+# Parsed shards per worker held at once when the consumer is slower than the parsers
+SHARDS_IN_FLIGHT_PER_WORKER = 2
+
+
+def count_quotes(data, start, end):
+    """Number of quote bytes in data[start:end], counted block by block."""
+    total = 0
+    for block_start in range(start, end, SCAN_BLOCK_BYTES):
+        block = data[block_start:min(end, block_start + SCAN_BLOCK_BYTES)]
+        total += int(np.count_nonzero(block == QUOTE))
+    return total
+
+
+def next_record_start(data, pos, quotes_before):
+    """First offset at or after pos that starts a record.
+
+    quotes_before is the number of quotes in data[:pos]. Returns len(data)
+    when no record boundary follows pos.
+    """
+    while pos < len(data):
+        block = data[pos:pos + SCAN_BLOCK_BYTES]
+        parity = (quotes_before + np.cumsum(block == QUOTE)) % 2
+        boundaries = np.flatnonzero((block == NEWLINE) & (parity == 0))
+        if len(boundaries):
+            return pos + int(boundaries[0]) + 1
+        quotes_before += int(np.count_nonzero(block == QUOTE))
+        pos += len(block)
+    return len(data)
+
+
+def split_ranges(path, n_shards):
+    """Cut a CSV file into up to n_shards newline-aligned byte ranges.
+
+    Returns the header line and a list of (start, end) ranges covering every
+    data record exactly once.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return '', []
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = np.frombuffer(mm, dtype=np.uint8)
+        header_end = next_record_start(data, 0, 0)
+        header = bytes(data[:header_end]).decode('utf-8').rstrip('\r\n')
+
+        target = max(1, (size - header_end) // max(1, n_shards))
+        starts = [header_end]
+        quotes = count_quotes(data, 0, header_end)
+        pos = header_end
+        while True:
+            candidate = starts[-1] + target
+            if candidate >= size:
+                break
+            quotes += count_quotes(data, pos, candidate)
+            pos = candidate
+            start = next_record_start(data, candidate, quotes)
+            if start >= size:
+                break
+            quotes += count_quotes(data, candidate, start)
+            pos = start
+            starts.append(start)
+        del data
+
+    ends = starts[1:] + [size]
+    return header, [(start, end) for start, end in zip(starts, ends) if end > start]
+
+
+def parse_range(path, start, end, names, read_kwargs):
+    """Parse bytes [start, end) of a CSV file; runs in a worker process."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        buffer = io.BytesIO(f.read(end - start))
+    return pd.read_csv(buffer, header=None, names=names, **read_kwargs)
+
+
+class ParallelCSVReader:
+    """Parse a large CSV file in newline-aligned shards across processes."""
+
+    def __init__(self, path, n_workers=None, shard_mb=None, **read_kwargs):
+        params = config.CLEANING_PARAMS
+        self.path = str(path)
+        self.n_workers = n_workers or params.get('read_workers') or os.cpu_count() or 1
+        self.shard_bytes = int((shard_mb or params.get('read_shard_mb', 64)) * 1024 * 1024)
+        self.read_kwargs = read_kwargs
+
+    def ranges(self):
+        """Header column names and byte ranges of the shards."""
+        size = os.path.getsize(self.path)
+        n_shards = max(self.n_workers, -(-size // self.shard_bytes))
+        header, ranges = split_ranges(self.path, n_shards)
+        names = pd.read_csv(io.StringIO(header), nrows=0).columns.tolist() if header else []
+        return names, ranges
+
+    def iter_shards(self):
+        """Yield the parsed shards in file order.
+
+        At most SHARDS_IN_FLIGHT_PER_WORKER shards per worker are in flight,
+        so memory stays bounded when the consumer is slower than the parsers.
+        """
+        names, ranges = self.ranges()
+        if not ranges:
+            return
+        if self.n_workers == 1 or len(ranges) == 1:
+            for start, end in ranges:
+                yield parse_range(self.path, start, end, names, self.read_kwargs)
+            return
+
+        window = SHARDS_IN_FLIGHT_PER_WORKER * self.n_workers
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            pending = []
+            for start, end in ranges:
+                pending.append(executor.submit(parse_range, self.path, start, end, names, self.read_kwargs))
+                if len(pending) >= window:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
+
+    def read(self):
+        """Parse the whole file into one frame."""
+        shards = list(self.iter_shards())
+        if not shards:
+            return pd.DataFrame()
+        return pd.concat(shards, ignore_index=True)
+
+
+def read_csv(path, n_workers=None, **read_kwargs):
+    """Read a CSV file, in parallel shards when it is large enough to pay off."""
+    min_bytes = config.CLEANING_PARAMS.get('parallel_read_min_mb', 64) * 1024 * 1024
+    n_workers = n_workers or config.CLEANING_PARAMS.get('read_workers') or os.cpu_count() or 1
+    if n_workers == 1 or os.path.getsize(path) < min_bytes:
+        return pd.read_csv(path, **read_kwargs)
+    logger.info(f"Reading {path} with {n_workers} parallel parsers")
+    return ParallelCSVReader(path, n_workers=n_workers, **read_kwargs).read()
+
+
+def raw_bytes_per_row(path, probe_bytes=1024 * 1024):
+    """Average raw bytes per line in the first probe_bytes of a file."""
+    with open(path, 'rb') as f:
+        probe = f.read(probe_bytes)
+    return len(probe) / max(1, probe.count(b'\n'))
+
+
+def iter_csv(path, chunk_rows, n_workers=None, **read_kwargs):
+    """Iterate over a CSV file in chunks of about chunk_rows rows.
+
+    Large files are parsed in parallel shards sized so that all the shards
+    in flight together hold about chunk_rows rows, and consecutive shards
+    are joined into chunks of about chunk_rows rows. Reading therefore holds
+    at most about one chunk besides the one the consumer is working on, so a
+    memory budget expressed in rows stays within about twice the budget
+    whatever the number of workers.
+    """
+    min_bytes = config.CLEANING_PARAMS.get('parallel_read_min_mb', 64) * 1024 * 1024
+    n_workers = n_workers or config.CLEANING_PARAMS.get('read_workers') or os.cpu_count() or 1
+    if n_workers == 1 or os.path.getsize(path) < min_bytes:
+        yield from pd.read_csv(path, chunksize=chunk_rows, **read_kwargs)
+        return
+    in_flight = SHARDS_IN_FLIGHT_PER_WORKER * n_workers
+    shard_mb = chunk_rows * raw_bytes_per_row(path) / in_flight / (1024 * 1024)
+    reader = ParallelCSVReader(path, n_workers=n_workers, shard_mb=shard_mb, **read_kwargs)
+
+    shards, rows = [], 0
+    for shard in reader.iter_shards():
+        shards.append(shard)
+        rows += len(shard)
+        if rows >= chunk_rows:
+            yield pd.concat(shards, ignore_index=True) if len(shards) > 1 else shards[0]
+            shards, rows = [], 0
+    if shards:
+        yield pd.concat(shards, ignore_index=True) if len(shards) > 1 else shards[0]
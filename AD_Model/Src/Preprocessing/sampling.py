@@ -0,0 +1,140 @@
+"""
+Representative one-pass sampling of the raw CERT files.
+
+The raw files are time-ordered, so taking the first N rows only covers the
+first weeks and misses most users. The sampler streams each file once in
+chunks and supports:
+
+- 'user_subset': every event of a fixed subset of users
+- 'reservoir': a uniform sample of rows
+- 'user_stratified': an equal share of the row budget per user
+- 'time_stratified': an equal share of the row budget per day
+
+Users are selected by a seeded hash of their ID, never by position, so the
+same users are kept in every source and a sampled user's logon, email, file
+and device events stay together. Row selection uses bottom-k sampling on
+seeded random keys: trimming a stratum to a smaller k keeps exactly the rows a
+smaller budget would have kept, which allows equal allocation across strata
+whose number is only known at the end of the file.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+from Src import config
+from Src.Preprocessing.parallel_reader import iter_csv
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_METHODS = ['user_subset', 'reservoir', 'user_stratified', 'time_stratified']
+
+# Raw user column of each source (None = not sampled by user)
+RAW_USER_COLUMNS = {
+    'users': 'user_id',
+    'logon': 'user',
+    'device': 'user',
+    'email': 'user',
+    'file': 'user',
+    'decoy': None
+}
+
+RAW_TIME_COLUMN = 'date'
+
+
+def user_hash_fraction(users, seed):
+    """Map user IDs to a stable pseudo-random number in [0, 1).
+
+    A domain prefix such as 'DTAA/' is ignored so that the same employee
+    hashes identically in every source.
+    """
+    users = pd.Series(users, dtype=object).astype(str).str.rsplit('/', n=1).str[-1]
+    hash_key = f'{seed:016d}'[-16:]
+    hashes = pd.util.hash_pandas_object(users, index=False, hash_key=hash_key).to_numpy()
+    return (hashes >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+class StreamSampler:
+    """Sample one raw file from a stream of chunks."""
+
+    def __init__(self, method='user_subset', budget=None, user_fraction=1.0, seed=42,
+                 user_column='user', time_column=RAW_TIME_COLUMN):
+        if method not in SAMPLING_METHODS:
+            raise ValueError(f"Unknown sampling method: {method}")
+        self.method = method
+        self.budget = None if method == 'user_subset' else budget
+        self.user_fraction = user_fraction
+        self.seed = seed
+        self.user_column = user_column
+        self.time_column = time_column
+        self.rng = np.random.default_rng(seed)
+        self.rows_seen = 0
+        self._kept = []
+        self._reservoir = None
+
+    def select_users(self, chunk):
+        """Boolean mask of rows belonging to the hashed user subset."""
+        if self.user_fraction >= 1.0 or self.user_column not in chunk.columns:
+            return np.ones(len(chunk), dtype=bool)
+        return user_hash_fraction(chunk[self.user_column], self.seed) < self.user_fraction
+
+    def strata(self, chunk):
+        """Stratum of every row for the configured method."""
+        if self.method == 'user_stratified' and self.user_column in chunk.columns:
+            return chunk[self.user_column].astype(str).to_numpy()
+        if self.method == 'time_stratified' and self.time_column in chunk.columns:
+            # The day is the date prefix of the raw string, so no parsing is needed
+            return chunk[self.time_column].astype(str).str[:10].to_numpy()
+        return np.zeros(len(chunk), dtype=np.int8)
+
+    def update(self, chunk):
+        """Feed the next chunk of the file."""
+        # Keys are drawn for every row before filtering so that the sample
+        # does not depend on how the file is split into chunks
+        keys = self.rng.random(len(chunk))
+        rows = np.arange(self.rows_seen, self.rows_seen + len(chunk))
+        self.rows_seen += len(chunk)
+
+        mask = self.select_users(chunk)
+        chunk = chunk[mask]
+        if self.budget is None:
+            self._kept.append(chunk)
+            return
+
+        chunk = chunk.assign(_key=keys[mask], _row=rows[mask], _stratum=self.strata(chunk))
+        combined = chunk if self._reservoir is None else pd.concat([self._reservoir, chunk], ignore_index=True)
+        n_strata = combined['_stratum'].nunique()
+        cap = max(1, self.budget // max(1, n_strata))
+
+        combined = combined.sort_values(['_stratum', '_key'], kind='stable')
+        self._reservoir = combined[combined.groupby('_stratum', sort=False).cumcount().to_numpy() < cap]
+
+    def result(self):
+        """Return the sample in original file order."""
+        if self.budget is None:
+            if not self._kept:
+                return pd.DataFrame()
+            return pd.concat(self._kept, ignore_index=True)
+        if self._reservoir is None:
+            return pd.DataFrame()
+        sample = self._reservoir.sort_values('_row')
+        return sample.drop(columns=['_key', '_row', '_stratum']).reset_index(drop=True)
+
+
+def sample_file(path, name, budget=None, method=None, user_fraction=None, seed=None, chunk_rows=None):
+    """Sample a raw file in one streaming pass using SAMPLING_PARAMS defaults."""
+    params = config.SAMPLING_PARAMS
+    sampler = StreamSampler(
+        method=method or params.get('method', 'user_subset'),
+        budget=budget,
+        user_fraction=params.get('user_fraction', 1.0) if user_fraction is None else user_fraction,
+        seed=params.get('seed', 42) if seed is None else seed,
+        user_column=RAW_USER_COLUMNS.get(name)
+    )
+    chunk_rows = chunk_rows or params.get('chunk_rows', 250000)
+
+    for chunk in iter_csv(path, chunk_rows, low_memory=False):
+        sampler.update(chunk)
+
+    sample = sampler.result()
+    logger.info(f"  Sampled {len(sample):,} of {sampler.rows_seen:,} rows from {name} ({sampler.method})")
+    return sample
@@ -0,0 +1,220 @@
+"""
+Schema registry for the CERT sources.
+
+Every cleaned dataset is declared once here: the canonical name of each
+column, the raw names it may arrive under, its dtype and the value that fills
+missing entries. The full cleaner, the streaming and incremental paths and
+quick_clean all apply the same declarations, so the cleaned tables have one
+set of names and compact, explicit dtypes instead of inferred object columns.
+
+Dtypes:
+
+- 'datetime64': parsed with the shared fixed-format TimestampParser
+- 'category': low-cardinality text such as activity types
+- 'int8' ... 'int64': numbers; unparseable values become the fill value
+- 'bool': True/False flags, also accepting 1/0 and yes/no text
+- 'string': free text, kept as read apart from the fill value
+- 'entity': a user, PC or address ID, interned to int32 codes by EntityInterner
+
+Raw columns that are not declared are passed through unchanged.
+"""
+import logging
+from collections import namedtuple
+
+import pandas as pd
+from Src.Preprocessing.timestamps import parse_column
+
+logger = logging.getLogger(__name__)
+
+# name: canonical column name; raw: raw names it may arrive under (default:
+# the canonical name); fill: value for missing entries (None = left missing;
+# a declared column with a fill value is created if the raw file lacks it);
+# entity: entity space of 'entity' columns
+Column = namedtuple('Column', ['name', 'dtype', 'raw', 'fill', 'entity'], defaults=((), None, None))
+
+TRUE_STRINGS = {'true', 't', 'yes', 'y', '1'}
+
+SCHEMAS = {
+    'users': [
+        Column('name', 'string', raw=('employee_name',)),
+        Column('user_id', 'entity', raw=('user_id', 'id'), entity='user'),
+        Column('email', 'entity', entity='address'),
+        Column('role', 'category', fill='Employee'),
+        Column('projects', 'string'),
+        Column('business_unit', 'category'),
+        Column('functional_unit', 'category'),
+        Column('department', 'category'),
+        Column('team', 'category'),
+        Column('supervisor_id', 'category', raw=('supervisor',)),
+        Column('start_date', 'datetime64'),
+        Column('end_date', 'datetime64', fill=pd.Timestamp('2100-01-01'))
+    ],
+    'logon': [
+        Column('logon_id', 'string', raw=('id',)),
+        Column('timestamp', 'datetime64', raw=('date',)),
+        Column('user_id', 'entity', raw=('user',), entity='user'),
+        Column('device_id', 'entity', raw=('pc',), entity='pc'),
+        Column('logon_type', 'category', raw=('activity',), fill='Unknown')
+    ],
+    'device': [
+        Column('device_event_id', 'string', raw=('id',)),
+        Column('timestamp', 'datetime64', raw=('date',)),
+        Column('user_id', 'entity', raw=('user',), entity='user'),
+        Column('device_id', 'entity', raw=('pc',), entity='pc'),
+        Column('file_path', 'string', raw=('file_tree',), fill='Unknown'),
+        Column('activity_type', 'category', raw=('activity',), fill='Unknown')
+    ],
+    'email': [
+        Column('email_id', 'string', raw=('id',)),
+        Column('timestamp', 'datetime64', raw=('date',)),
+        Column('sender_id', 'entity', raw=('user',), entity='user'),
+        Column('device_id', 'entity', raw=('pc',), entity='pc'),
+        Column('recipient_id', 'string', raw=('to',), fill=''),
+        Column('cc_recipients', 'string', raw=('cc',), fill=''),
+        Column('bcc_recipients', 'string', raw=('bcc',), fill=''),
+        Column('sender_address', 'entity', raw=('from',), entity='address'),
+        Column('email_size', 'int32', raw=('size',), fill=0),
+        Column('has_attachments', 'int32', raw=('attachments',), fill=0),
+        Column('content', 'string'),
+        Column('subject', 'string'),
+        Column('sensitivity', 'category', fill='Normal'),
+        Column('importance', 'category', fill='Normal')
+    ],
+    'file': [
+        Column('file_event_id', 'string', raw=('id',)),
+        Column('timestamp', 'datetime64', raw=('date',)),
+        Column('user_id', 'entity', raw=('user',), entity='user'),
+        Column('device_id', 'entity', raw=('pc',), entity='pc'),
+        Column('filename', 'string'),
+        Column('file_path', 'string'),
+        Column('activity_type', 'category', raw=('activity',), fill='Unknown'),
+        Column('to_removable_media', 'bool', fill=False),
+        Column('from_removable_media', 'bool', fill=False),
+        Column('content', 'string'),
+        Column('file_size', 'int64', raw=('size',), fill=0),
+        Column('sensitivity', 'category', fill='Normal')
+    ],
+    'decoy_file': [
+        Column('decoy_filename', 'string'),
+        Column('device_id', 'entity', raw=('pc',), entity='pc')
+    ],
+    # Derived from the cleaned email table (see email_edges.py)
+    'email_edges': [
+        Column('timestamp', 'datetime64'),
+        Column('sender_id', 'entity', entity='user'),
+        Column('recipient_address', 'entity', entity='address'),
+        Column('edge_type', 'int8'),
+        Column('is_external', 'bool')
+    ]
+}
+
+
+def get_schema(name):
+    """Column declarations of a cleaned dataset."""
+    if name not in SCHEMAS:
+        raise KeyError(f"No schema declared for {name}")
+    return SCHEMAS[name]
+
+
+def column_names(name):
+    """Canonical column names of a cleaned dataset, in declaration order."""
+    return [column.name for column in get_schema(name)]
+
+
+def entity_columns():
+    """Entity space of every interned column, per cleaned dataset."""
+    return {
+        name: {column.name: column.entity for column in columns if column.dtype == 'entity'}
+        for name, columns in SCHEMAS.items()
+    }
+
+
+def rename_map(name, raw_columns):
+    """Map the raw columns present in a file to their canonical names."""
+    present = set(raw_columns)
+    mapping = {}
+    for column in get_schema(name):
+        for raw in column.raw or (column.name,):
+            if raw in present and raw not in mapping:
+                mapping[raw] = column.name
+                break
+    return mapping
+
+
+def to_bool(series):
+    """Convert True/False, 1/0 or yes/no values to a boolean series with NaN kept."""
+    if pd.api.types.is_bool_dtype(series):
+        return series
+    if pd.api.types.is_numeric_dtype(series):
+        return series.ne(0).where(series.notna())
+    text = series.astype(object).where(series.notna())
+    lowered = text.map(lambda value: str(value).strip().lower(), na_action='ignore')
+    return lowered.isin(TRUE_STRINGS).where(text.notna())
+
+
+def to_text(series):
+    """Return a text series, converting non-text values with NaN kept."""
+    if pd.api.types.is_string_dtype(series) or pd.api.types.is_object_dtype(series):
+        return series
+    return series.astype(object).map(str, na_action='ignore').astype(object)
+
+
+def convert_column(series, column, parsers=None):
+    """Convert one renamed column to its declared dtype and fill rule."""
+    dtype = column.dtype
+    if dtype == 'datetime64':
+        frame = series.to_frame(column.name)
+        parse_column(frame, column.name, parsers)
+        series = frame[column.name]
+        return series if column.fill is None else series.fillna(column.fill)
+
+    if dtype in ('int8', 'int16', 'int32', 'int64'):
+        series = pd.to_numeric(series, errors='coerce')
+        if column.fill is None:
+            return series.astype(dtype.capitalize())
+        return series.fillna(column.fill).astype(dtype)
+
+    if dtype == 'bool':
+        series = to_bool(series)
+        if column.fill is None:
+            return series.astype('boolean')
+        return series.fillna(column.fill).astype(bool)
+
+    # Text columns read as numbers (e.g. numeric unit codes, or all empty)
+    # are turned back into text so every chunk agrees on the type
+    series = to_text(series)
+    if column.fill is not None:
+        series = series.fillna(column.fill)
+    if dtype == 'category':
+        return series.astype('category')
+    # 'string' and 'entity' columns keep their text; entities are interned later
+    return series
+
+
+def apply_schema(df, name, parsers=None):
+    """Rename, type and fill a raw frame according to its schema in one pass.
+
+    parsers is an optional dict of TimestampParsers keyed by column, shared
+    across the chunks of one file. Returns a new frame with the declared
+    columns in declaration order, followed by any undeclared raw columns.
+    """
+    df = df.rename(columns=rename_map(name, df.columns))
+    columns = {}
+    for column in get_schema(name):
+        if column.name in df.columns:
+            columns[column.name] = convert_column(df[column.name], column, parsers)
+        elif column.fill is not None:
+            columns[column.name] = convert_column(
+                pd.Series(column.fill, index=df.index, name=column.name), column, parsers
+            )
+    for col in df.columns:
+        if col not in columns:
+            columns[col] = df[col]
+    return pd.DataFrame(columns, index=df.index)
+
+
+def memory_per_row(df):
+    """Average in-memory bytes per row of a frame."""
+    if len(df) == 0:
+        return 0.0
+    return float(df.memory_usage(index=False, deep=True).sum()) / len(df)
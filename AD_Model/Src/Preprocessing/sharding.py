@@ -0,0 +1,195 @@
+"""
+User-sharded copies of the cleaned event tables.
+
+When CLEANING_PARAMS['user_shards'] is set, the cleaning stage finishes by
+hash-partitioning the rows of every event table by their (interned) user into
+N shards on disk: Cleaned/shards/shard-NNN/<table>.parquet. All features are
+per user, so feature extraction can run each shard in its own worker and
+concatenate the results; every worker holds about 1/N of each source.
+
+A manifest records the number of shards, the parts of each cleaned table that
+have been sharded and the first timestamp of each table, which the extractors
+need so that multi-day windows start on the same day in every shard. Tables
+that only grew by new parts have just those parts appended to their shards;
+rewritten tables are sharded again from scratch.
+"""
+import json
+import logging
+from contextlib import ExitStack
+
+import numpy as np
+import pandas as pd
+from Src import config
+from Src import storage
+from Src.sketches import hash_values
+from Src.Preprocessing.interning import ENTITY_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'shards.json'
+
+# Event tables that are sharded; users and decoy_file are small lookups
+SHARDED_TABLES = ['logon', 'device', 'email', 'file', 'email_edges']
+
+
+def shards_root(directory=None):
+    """Directory holding the shards of the cleaned tables."""
+    return (directory or config.CLEANED_DATA_DIR) / 'shards'
+
+
+def shard_dir(shard, directory=None):
+    """Directory of one shard; it holds tables named like the cleaned ones."""
+    return shards_root(directory) / f'shard-{shard:03d}'
+
+
+def user_column(name):
+    """The user entity column of a cleaned table."""
+    return next(column for column, space in ENTITY_COLUMNS[name].items() if space == 'user')
+
+
+def shard_of(users, n_shards):
+    """Shard number of each user code; stable across processes and runs."""
+    hashes = hash_values(pd.Series(np.asarray(users, dtype=np.int64)))
+    return (hashes % np.uint64(n_shards)).astype(np.int64)
+
+
+def load_manifest(directory=None):
+    """The shard manifest, or None when the tables have not been sharded."""
+    path = shards_root(directory) / MANIFEST_FILE
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, directory=None):
+    """Write the manifest atomically."""
+    root = shards_root(directory)
+    root.mkdir(parents=True, exist_ok=True)
+    tmp_path = root / f'{MANIFEST_FILE}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    tmp_path.replace(root / MANIFEST_FILE)
+
+
+def shard_table(name, n_shards, parts=None, append=False, directory=None):
+    """Partition the rows of one cleaned table into its shards.
+
+    parts limits the pass to those part files (the newly appended ones);
+    by default the whole table is read. Returns (rows, first timestamp).
+    """
+    directory = directory or config.CLEANED_DATA_DIR
+    table = f'{name}_cleaned'
+    column = user_column(name)
+    if parts is None:
+        batches = storage.iter_table(directory, table)
+    else:
+        batches = (storage.read_part(directory / part) for part in parts)
+
+    rows = 0
+    first = None
+    with ExitStack() as stack:
+        writers = [
+            stack.enter_context(storage.TableWriter(shard_dir(i, directory), table, append=append))
+            for i in range(n_shards)
+        ]
+        for df in batches:
+            shards = shard_of(df[column].to_numpy(), n_shards)
+            order = np.argsort(shards, kind='stable')
+            bounds = np.searchsorted(shards[order], np.arange(n_shards + 1))
+            for i in range(n_shards):
+                if bounds[i + 1] > bounds[i]:
+                    writers[i].write(df.iloc[order[bounds[i]:bounds[i + 1]]])
+            if 'timestamp' in df.columns:
+                # CSV tables come back as text
+                batch_first = pd.to_datetime(df['timestamp'], errors='coerce').min()
+                if pd.notna(batch_first):
+                    first = batch_first if first is None else min(first, batch_first)
+            rows += len(df)
+    return rows, first
+
+
+def update_user_shards(n_shards=None, directory=None):
+    """Bring the shards of every cleaned event table up to date.
+
+    Returns the manifest, or None when sharding is disabled.
+    """
+    n_shards = n_shards or config.CLEANING_PARAMS.get('user_shards')
+    if not n_shards:
+        return None
+    directory = directory or config.CLEANED_DATA_DIR
+    manifest = load_manifest(directory)
+    if manifest is None or manifest['n_shards'] != n_shards:
+        manifest = {'n_shards': n_shards, 'tables': {}}
+
+    for name in SHARDED_TABLES:
+        table = f'{name}_cleaned'
+        if not storage.table_exists(directory, table):
+            manifest['tables'].pop(name, None)
+            continue
+        parts = storage.part_stats(directory, table)
+        done = manifest['tables'].get(name)
+        if done is not None and done['parts'] == parts:
+            continue
+
+        appended = done is not None and parts[:len(done['parts'])] == done['parts'] and \
+            parts[0][0].endswith('.parquet')
+        if appended:
+            new_parts = [part for part, _, _ in parts[len(done['parts']):]]
+            rows, first = shard_table(name, n_shards, new_parts, append=True, directory=directory)
+            previous = done.get('first_timestamp')
+            if previous is not None and (first is None or pd.Timestamp(previous) < first):
+                first = pd.Timestamp(previous)
+            rows += done['rows']
+        else:
+            rows, first = shard_table(name, n_shards, directory=directory)
+
+        manifest['tables'][name] = {
+            'parts': parts,
+            'rows': rows,
+            'first_timestamp': None if first is None else first.isoformat()
+        }
+        logger.info(f"Sharded {name} by user into {n_shards} shards ({rows:,} rows)")
+
+    save_manifest(manifest, directory)
+    return manifest
+
+
+def current_shards(directory=None):
+    """The manifest if every sharded table matches its cleaned table, else None."""
+    directory = directory or config.CLEANED_DATA_DIR
+    manifest = load_manifest(directory)
+    if manifest is None:
+        return None
+    for name in SHARDED_TABLES:
+        table = f'{name}_cleaned'
+        sharded = manifest['tables'].get(name)
+        if storage.table_exists(directory, table) != (sharded is not None):
+            return None
+        if sharded is not None and sharded['parts'] != storage.part_stats(directory, table):
+            return None
+    return manifest
+
+
+def usable_shards(directory=None):
+    """The manifest if user sharding is configured and the shards are current and of the configured count.
+
+    Returns None otherwise, warning when sharding is configured but the
+    shards cannot be used.
+    """
+    n_shards = config.CLEANING_PARAMS.get('user_shards')
+    if not n_shards:
+        return None
+    manifest = current_shards(directory)
+    if manifest is None or manifest['n_shards'] != n_shards:
+        logger.warning("User shards are missing or stale; extracting from the whole tables")
+        return None
+    return manifest
+
+
+def shard_origins(manifest):
+    """First timestamp of every sharded table, for aligning multi-day windows."""
+    return {
+        name: pd.Timestamp(table['first_timestamp'])
+        for name, table in manifest['tables'].items() if table.get('first_timestamp')
+    }
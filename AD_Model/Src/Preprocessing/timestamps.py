@@ -0,0 +1,119 @@
+"""
+Timestamp parsing shared by the cleaning and feature stages.
+
+CERT files write dates as ``MM/DD/YYYY HH:MM:SS``. Letting pandas infer the
+format row by row is one of the most expensive steps on large files, so the
+layout is detected once from a sample and every value is then parsed with that
+fixed format. Event timestamps repeat heavily (many events share a second), so
+each distinct string is parsed only once and mapped back onto the rows.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CERT_TIMESTAMP_FORMAT = '%m/%d/%Y %H:%M:%S'
+
+# Layouts tried, in order, when detecting the format of a column
+CANDIDATE_FORMATS = [
+    CERT_TIMESTAMP_FORMAT,
+    '%m/%d/%Y',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d'
+]
+
+# Share of sampled values a candidate format must parse to be used
+MIN_FORMAT_MATCH = 0.95
+
+
+class TimestampParser:
+    """Parse one timestamp column, possibly across several chunks.
+
+    The format is detected on the first chunk and reused for the rest, and
+    the parser keeps running totals of parsed rows and rows coerced to NaT.
+    """
+
+    def __init__(self, column='timestamp', fmt=None, sample_size=1000):
+        self.column = column
+        self.fmt = fmt
+        self.sample_size = sample_size
+        self.rows = 0
+        self.coerced = 0
+
+    def detect_format(self, values):
+        """Pick the candidate format that parses most of a sample of values.
+
+        A few malformed values should not push the whole file onto the slow
+        inference path, so a format is accepted when it parses at least
+        MIN_FORMAT_MATCH of the sample; the rest are coerced to NaT.
+        """
+        sample = pd.Series(values).dropna()
+        sample = sample[sample.astype(str).str.strip() != ''].head(self.sample_size)
+        if sample.empty:
+            return None
+
+        best_fmt, best_rate = None, 0.0
+        for fmt in CANDIDATE_FORMATS:
+            rate = pd.to_datetime(sample, format=fmt, errors='coerce').notna().mean()
+            if rate > best_rate:
+                best_fmt, best_rate = fmt, rate
+            if rate == 1.0:
+                break
+
+        if best_rate >= MIN_FORMAT_MATCH:
+            return best_fmt
+        logger.warning(f"No fixed format matches {self.column}; using pandas inference")
+        return None
+
+    def parse(self, series):
+        """Parse a series of timestamp strings into datetime64 values."""
+        if pd.api.types.is_datetime64_any_dtype(series):
+            # Already parsed upstream; never parse twice
+            self.rows += len(series)
+            return series
+
+        codes, uniques = pd.factorize(series)
+        if self.fmt is None:
+            self.fmt = self.detect_format(uniques)
+
+        if self.fmt is not None:
+            parsed = pd.to_datetime(uniques, format=self.fmt, errors='coerce')
+        else:
+            parsed = pd.to_datetime(uniques, errors='coerce')
+
+        # Code -1 marks missing input; point it at a trailing NaT
+        lookup = np.append(np.asarray(parsed, dtype='datetime64[ns]'), np.datetime64('NaT', 'ns'))
+        result = pd.Series(lookup[codes], index=series.index, name=series.name)
+
+        self.rows += len(series)
+        self.coerced += int(result.isna().sum() - (codes == -1).sum())
+        return result
+
+    def report(self, source=''):
+        """Log how many rows were coerced to NaT."""
+        prefix = f"{source}.{self.column}" if source else self.column
+        if self.coerced:
+            logger.warning(f"{prefix}: {self.coerced:,} of {self.rows:,} rows coerced to NaT "
+                           f"(format {self.fmt or 'inferred'})")
+        else:
+            logger.info(f"{prefix}: parsed {self.rows:,} rows (format {self.fmt or 'inferred'})")
+
+
+def parse_timestamps(series, fmt=None):
+    """Parse one series, returning the parsed values and the NaT-coerced count."""
+    parser = TimestampParser(series.name or 'timestamp', fmt=fmt)
+    return parser.parse(series), parser.coerced
+
+
+def parse_column(df, column, parsers=None):
+    """Parse a column of df in place, reusing the parser kept for it in parsers."""
+    if parsers is None:
+        parser = TimestampParser(column)
+    else:
+        parser = parsers.setdefault(column, TimestampParser(column))
+    df[column] = parser.parse(df[column])
+    return df
@@ -11,6 +11,7 @@ PROCESSED_DATA_DIR = DATA_DIR / "Processed"
 FEATURES_DIR = DATA_DIR / "Features"
 MODELS_DIR = BASE_DIR / "Models"
 OUTPUTS_DIR = BASE_DIR / "Outputs"
+CACHE_DIR = DATA_DIR / "Cache"
 
 # Create directories if they don't exist
 for directory in [CLEANED_DATA_DIR, PROCESSED_DATA_DIR, FEATURES_DIR, MODELS_DIR, OUTPUTS_DIR]:
@@ -26,6 +27,50 @@ RAW_FILES = {
     'decoy': RAW_DATA_DIR / 'decoy_file.csv'
 }
 
+# Data cleaning parameters
+CLEANING_PARAMS = {
+    'chunk_rows': 250000,  # Rows per chunk in streaming mode
+    'memory_budget_mb': None,  # If set, chunk size is derived from this per-chunk memory budget
+    'n_workers': None,  # Worker processes for parallel cleaning (None = one per dataset, up to CPU count)
+    'read_workers': None,  # Parser processes per raw file (None = CPU count)
+    'read_shard_mb': 64,  # Byte range parsed by one parser task
+    'parallel_read_min_mb': 64,  # Smaller files are parsed on a single thread
+    'user_shards': None  # If set, event tables are also hash-partitioned by user into this many shards
+}
+
+# Business calendar of the int8 calendar columns added to every cleaned event
+# (see Preprocessing/business_calendar.py); re-clean after changing it
+CALENDAR_PARAMS = {
+    'business_hours': (8, 18),  # First and last business hour, inclusive; other hours are after hours
+    'weekend_days': (5, 6)  # Days of the week (Monday = 0) counted as weekend
+}
+
+# Sampling parameters for quick development runs (see Preprocessing/sampling.py)
+SAMPLING_PARAMS = {
+    'method': 'user_subset',  # 'user_subset', 'reservoir', 'user_stratified' or 'time_stratified'
+    'user_fraction': 0.15,  # Share of users kept, chosen by a seeded hash consistent across sources
+    'seed': 42,
+    'chunk_rows': 250000
+}
+
+# Storage parameters for cleaned, feature and output tables
+STORAGE_PARAMS = {
+    'format': 'parquet',  # 'parquet' or 'csv'
+    'compression': 'snappy',
+    'export_csv': False  # Also write a CSV copy of every table
+}
+
+# Stage cache parameters (see stage_cache.py)
+CACHE_PARAMS = {
+    'enabled': True,
+    'budget_mb': 20480  # Least recently used entries are evicted beyond this size
+}
+
+# Email parameters
+EMAIL_PARAMS = {
+    'internal_domains': ['dtaa.com']  # Recipient domains that are not external
+}
+
 # Model parameters
 MODEL_PARAMS = {
     'isolation_forest': {
@@ -39,6 +84,10 @@ MODEL_PARAMS = {
 # Feature engineering parameters
 FEATURE_PARAMS = {
     'time_windows': ['1H', '1D', '7D'],  # Time windows for aggregation
+    'n_workers': None,  # Worker processes for per-source extraction (None = CPU count, 1 = sequential)
+    'distinct_counts': 'exact',  # 'exact', or 'approx' for HyperLogLog estimates of the unique_* features
+    'sketch_precision': 12,  # HyperLogLog registers = 2**precision; relative standard error 1.04 / sqrt(2**precision)
+    'pagerank': {'damping': 0.85, 'tol': 1e-10, 'max_iter': 100},  # PageRank of the email communication graph
     'activity_thresholds': {
         'login_frequency': 3,  # Max logins per hour
         'file_access_frequency': 20,  # Max file accesses per hour
@@ -47,6 +96,35 @@ FEATURE_PARAMS = {
     }
 }
 
+# Online per-user feature state (see Feature_engineering/feature_state.py)
+FEATURE_STATE_PARAMS = {
+    'sketch_precision': 10  # Per-user HyperLogLog precision; relative error about 1.04 / sqrt(2**precision)
+}
+
+# Day-partitioned feature store (see Feature_engineering/feature_store.py)
+FEATURE_STORE_PARAMS = {
+    'enabled': True,  # Publish time-keyed features to the store and read training/scoring ranges from it
+    'row_group_rows': 65536  # Rows per Parquet row group within a day file
+}
+
+# Per-user EWMA baselines of the daily features (see Feature_engineering/baselines.py)
+BASELINE_PARAMS = {
+    'enabled': True,  # Fold newly published feature days into the baselines and publish deviation z-scores
+    'halflife_days': 14,  # Weight of a day halves after this many days
+    'min_days': 7,  # Days of history before a user's deviations are emitted (0 until then)
+    'min_std': 1.0,  # Floor of the baseline standard deviation, so near-constant users do not explode
+    'features': None  # Daily feature columns to baseline (None = every *_1D window count)
+}
+
+# Peer-group deviations of the per-user features (see Feature_engineering/peer_groups.py)
+PEER_GROUP_PARAMS = {
+    'enabled': True,
+    'attributes': ['role', 'department', 'team'],  # Users table columns defining peer groups (also 'business_unit', 'supervisor_id', ...)
+    'min_group_size': 5,  # Smaller peer groups emit 0
+    'min_scale': 1.0,  # Floor of the robust scale 1.4826 * MAD, so groups of identical users do not explode
+    'features': None  # Per-user features compared with peers (None = every numeric feature but the decoy label)
+}
+
 # Alert thresholds
 ALERT_THRESHOLDS = {
     'high_risk': 0.8,  # Anomaly score threshold for high risk
@@ -1,56 +1,257 @@
+"""
+Streaming profiler for the raw CERT files.
+
+Each raw file is read once in chunks and every column is summarized with
+mergeable sketches: row and null counts, min/max and mean, approximate
+quantiles, HyperLogLog distinct counts and top-k values. Memory stays
+bounded by the chunk size and the sketch sizes, not by the file size. The
+profile of each source is written as compact JSON to Data/Exploratory, and
+the optional plots are drawn from that JSON, never from the raw data.
+"""
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import json
+import logging
 from pathlib import Path
 
-# Set paths
-import os
-BASE_DIR = Path(__file__).parent.parent  # This points to AD_Model directory
-DATA_DIR = os.path.join(BASE_DIR, "Data")
-RAW_DATA_DIR = os.path.join(DATA_DIR, "Raw")
-
-# Function to load and display basic info about a CSV file
-def explore_csv(file_name):
-    print(f"\n{'='*50}")
-    print(f"Exploring {file_name}")
-    print("="*50)
-    
-    file_path = os.path.join(RAW_DATA_DIR, file_name)
+import numpy as np
+import pandas as pd
+from Src import config
+from Src.sketches import HyperLogLog, QuantileSketch, TopK
+from Src.Preprocessing.parallel_reader import iter_csv
+from Src.Preprocessing.timestamps import TimestampParser
+from Src.Preprocessing.schema import SCHEMAS, rename_map
+
+logger = logging.getLogger(__name__)
+
+# Quantiles reported for numeric and datetime columns
+PROFILE_QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+# Most frequent values reported per column
+TOP_K = 10
+
+
+def exploratory_dir():
+    """Directory holding the profiles and plots."""
+    return config.DATA_DIR / "Exploratory"
+
+
+def datetime_columns(source, columns):
+    """Raw columns the schema registry declares as timestamps."""
+    schema = SCHEMAS.get(source, [])
+    declared = {column.name for column in schema if column.dtype == 'datetime64'}
+    return {raw for raw, name in rename_map(source, columns).items() if name in declared} if schema else set()
+
+
+class ColumnProfile:
+    """Sketches of one column, updated chunk by chunk.
+
+    The kind ('numeric', 'datetime' or 'text') is fixed by the first chunk
+    holding any value, so a column that starts out empty is not mistaken for
+    a numeric one.
+    """
+
+    def __init__(self, kind=None):
+        self.kind = kind
+        self.rows = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.distinct = HyperLogLog()
+        self.top = TopK(capacity=10 * TOP_K)
+        self.quantiles = None
+
+    def update(self, series, kind=None):
+        """Add one chunk of the column; kind forces the column kind when given."""
+        values = series.dropna()
+        self.rows += len(series)
+        self.nulls += len(series) - len(values)
+        if values.empty:
+            return
+        if self.kind is None:
+            if kind is not None:
+                self.kind = kind
+            elif pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+                self.kind = 'numeric'
+            else:
+                self.kind = 'text'
+            if self.kind != 'text':
+                self.quantiles = QuantileSketch()
+
+        self.distinct.update(values)
+        self.top.update(values)
+        if self.quantiles is None:
+            return
+
+        if self.kind == 'datetime':
+            numbers = values.astype('int64').to_numpy(dtype=np.float64)
+        else:
+            # A later chunk holding text makes those values missing, not a new kind
+            numbers = pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64)
+            numbers = numbers[np.isfinite(numbers)]
+            if len(numbers) == 0:
+                return
+        self.sum += float(numbers.sum())
+        self.quantiles.update(numbers)
+        low, high = numbers.min(), numbers.max()
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def merge(self, other):
+        """Fold the profile of the same column over other rows into this one."""
+        self.rows += other.rows
+        self.nulls += other.nulls
+        self.sum += other.sum
+        self.distinct.merge(other.distinct)
+        self.top.merge(other.top)
+        if self.kind is None:
+            self.kind = other.kind
+        if other.quantiles is not None:
+            self.quantiles = other.quantiles if self.quantiles is None else self.quantiles.merge(other.quantiles)
+        for attr, pick in (('min', min), ('max', max)):
+            values = [v for v in (getattr(self, attr), getattr(other, attr)) if v is not None]
+            setattr(self, attr, pick(values) if values else None)
+        return self
+
+    def _format(self, value):
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return None
+        if self.kind == 'datetime':
+            return pd.Timestamp(int(value)).isoformat()
+        return float(value)
+
+    def to_dict(self):
+        """Summary of the column for the JSON profile."""
+        present = self.rows - self.nulls
+        summary = {
+            'kind': self.kind or 'empty',
+            'count': present,
+            'nulls': self.nulls,
+            'null_rate': self.nulls / self.rows if self.rows else 0.0,
+            'distinct_approx': self.distinct.count(),
+            'distinct_error': round(float(self.distinct.error), 4),
+            'top': [[str(value), count] for value, count in self.top.top(TOP_K)],
+            'top_error_bound': self.top.error_bound()
+        }
+        if self.quantiles is not None:
+            summary.update({
+                'min': self._format(self.min),
+                'max': self._format(self.max),
+                'mean': self._format(self.sum / present) if present else None,
+                'quantiles': {
+                    str(q): self._format(v)
+                    for q, v in zip(PROFILE_QUANTILES, self.quantiles.quantiles(PROFILE_QUANTILES))
+                }
+            })
+        return summary
+
+
+def profile_file(path, source=None, chunk_rows=None):
+    """Profile a raw CSV file in one streaming pass.
+
+    Timestamp columns, as declared in the schema registry, are parsed with
+    the shared fixed-format parser so that their range and quantiles are
+    reported as dates.
+    """
+    path = Path(path)
+    source = source or path.stem
+    chunk_rows = chunk_rows or config.CLEANING_PARAMS.get('chunk_rows', 250000)
+
+    columns = {}
+    parsers = {}
+    rows = 0
+    for chunk in iter_csv(path, chunk_rows, low_memory=False):
+        rows += len(chunk)
+        dates = datetime_columns(source, chunk.columns)
+        for col in chunk.columns:
+            series = chunk[col]
+            if col in dates:
+                series = parsers.setdefault(col, TimestampParser(col)).parse(series)
+            columns.setdefault(col, ColumnProfile()).update(series, 'datetime' if col in dates else None)
+
+    return {
+        'source': source,
+        'file': path.name,
+        'bytes': path.stat().st_size,
+        'rows': rows,
+        'columns': {col: profile.to_dict() for col, profile in columns.items()}
+    }
+
+
+def write_profile(profile, directory=None):
+    """Write a profile as JSON, returning its path."""
+    directory = Path(directory or exploratory_dir())
+    directory.mkdir(parents=True, exist_ok=True)
+    output_path = directory / f"{profile['source']}_profile.json"
+    with open(output_path, 'w') as f:
+        json.dump(profile, f, indent=1)
+    return output_path
+
+
+def load_profile(source, directory=None):
+    """Load a profile written by write_profile()."""
+    directory = Path(directory or exploratory_dir())
+    with open(directory / f'{source}_profile.json') as f:
+        return json.load(f)
+
+
+def plot_profile(profile, directory=None):
+    """Plot quantiles of numeric columns and top values of text columns from a profile."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    directory = Path(directory or exploratory_dir())
+    directory.mkdir(parents=True, exist_ok=True)
+    columns = profile['columns']
+    if not columns:
+        return None
+
+    fig, axes = plt.subplots(len(columns), 1, figsize=(10, 2.5 * len(columns)), squeeze=False)
+    for ax, (col, summary) in zip(axes[:, 0], columns.items()):
+        if summary['kind'] == 'numeric' and summary.get('quantiles'):
+            qs = summary['quantiles']
+            ax.plot([float(q) for q in qs], [np.nan if v is None else v for v in qs.values()], marker='o')
+            ax.set_xlabel('quantile')
+        elif summary['top']:
+            labels, counts = zip(*summary['top'])
+            ax.barh([label[:40] for label in labels][::-1], list(counts)[::-1])
+        ax.set_title(f"{col} ({summary['kind']}, ~{summary['distinct_approx']:,} distinct, "
+                     f"{summary['null_rate']:.1%} null)")
+    fig.tight_layout()
+    output_path = directory / f"{profile['source']}_profile.png"
+    fig.savefig(output_path)
+    plt.close(fig)
+    return output_path
+
+
+def explore_csv(file_name, plot=False):
+    """Profile one raw CSV file, write its JSON profile and optionally plot it."""
+    file_path = config.RAW_DATA_DIR / file_name
+    source = next((name for name, path in config.RAW_FILES.items() if path.name == file_name),
+                  Path(file_name).stem)
+    logger.info(f"Profiling {file_name}...")
     try:
-        df = pd.read_csv(file_path)
-        print(f"\nShape: {df.shape}")
-        print("\nFirst 5 rows:")
-        print(df.head())
-        print("\nData types:")
-        print(df.dtypes)
-        print("\nMissing values:")
-        print(df.isnull().sum())
-        print("\nBasic statistics:")
-        print(df.describe(include='all'))
-        
-        # Save sample visualizations
-        exploratory_dir = os.path.join(DATA_DIR, "Exploratory")
-        if not os.path.exists(exploratory_dir):
-            os.makedirs(exploratory_dir)
-            
-        # Plot histograms for numeric columns
-        numeric_cols = df.select_dtypes(include=['int64', 'float64']).columns
-        if len(numeric_cols) > 0:
-            plt.figure(figsize=(15, 10))
-            df[numeric_cols].hist()
-            plt.tight_layout()
-            plt.savefig(os.path.join(DATA_DIR, "Exploratory", f"{file_name.replace('.csv', '')}_histograms.png"))
-            plt.close()
-            
+        profile = profile_file(file_path, source)
+        output_path = write_profile(profile)
+        logger.info(f"Profiled {file_name}: {profile['rows']:,} rows, "
+                    f"{len(profile['columns'])} columns -> {output_path}")
+        if plot:
+            plot_profile(profile)
+        return profile
     except Exception as e:
-        print(f"Error processing {file_name}: {str(e)}")
+        logger.error(f"Error processing {file_name}: {str(e)}")
+        return None
+
+
+def explore_all(plot=False):
+    """Profile every raw CSV file."""
+    csv_files = sorted(f for f in os.listdir(config.RAW_DATA_DIR) if f.endswith('.csv'))
+    return {csv_file: explore_csv(csv_file, plot=plot) for csv_file in csv_files}
 
-# List of all CSV files to explore
-csv_files = [f for f in os.listdir(RAW_DATA_DIR) if f.endswith('.csv')]
 
-# Explore each file
-for csv_file in csv_files:
-    explore_csv(csv_file)
-    
-print("\nExploration complete! Check the 'Exploratory' folder for visualizations.")
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    explore_all(plot='--plot' in sys.argv)
+    print("\nExploration complete! Check the 'Exploratory' folder for profiles.")
@@ -8,6 +8,11 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import classification_report, f1_score, precision_score, recall_score
 from Src import config
+from Src import storage
+from Src.Preprocessing.interning import EntityInterner
+from Src.Preprocessing.business_calendar import calendar_columns
+from Src.Feature_engineering.feature_store import FeatureStore, store_available
+from Src.Feature_engineering.baselines import DEVIATIONS_TABLE, join_deviations
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,23 +28,55 @@ class InsiderThreatDetector:
         self.X_test = None
         self.y_train = None
         self.y_test = None
+        self.model_columns = None
         
-    def load_features(self):
-        """Load the extracted features."""
-        features_path = config.FEATURES_DIR / "all_features.csv"
-        if not features_path.exists():
-            raise FileNotFoundError(f"Features file not found at {features_path}")
-            
+    def read_features(self, start=None, end=None):
+        """Read the extracted features, only those of the days in [start, end] when given.
+        
+        The day partitions of the feature store are read when it has been
+        published, so a range only opens the files of its days; otherwise the
+        all_features table is read whole and filtered.
+        """
+        store = FeatureStore("all_features")
+        if store_available() and store.exists():
+            features = store.scan(start, end)
+            # Deviations of each day from the user's own baseline
+            deviations = FeatureStore(DEVIATIONS_TABLE)
+            if deviations.exists():
+                features = join_deviations(features, deviations.scan(start, end))
+            return features
+        
+        if not storage.table_exists(config.FEATURES_DIR, "all_features"):
+            raise FileNotFoundError(f"Features table not found in {config.FEATURES_DIR}")
+        features = storage.read_table(config.FEATURES_DIR, "all_features", parse_dates=['timestamp'])
+        days = features['timestamp'].dt.normalize()
+        if start is not None:
+            features = features[days >= pd.Timestamp(start).normalize()]
+        if end is not None:
+            features = features[days <= pd.Timestamp(end).normalize()]
+        return features.reset_index(drop=True)
+    
+    def load_features(self, start=None, end=None):
+        """Load the extracted features (of the days in [start, end] when given) and label them."""
         logger.info("Loading features...")
-        self.features = pd.read_csv(features_path, parse_dates=['timestamp'])
+        self.features = self.read_features(start, end)
         logger.info(f"Loaded features with shape: {self.features.shape}")
         
-        # Check if we have decoy file access data for labeling
-        decoy_path = config.CLEANED_DATA_DIR / "decoy_file_cleaned.csv"
-        if decoy_path.exists():
-            decoy_df = pd.read_csv(decoy_path, parse_dates=['timestamp'])
-            # Mark users who accessed decoy files
-            self.features['is_anomaly'] = self.features['user'].isin(decoy_df['user']).astype(int)
+        # Label users who accessed decoy files, preferably from the decoy
+        # accesses saved by feature extraction
+        if storage.table_exists(config.FEATURES_DIR, "decoy_access"):
+            decoy_users = storage.read_table(config.FEATURES_DIR, "decoy_access", columns=['user'])['user']
+            self.features['is_anomaly'] = self.features['user'].isin(decoy_users).astype(int)
+            logger.info(f"Found {self.features['is_anomaly'].sum()} anomalous samples")
+        elif storage.table_exists(config.CLEANED_DATA_DIR, "decoy_file_cleaned") and \
+                storage.table_exists(config.CLEANED_DATA_DIR, "file_cleaned"):
+            decoy_df = storage.read_table(config.CLEANED_DATA_DIR, "decoy_file_cleaned", columns=['decoy_filename'])
+            file_df = storage.read_table(config.CLEANED_DATA_DIR, "file_cleaned", columns=['user_id', 'filename'])
+            # Mark users who accessed decoy files; the decoy table only lists
+            # files and PCs, so users come from the file access events
+            decoy_users = file_df.loc[file_df['filename'].isin(decoy_df['decoy_filename']), 'user_id'].unique()
+            decoy_users = EntityInterner.load().decode('user', decoy_users)
+            self.features['is_anomaly'] = self.features['user'].isin(decoy_users).astype(int)
             logger.info(f"Found {self.features['is_anomaly'].sum()} anomalous samples")
         else:
             logger.warning("No decoy file data found for labeling anomalies")
@@ -53,16 +90,14 @@ class InsiderThreatDetector:
         logger.info("Preprocessing data...")
         
         # Create time-based features
-        self.features['hour_sin'] = np.sin(2 * np.pi * self.features['hour_of_day']/24.0)
-        self.features['hour_cos'] = np.cos(2 * np.pi * self.features['hour_of_day']/24.0)
-        self.features['day_sin'] = np.sin(2 * np.pi * self.features['day_of_week']/7.0)
-        self.features['day_cos'] = np.cos(2 * np.pi * self.features['day_of_week']/7.0)
+        add_time_encodings(self.features)
         
         # Select features for training
         numeric_cols = self.features.select_dtypes(include=[np.number]).columns.tolist()
         # Remove non-feature columns
         non_feature_cols = ['user', 'timestamp', 'is_anomaly', 'hour_of_day', 'day_of_week']
         feature_cols = [col for col in numeric_cols if col not in non_feature_cols]
+        self.model_columns = feature_cols
         
         # Scale features
         X = self.features[feature_cols]
@@ -71,14 +106,15 @@ class InsiderThreatDetector:
         # Use decoy file access as labels if available
         self.y = self.features['is_anomaly'].values
         
-        # Split into train and test sets
+        # Split into train and test sets, keeping the row positions of the test set
+        rows = np.arange(len(self.features))
         if len(np.unique(self.y)) > 1:  # If we have both classes
-            self.X_train, self.X_test, self.y_train, self.y_test = train_test_split(
-                self.X_scaled, self.y, test_size=0.2, random_state=42, stratify=self.y
+            self.X_train, self.X_test, self.y_train, self.y_test, _, self.test_rows = train_test_split(
+                self.X_scaled, self.y, rows, test_size=0.2, random_state=42, stratify=self.y
             )
         else:  # If we only have one class (no anomalies found)
-            self.X_train, self.X_test = train_test_split(
-                self.X_scaled, test_size=0.2, random_state=42
+            self.X_train, self.X_test, _, self.test_rows = train_test_split(
+                self.X_scaled, rows, test_size=0.2, random_state=42
             )
             self.y_train, self.y_test = None, None
             
@@ -157,8 +193,10 @@ class InsiderThreatDetector:
         if self.model is None:
             raise ValueError("Model not trained. Call train_model() first.")
             
+        rows = None
         if X is None and hasattr(self, 'X_test'):
             X = self.X_test
+            rows = self.test_rows
         elif X is None:
             raise ValueError("No data provided for prediction")
             
@@ -178,11 +216,11 @@ class InsiderThreatDetector:
             'is_anomaly': (y_pred == -1).astype(int)
         })
         
-        # Add user and timestamp if available
-        if hasattr(self, 'features') and 'user' in self.features.columns:
-            results['user'] = self.features['user'].values
-        if hasattr(self, 'features') and 'timestamp' in self.features.columns:
-            results['timestamp'] = self.features['timestamp'].values
+        # Add user and timestamp of the test rows if available
+        if rows is not None and 'user' in self.features.columns:
+            results['user'] = self.features['user'].values[rows]
+        if rows is not None and 'timestamp' in self.features.columns:
+            results['timestamp'] = self.features['timestamp'].values[rows]
             
         return results
     
@@ -199,17 +237,40 @@ class InsiderThreatDetector:
         joblib.dump({
             'model': self.model,
             'scaler': self.scaler,
-            'feature_columns': self.features.columns.tolist()
+            'feature_columns': self.features.columns.tolist(),
+            'model_columns': self.model_columns
         }, model_path)
         logger.info(f"Model saved to {model_path}")
         
         # Also save predictions for analysis
         if hasattr(self, 'X_test'):
             predictions = self.predict_anomalies()
-            predictions_path = config.OUTPUTS_DIR / "anomaly_predictions.csv"
-            predictions.to_csv(predictions_path, index=False)
+            predictions_path = storage.write_table(predictions, config.OUTPUTS_DIR, "anomaly_predictions")
             logger.info(f"Predictions saved to {predictions_path}")
     
+    def score(self, start, end=None):
+        """Score the feature rows of the days in [start, end] with the saved model.
+        
+        Only the feature store partitions of those days are read, so daily
+        scoring and backtests over a range do not load the whole history.
+        """
+        saved = joblib.load(config.MODELS_DIR / "insider_threat_detector.joblib")
+        features = self.read_features(start, end if end is not None else start)
+        if features.empty:
+            logger.warning(f"No features between {start} and {end or start}")
+            return pd.DataFrame(columns=['user', 'timestamp', 'anomaly_score', 'is_anomaly'])
+        
+        add_time_encodings(features)
+        X = saved['scaler'].transform(features.reindex(columns=saved['model_columns'], fill_value=0))
+        results = pd.DataFrame({
+            'user': features['user'].values,
+            'timestamp': features['timestamp'].values,
+            'anomaly_score': -saved['model'].decision_function(X),  # Higher = more anomalous
+            'is_anomaly': (saved['model'].predict(X) == -1).astype(int)
+        })
+        logger.info(f"Scored {len(results):,} feature rows, {results['is_anomaly'].sum()} anomalous")
+        return results
+    
     def run(self):
         """Run the full training pipeline."""
         try:
@@ -223,6 +284,28 @@ class InsiderThreatDetector:
             logger.error(f"Error in training pipeline: {str(e)}", exc_info=True)
             return False
 
+def cyclical_table(period):
+    """sin and cos of every value 0 .. period-1, followed by 0 for missing values (-1)."""
+    angles = 2 * np.pi * np.arange(period) / period
+    return np.append(np.sin(angles), 0.0), np.append(np.cos(angles), 0.0)
+
+def add_time_encodings(features):
+    """Add cyclical encodings of the hour of day and day of week in place.
+    
+    The encodings are looked up from the int8 calendar columns of the
+    features; tables saved without them get them from the timestamps.
+    """
+    if 'hour_of_day' not in features.columns or 'day_of_week' not in features.columns:
+        calendar = calendar_columns(features['timestamp'])
+        features['hour_of_day'] = calendar['hour']
+        features['day_of_week'] = calendar['day_of_week']
+    for column, prefix, period in [('hour_of_day', 'hour', 24), ('day_of_week', 'day', 7)]:
+        values = features[column].fillna(-1).to_numpy(dtype=np.int64)
+        sin, cos = cyclical_table(period)
+        features[f'{prefix}_sin'] = sin[values]
+        features[f'{prefix}_cos'] = cos[values]
+    return features
+
 if __name__ == "__main__":
     detector = InsiderThreatDetector()
     success = detector.run()
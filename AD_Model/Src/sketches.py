@@ -0,0 +1,384 @@
+"""
+Mergeable streaming sketches.
+
+Each sketch is updated one chunk at a time with vectorized numpy work, keeps
+a bounded amount of state regardless of how many rows it has seen, and can
+be merged with another sketch of the same kind, so that sketches built on
+separate chunks, shards or time windows combine into the sketch of the
+union:
+
+- HyperLogLog: approximate distinct counts
+- HyperLogLogArray: one HyperLogLog per row, e.g. per user, updated together
+- SparseHyperLogLogArray: the same for many rows holding few values each,
+  e.g. per user and day, storing only the non-zero registers
+- QuantileSketch: approximate quantiles (a KLL-style compactor hierarchy)
+- TopK: heavy hitters with bounded count error (Misra-Gries summary)
+"""
+import base64
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# Hash key of pandas' value hashing; fixed so that sketches built in
+# different processes or runs hash values identically and stay mergeable
+HASH_KEY = '0123456789abcdef'
+
+
+def hash_values(values):
+    """64-bit hashes of a sequence of values, stable across processes."""
+    values = pd.Series(values) if not isinstance(values, pd.Series) else values
+    return pd.util.hash_pandas_object(values, index=False, hash_key=HASH_KEY).to_numpy()
+
+
+class HyperLogLog:
+    """Approximate distinct counter.
+
+    Uses 2**precision one-byte registers; the relative standard error of the
+    estimate is about 1.04 / sqrt(2**precision), 0.8% at the default 14.
+    """
+
+    # Hash bits used for the rank; 50 bits stay exact in float64 arithmetic
+    RANK_BITS = 50
+
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18")
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @property
+    def error(self):
+        """Relative standard error of count()."""
+        return 1.04 / np.sqrt(len(self.registers))
+
+    def update(self, values):
+        """Add the non-missing values of a sequence."""
+        values = pd.Series(values) if not isinstance(values, pd.Series) else values
+        self.update_hashes(hash_values(values.dropna()))
+        return self
+
+    def update_hashes(self, hashes):
+        """Add values given as precomputed uint64 hashes."""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(hashes) == 0:
+            return self
+        index, rank = _hll_positions(hashes, self.precision, self.RANK_BITS)
+        np.maximum.at(self.registers, index, rank)
+        return self
+
+    def merge(self, other):
+        """Fold another sketch of the same precision into this one."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches of different precision")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        """Estimated number of distinct values."""
+        return int(round(_hll_estimate(self.registers[np.newaxis, :])[0]))
+
+    def to_dict(self):
+        """JSON-serializable state."""
+        return {
+            'precision': self.precision,
+            'registers': base64.b64encode(zlib.compress(self.registers.tobytes())).decode('ascii')
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """Rebuild a sketch written by to_dict()."""
+        sketch = cls(state['precision'])
+        registers = np.frombuffer(zlib.decompress(base64.b64decode(state['registers'])), dtype=np.uint8)
+        sketch.registers = registers.copy()
+        return sketch
+
+
+class HyperLogLogArray:
+    """One HyperLogLog per row, kept as a 2-d register array.
+
+    Rows are dense integer keys such as interned user codes; values for many
+    rows are added in one vectorized update. The array grows as larger row
+    keys arrive. Row i of two arrays merges like two HyperLogLogs.
+    """
+
+    RANK_BITS = HyperLogLog.RANK_BITS
+
+    def __init__(self, precision=10, rows=0):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18")
+        self.precision = precision
+        self.registers = np.zeros((rows, 1 << precision), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.registers)
+
+    @property
+    def error(self):
+        """Relative standard error of each row's count."""
+        return 1.04 / np.sqrt(self.registers.shape[1])
+
+    def grow(self, rows):
+        """Make room for at least `rows` rows."""
+        if rows > len(self.registers):
+            extra = np.zeros((rows - len(self.registers), self.registers.shape[1]), dtype=np.uint8)
+            self.registers = np.concatenate([self.registers, extra])
+        return self
+
+    def update(self, rows, values):
+        """Add values to the sketches of their rows, skipping missing values."""
+        rows = np.asarray(rows, dtype=np.int64)
+        values = pd.Series(np.asarray(values))
+        present = values.notna().to_numpy()
+        return self.update_hashes(rows[present], hash_values(values[present]))
+
+    def update_hashes(self, rows, hashes):
+        """Add values given as precomputed uint64 hashes to their rows."""
+        rows = np.asarray(rows, dtype=np.int64)
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(rows) == 0:
+            return self
+        self.grow(int(rows.max()) + 1)
+        index, rank = _hll_positions(hashes, self.precision, self.RANK_BITS)
+        np.maximum.at(self.registers, (rows, index), rank)
+        return self
+
+    def merge(self, other):
+        """Fold another array of the same precision into this one, row by row."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches of different precision")
+        self.grow(len(other))
+        np.maximum(self.registers[:len(other)], other.registers, out=self.registers[:len(other)])
+        return self
+
+    def counts(self):
+        """Estimated number of distinct values of every row."""
+        if len(self.registers) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.rint(_hll_estimate(self.registers)).astype(np.int64)
+
+
+class SparseHyperLogLogArray:
+    """One HyperLogLog per row, stored as the non-zero registers of each row.
+
+    Meant for many small sets, such as the values of every (user, window):
+    a dense array needs 2**precision bytes per row, while this one needs at
+    most one (row, index, rank) entry per added value. Rows are merged by
+    regroup(), which maps every row onto a group of a coarser keying (e.g.
+    days onto weeks) and keeps the largest rank of each register, exactly as
+    merging the dense sketches would.
+    """
+
+    RANK_BITS = HyperLogLog.RANK_BITS
+
+    def __init__(self, precision=12, rows=None, index=None, rank=None):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18")
+        self.precision = precision
+        self.rows = np.zeros(0, dtype=np.int64) if rows is None else rows
+        self.index = np.zeros(0, dtype=np.int64) if index is None else index
+        self.rank = np.zeros(0, dtype=np.uint8) if rank is None else rank
+
+    @property
+    def error(self):
+        """Relative standard error of each row's count."""
+        return 1.04 / np.sqrt(1 << self.precision)
+
+    @classmethod
+    def from_values(cls, rows, values, precision=12):
+        """Sketch the values of each row, skipping missing values."""
+        rows = np.asarray(rows, dtype=np.int64)
+        values = pd.Series(np.asarray(values))
+        present = values.notna().to_numpy()
+        hashes = hash_values(values[present])
+        index, rank = _hll_positions(hashes, precision, cls.RANK_BITS)
+        return cls(precision, rows[present], index, rank)._compact()
+
+    def _compact(self):
+        """Keep one entry per (row, register), sorted, with the largest rank."""
+        if len(self.rows) == 0:
+            return self
+        keys = (self.rows << self.precision) | self.index
+        order = np.lexsort((self.rank, keys))
+        keys = keys[order]
+        # The last entry of each key has its largest rank
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        self.rows = keys[last] >> self.precision
+        self.index = keys[last] & ((1 << self.precision) - 1)
+        self.rank = self.rank[order][last]
+        return self
+
+    def regroup(self, groups):
+        """Merge the rows mapped onto the same group; returns the sketch of the groups."""
+        groups = np.asarray(groups, dtype=np.int64)
+        return SparseHyperLogLogArray(
+            self.precision, groups[self.rows], self.index.copy(), self.rank.copy()
+        )._compact()
+
+    def counts(self, n_rows):
+        """Estimated number of distinct values of rows 0..n_rows-1."""
+        m = 1 << self.precision
+        inverse_sum = np.bincount(self.rows, np.ldexp(1.0, -self.rank.astype(np.int64)), minlength=n_rows)
+        nonzero = np.bincount(self.rows, minlength=n_rows)
+        zeros = m - nonzero
+        estimate = _hll_correct(m, inverse_sum + zeros, zeros)
+        return np.where(nonzero > 0, np.rint(estimate), 0).astype(np.int64)
+
+
+def _hll_positions(hashes, precision, rank_bits):
+    """Register index and rank of each hash."""
+    index = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    low = (hashes & np.uint64((1 << rank_bits) - 1)).astype(np.float64)
+    # Position of the first 1-bit in the low bits (rank_bits + 1 when all zero)
+    rank = (rank_bits + 1 - np.frexp(low)[1]).astype(np.uint8)
+    return index, rank
+
+
+def _hll_estimate(registers):
+    """HyperLogLog estimates of the rows of a 2-d register array."""
+    m = registers.shape[1]
+    inverse_sum = np.ldexp(1.0, -registers.astype(np.int64)).sum(axis=1)
+    zeros = np.count_nonzero(registers == 0, axis=1)
+    return _hll_correct(m, inverse_sum, zeros)
+
+
+def _hll_correct(m, inverse_sum, zeros):
+    """Raw HyperLogLog estimates from the sums of 2**-register, with the small-range correction."""
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / inverse_sum
+    # Small-range correction: linear counting
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((estimate <= 2.5 * m) & (zeros > 0), linear, estimate)
+
+
+class QuantileSketch:
+    """Approximate quantiles of a numeric stream.
+
+    Values live in levels of at most k items; an item on level h stands for
+    2**h original values. A full level is sorted and every other item, from
+    a random offset, is promoted to the next level. Rank error is about
+    1 / k of the stream length per level in use, so k=256 gives quantiles
+    within roughly one percentile on large files.
+    """
+
+    def __init__(self, k=256, seed=0):
+        self.k = k
+        self.levels = []
+        self.n = 0
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        """Add the finite values of a numeric sequence."""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+        self.n += len(values)
+        self._add(0, values)
+        self._compact()
+        return self
+
+    def _add(self, level, values):
+        while len(self.levels) <= level:
+            self.levels.append(np.empty(0, dtype=np.float64))
+        self.levels[level] = np.concatenate([self.levels[level], values])
+
+    def _compact(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.k:
+                items = np.sort(items)
+                # An odd item out stays on its level
+                keep = items[:len(items) % 2]
+                offset = int(self.rng.integers(2))
+                self.levels[level] = keep
+                self._add(level + 1, items[len(keep) + offset::2])
+            level += 1
+
+    def merge(self, other):
+        """Fold another quantile sketch into this one."""
+        for level, items in enumerate(other.levels):
+            self._add(level, items)
+        self.n += other.n
+        self._compact()
+        return self
+
+    def quantiles(self, qs):
+        """Approximate values at the quantiles qs (NaN when empty)."""
+        qs = np.asarray(qs, dtype=np.float64)
+        if self.n == 0:
+            return np.full(len(qs), np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([
+            np.full(len(items), 2.0 ** level) for level, items in enumerate(self.levels)
+        ])
+        order = np.argsort(values, kind='stable')
+        values, cumulative = values[order], np.cumsum(weights[order])
+        positions = np.searchsorted(cumulative, qs * cumulative[-1], side='left')
+        return values[np.minimum(positions, len(values) - 1)]
+
+    def to_dict(self):
+        """JSON-serializable state."""
+        return {'k': self.k, 'n': self.n, 'levels': [items.tolist() for items in self.levels]}
+
+    @classmethod
+    def from_dict(cls, state):
+        """Rebuild a sketch written by to_dict()."""
+        sketch = cls(state['k'])
+        sketch.n = state['n']
+        sketch.levels = [np.asarray(items, dtype=np.float64) for items in state['levels']]
+        return sketch
+
+
+class TopK:
+    """Most frequent values with bounded count error (Misra-Gries summary).
+
+    At most `capacity` counters are kept. Every reported count is an
+    underestimate by at most error_bound(), which is the number of rows seen
+    divided by capacity + 1.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype=np.int64)
+        self.n = 0
+        self.decrement = 0
+
+    def update(self, values):
+        """Add the non-missing values of a sequence."""
+        values = pd.Series(values) if not isinstance(values, pd.Series) else values
+        counts = values.value_counts(dropna=True, sort=False)
+        self.n += int(counts.sum())
+        return self._combine(counts)
+
+    def _combine(self, counts):
+        counts = counts.astype(np.int64)
+        counts.index = counts.index.astype(object)
+        combined = self.counts.add(counts, fill_value=0).astype(np.int64)
+        if len(combined) > self.capacity:
+            # Subtracting the (capacity + 1)-th largest count keeps at most
+            # `capacity` positive counters
+            cut = int(np.partition(combined.to_numpy(), -(self.capacity + 1))[-(self.capacity + 1)])
+            combined = combined - cut
+            combined = combined[combined > 0]
+            self.decrement += cut
+        self.counts = combined
+        return self
+
+    def merge(self, other):
+        """Fold another summary into this one."""
+        self.n += other.n
+        self.decrement += other.decrement
+        return self._combine(other.counts)
+
+    def error_bound(self):
+        """Largest possible undercount of any reported count."""
+        return self.decrement
+
+    def top(self, k=10):
+        """The k most frequent values as (value, count) pairs."""
+        top = self.counts.sort_values(ascending=False, kind='stable').head(k)
+        return list(zip(top.index.tolist(), top.to_numpy().tolist()))
@@ -0,0 +1,263 @@
+"""
+Content-addressed cache of pipeline stage outputs.
+
+A stage's key hashes the fingerprints of its inputs (size, mtime and a fast
+content hash of each file, or the key of the upstream stage) together with
+the config parameters that affect it. When a stage runs, its outputs are
+stored under Data/Cache/<stage>/<key>. On a later run a stage whose key
+matches the outputs currently in place is skipped, and one whose key is in
+the cache has its outputs restored instead of being recomputed. Entries are
+evicted least recently used first once the cache exceeds its disk budget.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+
+from Src import config
+
+logger = logging.getLogger(__name__)
+
+# Bytes hashed from each sampled block of an input file
+SAMPLE_BYTES = 65536
+
+# Blocks sampled between the first and last block of large files
+SAMPLE_BLOCKS = 16
+
+MANIFEST_FILE = 'manifest.json'
+CURRENT_FILE = 'current.json'
+
+
+def fast_file_hash(path):
+    """Hash the size and evenly spaced blocks of a file.
+
+    Reads at most (SAMPLE_BLOCKS + 2) * SAMPLE_BYTES bytes, so large raw
+    files are fingerprinted in milliseconds. Files up to that size are
+    hashed in full.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        if size <= (SAMPLE_BLOCKS + 2) * SAMPLE_BYTES:
+            digest.update(f.read())
+        else:
+            step = (size - SAMPLE_BYTES) // (SAMPLE_BLOCKS + 1)
+            for i in range(SAMPLE_BLOCKS + 2):
+                f.seek(min(i * step, size - SAMPLE_BYTES))
+                digest.update(f.read(SAMPLE_BYTES))
+    return digest.hexdigest()
+
+
+def fingerprint(path):
+    """Fingerprint of a file or directory tree: size, mtime and fast content hash per file."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    files = [path] if path.is_file() else sorted(p for p in path.rglob('*') if p.is_file())
+    return [
+        [str(p.relative_to(path)) if p != path else p.name, p.stat().st_size,
+         p.stat().st_mtime_ns, fast_file_hash(p)]
+        for p in files
+    ]
+
+
+def params_hash(params):
+    """Stable hash of JSON-like config parameters."""
+    encoded = json.dumps(params, sort_keys=True, default=repr).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def stage_key(stage, inputs=(), upstream=(), params=None):
+    """Cache key of a stage run.
+
+    inputs are paths fingerprinted from disk; upstream are keys of the
+    stages whose outputs this stage reads, which already cover those inputs.
+    """
+    return params_hash({
+        'stage': stage,
+        'inputs': {str(path): fingerprint(path) for path in inputs},
+        'upstream': list(upstream),
+        'params': params_hash(params or {})
+    })
+
+
+def outputs_hash(outputs):
+    """Hash of the fingerprints of a list of output paths."""
+    return params_hash([fingerprint(path) for path in outputs])
+
+
+def link_or_copy(src, dst):
+    """Hard-link Parquet part files, which are never modified in place; copy the rest."""
+    if str(src).endswith('.parquet'):
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def copy_path(src, dst):
+    """Copy a file or directory tree, replacing dst."""
+    src, dst = Path(src), Path(dst)
+    remove_path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if src.is_dir():
+        shutil.copytree(src, dst, copy_function=link_or_copy)
+    else:
+        link_or_copy(src, dst)
+
+
+def remove_path(path):
+    """Delete a file or directory tree if it exists."""
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def path_size(path):
+    """Size of a file or directory tree in bytes."""
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+
+
+class StageCache:
+    """Stage outputs stored by key, with LRU eviction by disk budget."""
+
+    def __init__(self, root=None, budget_mb=None):
+        params = config.CACHE_PARAMS
+        self.root = Path(root or config.CACHE_DIR)
+        self.budget_bytes = (budget_mb or params.get('budget_mb', 20480)) * 1024 * 1024
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def entry_dir(self, stage, key):
+        """Directory of one cached stage run."""
+        return self.root / stage / key
+
+    def _load_current(self):
+        path = self.root / CURRENT_FILE
+        if not path.exists():
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def is_current(self, stage, key, outputs):
+        """Whether the outputs in place were produced by the run with this key.
+
+        The outputs are fingerprinted too, so outputs overwritten by another
+        script (e.g. quick_clean) are not mistaken for the cached run.
+        """
+        current = self._load_current().get(stage)
+        return current is not None and current['key'] == key and \
+            current['outputs'] == outputs_hash(outputs)
+
+    def mark_current(self, stage, key, outputs):
+        """Record that the outputs in place belong to the run with this key."""
+        current = self._load_current()
+        current[stage] = {'key': key, 'outputs': outputs_hash(outputs)}
+        tmp_path = self.root / f'{CURRENT_FILE}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(current, f, indent=2)
+        os.replace(tmp_path, self.root / CURRENT_FILE)
+
+    def contains(self, stage, key):
+        """Whether a complete entry exists for the key."""
+        return (self.entry_dir(stage, key) / MANIFEST_FILE).exists()
+
+    def _touch(self, entry):
+        manifest_path = entry / MANIFEST_FILE
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        manifest['last_used'] = time.time()
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+    def store(self, stage, key, outputs):
+        """Store the outputs of a finished stage run under its key."""
+        entry = self.entry_dir(stage, key)
+        tmp_entry = entry.with_name(f'{key}.tmp')
+        remove_path(tmp_entry)
+        tmp_entry.mkdir(parents=True)
+
+        stored = {}
+        for i, output in enumerate(outputs):
+            output = Path(output)
+            if not output.exists():
+                continue
+            name = f'{i:02d}_{output.name}'
+            copy_path(output, tmp_entry / name)
+            stored[name] = str(output)
+
+        manifest = {
+            'stage': stage,
+            'key': key,
+            'outputs': stored,
+            'bytes': path_size(tmp_entry),
+            'created': time.time(),
+            'last_used': time.time()
+        }
+        with open(tmp_entry / MANIFEST_FILE, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        # The manifest marks a complete entry, so a crash never leaves a partial one visible
+        remove_path(entry)
+        os.replace(tmp_entry, entry)
+        logger.info(f"Cached {stage} outputs under {key[:12]} ({manifest['bytes'] / 1024 / 1024:.1f} MB)")
+        self.evict(keep=entry)
+
+    def restore(self, stage, key):
+        """Put the cached outputs of a run back in place."""
+        entry = self.entry_dir(stage, key)
+        manifest = self._touch(entry)
+        for name, target in manifest['outputs'].items():
+            copy_path(entry / name, target)
+        logger.info(f"Restored {stage} outputs from cache ({key[:12]})")
+
+    def entries(self):
+        """Manifests of all complete entries."""
+        manifests = []
+        for manifest_path in self.root.glob(f'*/*/{MANIFEST_FILE}'):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            manifest['path'] = manifest_path.parent
+            manifests.append(manifest)
+        return manifests
+
+    def evict(self, keep=None):
+        """Delete least recently used entries until the cache fits its budget."""
+        entries = sorted(self.entries(), key=lambda m: m['last_used'])
+        total = sum(m['bytes'] for m in entries)
+        for manifest in entries:
+            if total <= self.budget_bytes:
+                break
+            if keep is not None and Path(manifest['path']) == Path(keep):
+                continue
+            remove_path(manifest['path'])
+            total -= manifest['bytes']
+            logger.info(f"Evicted cached {manifest['stage']} outputs {manifest['key'][:12]}")
+        return total
+
+    def run(self, stage, key, outputs, fn, force=False):
+        """Run a stage unless its outputs for this key are in place or cached.
+
+        Returns 'skipped', 'restored' or 'ran'.
+        """
+        if not force and self.is_current(stage, key, outputs):
+            logger.info(f"{stage}: inputs and parameters unchanged; skipping")
+            return 'skipped'
+        if not force and self.contains(stage, key):
+            self.restore(stage, key)
+            self.mark_current(stage, key, outputs)
+            return 'restored'
+
+        fn()
+        self.store(stage, key, outputs)
+        self.mark_current(stage, key, outputs)
+        return 'ran'
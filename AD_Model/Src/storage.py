@@ -0,0 +1,289 @@
+"""
+Columnar table storage shared by the cleaning, feature and training stages.
+
+Tables are written as Parquet datasets: a directory ``<name>.parquet`` holding
+one or more part files. Types (including datetimes) survive the round trip and
+reads can be limited to a subset of columns. CSV stays available either as an
+extra export next to the Parquet data or as the only format.
+"""
+import os
+import shutil
+import logging
+from pathlib import Path
+
+import pandas as pd
+from Src import config
+from Src.Preprocessing.timestamps import parse_column
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+
+def get_format(fmt=None):
+    """Return the storage format to use, falling back to CSV without pyarrow."""
+    fmt = fmt or config.STORAGE_PARAMS.get('format', 'parquet')
+    if fmt == 'parquet' and pq is None:
+        logger.warning("pyarrow is not installed; falling back to CSV storage")
+        return 'csv'
+    return fmt
+
+
+def parquet_path(directory, name):
+    """Path of the Parquet dataset directory for a table."""
+    return Path(directory) / f'{name}.parquet'
+
+
+def csv_path(directory, name):
+    """Path of the CSV file for a table."""
+    return Path(directory) / f'{name}.csv'
+
+
+def table_exists(directory, name):
+    """Check whether a table has been written in any format."""
+    return parquet_path(directory, name).exists() or csv_path(directory, name).exists()
+
+
+def list_parts(directory, name):
+    """Return the part files of a Parquet table in write order."""
+    path = parquet_path(directory, name)
+    if not path.exists():
+        return []
+    return sorted(path.glob('part-*.parquet'))
+
+
+def remove_table(directory, name):
+    """Delete a table in all formats."""
+    path = parquet_path(directory, name)
+    if path.exists():
+        shutil.rmtree(path)
+    path = csv_path(directory, name)
+    if path.exists():
+        path.unlink()
+
+
+class TableWriter:
+    """Write a table chunk by chunk.
+
+    In Parquet format every writer session produces one part file made of row
+    groups, one per chunk. The schema is pinned by the first chunk (or by the
+    existing parts when appending) so that later chunks, whose dtypes pandas
+    may infer differently, are cast to the same types.
+    """
+
+    def __init__(self, directory, name, append=False, fmt=None, export_csv=None):
+        self.directory = Path(directory)
+        self.name = name
+        self.append = append
+        self.fmt = get_format(fmt)
+        if export_csv is None:
+            export_csv = config.STORAGE_PARAMS.get('export_csv', False)
+        self.write_csv = self.fmt == 'csv' or export_csv
+        self.compression = config.STORAGE_PARAMS.get('compression', 'snappy')
+        self.rows = 0
+        self._writer = None
+        self._schema = None
+        self._csv_started = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def open(self):
+        """Prepare the output location."""
+        os.makedirs(self.directory, exist_ok=True)
+        if not self.append:
+            remove_table(self.directory, self.name)
+
+        if self.fmt == 'parquet':
+            parts = list_parts(self.directory, self.name)
+            if parts:
+                self._schema = pq.read_schema(parts[0])
+            path = parquet_path(self.directory, self.name)
+            path.mkdir(parents=True, exist_ok=True)
+            self._part_path = path / f'part-{len(parts):05d}.parquet'
+
+        self._csv_started = self.append and csv_path(self.directory, self.name).exists()
+        return self
+
+    def _to_arrow(self, df):
+        """Convert a chunk to Arrow, conforming it to the pinned schema."""
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._schema is None:
+            # Columns that are entirely empty in the first chunk have no type
+            # yet; CERT only has text columns that can be empty
+            fields = [
+                pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f
+                for f in table.schema
+            ]
+            # Category columns get a wide index type so that later chunks
+            # with more categories still fit the pinned schema
+            fields = [
+                pa.field(f.name, pa.dictionary(pa.int32(), f.type.value_type))
+                if pa.types.is_dictionary(f.type) else f
+                for f in fields
+            ]
+            self._schema = pa.schema(fields)
+            return table.cast(self._schema)
+
+        columns = []
+        for field in self._schema:
+            if field.name not in table.column_names:
+                columns.append(pa.nulls(len(table), type=field.type))
+                continue
+            column = table.column(field.name)
+            if column.type != field.type:
+                if column.null_count == len(column):
+                    column = pa.nulls(len(column), type=field.type)
+                else:
+                    column = column.cast(field.type)
+            columns.append(column)
+        return pa.Table.from_arrays(columns, schema=self._schema)
+
+    def write(self, df):
+        """Append one chunk to the table."""
+        if df is None or df.empty:
+            return
+
+        if self.fmt == 'parquet':
+            table = self._to_arrow(df)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(
+                    self._part_path, self._schema, compression=self.compression
+                )
+            self._writer.write_table(table)
+
+        if self.write_csv:
+            df.to_csv(
+                csv_path(self.directory, self.name),
+                mode='a' if self._csv_started else 'w',
+                header=not self._csv_started,
+                index=False
+            )
+            self._csv_started = True
+
+        self.rows += len(df)
+
+    def close(self):
+        """Finish the current part file."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def write_table(df, directory, name, fmt=None, export_csv=None):
+    """Write a whole table, replacing any previous version."""
+    with TableWriter(directory, name, fmt=fmt, export_csv=export_csv) as writer:
+        writer.write(df)
+    return parquet_path(directory, name) if writer.fmt == 'parquet' else csv_path(directory, name)
+
+
+def append_table(df, directory, name, fmt=None, export_csv=None):
+    """Append rows to a table as a new part."""
+    with TableWriter(directory, name, append=True, fmt=fmt, export_csv=export_csv) as writer:
+        writer.write(df)
+    return writer.rows
+
+
+def read_table(directory, name, columns=None, parse_dates=None):
+    """Read a table, preferring Parquet and reading only the requested columns.
+
+    parse_dates only matters for the CSV fallback; Parquet keeps datetime
+    columns typed.
+    """
+    path = parquet_path(directory, name)
+    if path.exists() and pq is not None:
+        parts = list_parts(directory, name)
+        if not parts:
+            return pd.DataFrame(columns=columns or [])
+        if columns is not None:
+            available = set(pq.read_schema(parts[0]).names)
+            columns = [c for c in columns if c in available]
+        return pq.read_table(path, columns=columns).to_pandas()
+
+    path = csv_path(directory, name)
+    if path.exists():
+        usecols = None
+        if columns is not None:
+            wanted = set(columns)
+            usecols = lambda c: c in wanted
+        df = pd.read_csv(path, usecols=usecols, low_memory=False)
+        for col in parse_dates or []:
+            if col in df.columns:
+                parse_column(df, col)
+        return df
+
+    raise FileNotFoundError(f"Table {name} not found in {directory}")
+
+
+def part_stats(directory, name):
+    """[file name, size, mtime] of each stored part of a table, in write order.
+
+    Tables only ever grow by new parts, so a previous listing that is a
+    prefix of the current one means rows were appended; anything else means
+    the table was rewritten. A CSV table is listed as its single file.
+    """
+    directory = Path(directory)
+    paths = list_parts(directory, name)
+    if not paths and csv_path(directory, name).exists():
+        paths = [csv_path(directory, name)]
+    return [[str(path.relative_to(directory)), path.stat().st_size, path.stat().st_mtime_ns]
+            for path in paths]
+
+
+def read_part(part, columns=None):
+    """Read one part file of a Parquet table, limited to the columns it has."""
+    if columns is not None:
+        available = set(pq.read_schema(part).names)
+        columns = [c for c in columns if c in available]
+    return pq.read_table(part, columns=columns).to_pandas()
+
+
+def iter_table(directory, name, columns=None, batch_rows=250000):
+    """Yield a table as DataFrames of at most batch_rows rows."""
+    parts = list_parts(directory, name)
+    if parts and pq is not None:
+        for part in parts:
+            parquet_file = pq.ParquetFile(part)
+            part_columns = columns
+            if columns is not None:
+                part_columns = [c for c in columns if c in parquet_file.schema_arrow.names]
+            for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=part_columns):
+                yield batch.to_pandas()
+        return
+
+    path = csv_path(directory, name)
+    if not path.exists():
+        raise FileNotFoundError(f"Table {name} not found in {directory}")
+    usecols = None
+    if columns is not None:
+        wanted = set(columns)
+        usecols = lambda c: c in wanted
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=batch_rows, low_memory=False):
+        yield chunk
+
+
+def replace_table(directory, source, target):
+    """Move table source over table target, replacing it."""
+    remove_table(directory, target)
+    for src, dst in [(parquet_path(directory, source), parquet_path(directory, target)),
+                     (csv_path(directory, source), csv_path(directory, target))]:
+        if src.exists():
+            os.replace(src, dst)
+
+
+def table_size(directory, name):
+    """Size of a table on disk in bytes."""
+    path = parquet_path(directory, name)
+    if path.exists():
+        return sum(p.stat().st_size for p in path.glob('*.parquet'))
+    path = csv_path(directory, name)
+    return path.stat().st_size if path.exists() else 0
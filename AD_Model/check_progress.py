@@ -2,14 +2,20 @@
 import os
 from pathlib import Path
 
+def path_size(path):
+    """Size in bytes of a file or a Parquet dataset directory."""
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.glob("*.parquet"))
+    return path.stat().st_size
+
 # Check cleaned data files
 cleaned_dir = Path("Data/Cleaned")
 if cleaned_dir.exists():
     print("\n=== CLEANED DATA FILES ===")
-    files = list(cleaned_dir.glob("*.csv"))
+    files = list(cleaned_dir.glob("*.parquet")) + list(cleaned_dir.glob("*.csv"))
     if files:
         for f in files:
-            size_mb = f.stat().st_size / (1024 * 1024)
+            size_mb = path_size(f) / (1024 * 1024)
             print(f"✓ {f.name:<30} {size_mb:>10.2f} MB")
     else:
         print("No cleaned files yet")
@@ -20,10 +26,10 @@ else:
 features_dir = Path("Data/Features")
 if features_dir.exists():
     print("\n=== FEATURE FILES ===")
-    files = list(features_dir.glob("*.csv"))
+    files = list(features_dir.glob("*.parquet")) + list(features_dir.glob("*.csv"))
     if files:
         for f in files:
-            size_mb = f.stat().st_size / (1024 * 1024)
+            size_mb = path_size(f) / (1024 * 1024)
             print(f"✓ {f.name:<30} {size_mb:>10.2f} MB")
     else:
         print("No feature files yet")
@@ -3,7 +3,6 @@ Quick data cleaning with sampling for faster processing
 Use this for development/testing with large datasets
 """
 import os
-import pandas as pd
 import logging
 from pathlib import Path
 import sys
@@ -11,11 +10,18 @@ import sys
 # Add project root to path
 sys.path.insert(0, str(Path(__file__).parent))
 from Src import config
+from Src import storage
+from Src.Preprocessing.interning import EntityInterner
+from Src.Preprocessing.data_cleaning import CLEANED_NAMES, FRAME_CLEANERS, DERIVED_TABLES
+from Src.Preprocessing.sampling import sample_file
+from Src.Preprocessing.ingestion import clear_watermarks
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Sample sizes for large files (set to None to process all data)
+# Row budgets for large files (None = no row budget). The budgets apply to
+# the 'reservoir' and stratified sampling methods; the default 'user_subset'
+# method keeps every event of a hashed subset of users instead.
 SAMPLE_SIZES = {
     'users': None,  # Small file, process all
     'logon': 500000,  # Sample 500k rows instead of 3.5M
@@ -30,6 +36,10 @@ def quick_clean():
     logger.info("Starting QUICK data cleaning with sampling...")
     
     os.makedirs(config.CLEANED_DATA_DIR, exist_ok=True)
+    interner = EntityInterner()
+    
+    # Sampled tables are never a base for incremental appends
+    clear_watermarks()
     
     for name, path in config.RAW_FILES.items():
         if not path.exists():
@@ -38,106 +48,50 @@ def quick_clean():
             
         logger.info(f"\nProcessing {name}...")
         
-        # Determine sample size
+        # Determine row budget
         sample_size = SAMPLE_SIZES.get(name)
         
         try:
-            # Read with sampling if specified
-            if sample_size:
-                logger.info(f"  Sampling {sample_size:,} rows from {name}")
-                df = pd.read_csv(path, nrows=sample_size, low_memory=False)
-            else:
-                logger.info(f"  Loading all data from {name}")
-                df = pd.read_csv(path, low_memory=False)
+            # Sample in one streaming pass; users are chosen consistently
+            # across sources so a sampled user keeps their events together
+            df = sample_file(path, name, budget=sample_size)
             
             logger.info(f"  Loaded: {df.shape}")
+            parsers = {}
+            cleaned_name = CLEANED_NAMES.get(name, name)
+            
+            # Same schema-driven cleaning rules as the full cleaner
+            df = FRAME_CLEANERS[cleaned_name](df, parsers)
+            
+            for parser in parsers.values():
+                parser.report(name)
             
-            # Apply column renaming based on file type
-            if name == 'users':
-                df.rename(columns={
-                    'employee_name': 'name',
-                    'supervisor': 'supervisor_id'
-                }, inplace=True)
-                df['start_date'] = pd.to_datetime(df['start_date'], errors='coerce')
-                df['end_date'] = pd.to_datetime(df['end_date'], errors='coerce')
-                df['end_date'].fillna(pd.Timestamp('2100-01-01'), inplace=True)
-                df['role'] = df['role'].fillna('Employee')
-                
-            elif name == 'logon':
-                df.rename(columns={
-                    'id': 'logon_id',
-                    'date': 'timestamp',
-                    'user': 'user_id',
-                    'pc': 'device_id',
-                    'activity': 'logon_type'
-                }, inplace=True)
-                df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-                df['logon_type'] = df['logon_type'].fillna('Unknown')
-                
-            elif name == 'device':
-                df.rename(columns={
-                    'id': 'device_event_id',
-                    'date': 'timestamp',
-                    'user': 'user_id',
-                    'pc': 'device_id',
-                    'file_tree': 'file_path',
-                    'activity': 'activity_type'
-                }, inplace=True)
-                df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-                df['activity_type'] = df['activity_type'].fillna('Unknown')
-                df['file_path'] = df['file_path'].fillna('Unknown')
-                
-            elif name == 'email':
-                df.rename(columns={
-                    'id': 'email_id',
-                    'date': 'timestamp',
-                    'user': 'sender_id',
-                    'to': 'recipient_id',
-                    'cc': 'cc_recipients',
-                    'bcc': 'bcc_recipients',
-                    'attachments': 'has_attachments',
-                    'size': 'email_size'
-                }, inplace=True)
-                df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-                df['cc_recipients'] = df['cc_recipients'].fillna('')
-                df['bcc_recipients'] = df['bcc_recipients'].fillna('')
-                df['has_attachments'] = df['has_attachments'].fillna(False)
-                
-            elif name == 'file':
-                df.rename(columns={
-                    'id': 'file_event_id',
-                    'date': 'timestamp',
-                    'user': 'user_id',
-                    'pc': 'device_id',
-                    'activity': 'activity_type',
-                    'size': 'file_size'
-                }, inplace=True)
-                df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-                df['activity_type'] = df['activity_type'].fillna('Unknown')
-                if 'filename' in df.columns:
-                    df['file_extension'] = df['filename'].str.extract(r'\.(\w+)$', expand=False)
-                
-            elif name == 'decoy_file':
-                df.rename(columns={
-                    'decoy_filename': 'decoy_filename',
-                    'pc': 'device_id'
-                }, inplace=True)
-                df['is_suspicious'] = True
+            # Recipient edges and other derived tables
+            derived = {}
+            for table, builder in DERIVED_TABLES.get(cleaned_name, {}).items():
+                derived[table] = interner.encode_frame(builder(df), table)
+            
+            # Replace user/PC/address strings with shared int32 codes
+            interner.encode_frame(df, cleaned_name)
+            for table, derived_df in derived.items():
+                storage.write_table(derived_df, config.CLEANED_DATA_DIR, f'{table}_cleaned')
+                logger.info(f"  ✓ Saved {table} (shape: {derived_df.shape})")
             
             # Save cleaned data
-            output_path = os.path.join(config.CLEANED_DATA_DIR, f'{name}_cleaned.csv')
-            df.to_csv(output_path, index=False)
+            output_path = storage.write_table(df, config.CLEANED_DATA_DIR, f'{cleaned_name}_cleaned')
             logger.info(f"  ✓ Saved to {output_path} (shape: {df.shape})")
             
         except Exception as e:
             logger.error(f"  ✗ Error processing {name}: {str(e)}")
             continue
     
+    interner.save()
+    
     logger.info("\n" + "="*60)
     logger.info("QUICK DATA CLEANING COMPLETED!")
     logger.info("="*60)
     logger.info(f"Cleaned data saved to: {config.CLEANED_DATA_DIR}")
-    logger.info("\nNote: Large files were sampled for faster processing.")
+    logger.info(f"\nNote: Data was sampled ({config.SAMPLING_PARAMS['method']}) for faster processing.")
     logger.info("For production, use the full data cleaning script.")
 
 if __name__ == "__main__":
@@ -7,61 +7,111 @@ import numpy as np
 import os
 import sys
 import logging
+import time as timer
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from datetime import time
 
 sys.path.insert(0, str(Path(__file__).parent))
 from Src import config
+from Src import storage
+from Src.Preprocessing.interning import EntityInterner
+from Src.Preprocessing.email_edges import recipient_summary
+from Src.Preprocessing.business_calendar import ensure_calendar_columns, known_hours
+from Src.Feature_engineering.feature_state import refresh_state
+from Src.Feature_engineering.peer_groups import refresh_peer_groups
+from Src.Feature_engineering.feature_extraction import extraction_workers, distinct_error
+from Src.sketches import HyperLogLogArray
+from Src.Preprocessing.sharding import usable_shards, shard_dir
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def load_cleaned_data():
-    """Load all cleaned data files."""
+# Cleaned table of each dataset
+TABLES = {
+    'users': 'users_cleaned',
+    'logon': 'logon_cleaned',
+    'device': 'device_cleaned',
+    'email': 'email_cleaned',
+    'file': 'file_cleaned',
+    'decoy': 'decoy_file_cleaned',
+    'email_edges': 'email_edges_cleaned'
+}
+
+def load_cleaned_data(names=None, directory=None):
+    """Load all cleaned data files (only the datasets in names, when given).
+    
+    directory defaults to the cleaned data; a user shard directory holds
+    tables of the same names.
+    """
     logger.info("Loading cleaned data...")
+    directory = directory or config.CLEANED_DATA_DIR
     data = {}
     
-    files = {
-        'users': 'users_cleaned.csv',
-        'logon': 'logon_cleaned.csv',
-        'device': 'device_cleaned.csv',
-        'email': 'email_cleaned.csv',
-        'file': 'file_cleaned.csv',
-        'decoy': 'decoy_cleaned.csv'
-    }
-    
-    for name, filename in files.items():
-        file_path = config.CLEANED_DATA_DIR / filename
-        if file_path.exists():
-            data[name] = pd.read_csv(file_path)
-            # Convert timestamp columns
-            if 'timestamp' in data[name].columns:
-                data[name]['timestamp'] = pd.to_datetime(data[name]['timestamp'])
+    tables = {name: table for name, table in TABLES.items() if names is None or name in names}
+    
+    for name, table in tables.items():
+        if storage.table_exists(directory, table):
+            data[name] = storage.read_table(directory, table, parse_dates=['timestamp'])
             logger.info(f"  Loaded {name}: {data[name].shape}")
         else:
-            logger.warning(f"  File not found: {filename}")
+            logger.warning(f"  Table not found: {table}")
     
     return data
 
+def sketch_precision():
+    """HyperLogLog precision of the unique_* features, or None when they are counted exactly."""
+    if config.FEATURE_PARAMS.get('distinct_counts') != 'approx':
+        return None
+    return config.FEATURE_PARAMS.get('sketch_precision', 12)
+
+def distinct_counts(df, key, column):
+    """Distinct values of column per key, exact or estimated per FEATURE_PARAMS['distinct_counts']."""
+    precision = sketch_precision()
+    if precision is None:
+        return df.groupby(key)[column].nunique()
+    codes, keys = pd.factorize(df[key])
+    keyed = codes >= 0
+    sketch = HyperLogLogArray(precision, len(keys)).update(codes[keyed], df[column].to_numpy()[keyed])
+    return pd.Series(sketch.counts(), index=keys).sort_index()
+
+def activity_columns(df, key, column, prefix):
+    """Per-key count and share of each value of a categorical column.
+    
+    Returns one '<prefix>=<value>' count column per value followed by the
+    matching '<prefix>=<value>_ratio' shares of the key's events, values in
+    sorted order; values that never occur get no column.
+    """
+    counts = df.groupby([key, column], observed=True).size().unstack(fill_value=0)
+    counts = counts[sorted(counts.columns, key=str)]
+    ratios = counts.div(counts.sum(axis=1), axis=0)
+    counts.columns = [f'{prefix}={value}' for value in counts.columns]
+    ratios.columns = [f'{name}_ratio' for name in counts.columns]
+    features = pd.concat([counts, ratios], axis=1).reset_index()
+    features.columns.name = None
+    return features
+
+def order_activity_columns(features):
+    """Put the activity count and ratio columns in the order activity_columns() emits."""
+    activity = [col for col in features.columns if '=' in col]
+    counts = sorted(col for col in activity if not col.endswith('_ratio'))
+    ratios = [f'{col}_ratio' for col in counts if f'{col}_ratio' in features.columns]
+    return features[[col for col in features.columns if '=' not in col] + counts + ratios]
+
 def extract_logon_features(logon_df):
     """Extract features from logon data."""
     logger.info("Extracting logon features...")
     
     features = logon_df.groupby('user_id').agg({
-        'logon_id': 'count',  # Total logons
-        'device_id': 'nunique',  # Unique devices used
-        'logon_type': lambda x: x.value_counts().to_dict()  # Logon type distribution
+        'logon_id': 'count'  # Total logons
     }).reset_index()
     
-    features.columns = ['user_id', 'total_logons', 'unique_devices_logon', 'logon_types']
-    
-    # Add time-based features
-    logon_df['hour'] = logon_df['timestamp'].dt.hour
-    logon_df['day_of_week'] = logon_df['timestamp'].dt.dayofweek
-    logon_df['is_weekend'] = logon_df['day_of_week'].isin([5, 6]).astype(int)
-    logon_df['is_after_hours'] = ((logon_df['hour'] < 8) | (logon_df['hour'] > 18)).astype(int)
+    features.columns = ['user_id', 'total_logons']
+    features['unique_devices_logon'] = features['user_id'].map(distinct_counts(logon_df, 'user_id', 'device_id'))  # Unique devices used
     
-    time_features = logon_df.groupby('user_id').agg({
+    # Add time-based features from the calendar columns of the cleaned table
+    ensure_calendar_columns(logon_df)
+    time_features = logon_df.assign(hour=known_hours(logon_df)).groupby('user_id').agg({
         'is_weekend': 'sum',
         'is_after_hours': 'sum',
         'hour': ['mean', 'std']
@@ -72,28 +122,35 @@ def extract_logon_features(logon_df):
     
     features = pd.merge(features, time_features, on='user_id', how='left')
     
+    # Logon type distribution
+    features = pd.merge(features, activity_columns(logon_df, 'user_id', 'logon_type', 'logon_type'),
+                        on='user_id', how='left')
+    
     logger.info(f"  Logon features shape: {features.shape}")
     return features
 
-def extract_email_features(email_df):
-    """Extract features from email data."""
+def extract_email_features(email_df, edges_df=None):
+    """Extract features from email data and its recipient edge table."""
     logger.info("Extracting email features...")
     
     features = email_df.groupby('sender_id').agg({
         'email_id': 'count',  # Total emails sent
-        'recipient_id': 'nunique',  # Unique recipients
         'has_attachments': 'sum',  # Emails with attachments
         'email_size': ['mean', 'sum', 'max']  # Email size statistics
     }).reset_index()
     
-    features.columns = ['user_id', 'total_emails_sent', 'unique_recipients', 
+    features.columns = ['user_id', 'total_emails_sent', 
                        'emails_with_attachments', 'avg_email_size', 
                        'total_email_size', 'max_email_size']
     
-    # Add time-based features
-    email_df['hour'] = email_df['timestamp'].dt.hour
-    email_df['is_after_hours'] = ((email_df['hour'] < 8) | (email_df['hour'] > 18)).astype(int)
+    # Unique recipient addresses across to/cc/bcc and share outside the organisation
+    if edges_df is not None:
+        recipients = recipient_summary(edges_df, ['sender_id'], sketch_precision())
+        recipients = recipients.drop(columns=['recipient_edges']).rename(columns={'sender_id': 'user_id'})
+        features = pd.merge(features, recipients, on='user_id', how='left')
     
+    # Add time-based features from the calendar columns of the cleaned table
+    ensure_calendar_columns(email_df)
     time_features = email_df.groupby('sender_id').agg({
         'is_after_hours': 'sum'
     }).reset_index()
@@ -109,14 +166,12 @@ def extract_file_features(file_df):
     logger.info("Extracting file features...")
     
     features = file_df.groupby('user_id').agg({
-        'file_event_id': 'count',  # Total file operations
-        'filename': 'nunique',  # Unique files accessed
-        'device_id': 'nunique',  # Unique devices for file access
-        'activity_type': lambda x: x.value_counts().to_dict()  # Activity distribution
+        'file_event_id': 'count'  # Total file operations
     }).reset_index()
     
-    features.columns = ['user_id', 'total_file_ops', 'unique_files', 
-                       'unique_devices_file', 'file_activities']
+    features.columns = ['user_id', 'total_file_ops']
+    features['unique_files'] = features['user_id'].map(distinct_counts(file_df, 'user_id', 'filename'))  # Unique files accessed
+    features['unique_devices_file'] = features['user_id'].map(distinct_counts(file_df, 'user_id', 'device_id'))  # Unique devices for file access
     
     # Add removable media features if available
     if 'to_removable_media' in file_df.columns:
@@ -130,10 +185,8 @@ def extract_file_features(file_df):
         removable_features.columns = ['user_id', 'files_to_removable', 'files_from_removable']
         features = pd.merge(features, removable_features, on='user_id', how='left')
     
-    # Add time-based features
-    file_df['hour'] = file_df['timestamp'].dt.hour
-    file_df['is_after_hours'] = ((file_df['hour'] < 8) | (file_df['hour'] > 18)).astype(int)
-    
+    # Add time-based features from the calendar columns of the cleaned table
+    ensure_calendar_columns(file_df)
     time_features = file_df.groupby('user_id').agg({
         'is_after_hours': 'sum'
     }).reset_index()
@@ -141,6 +194,10 @@ def extract_file_features(file_df):
     
     features = pd.merge(features, time_features, on='user_id', how='left')
     
+    # Activity distribution
+    features = pd.merge(features, activity_columns(file_df, 'user_id', 'activity_type', 'file_activity'),
+                        on='user_id', how='left')
+    
     logger.info(f"  File features shape: {features.shape}")
     return features
 
@@ -149,16 +206,27 @@ def extract_device_features(device_df):
     logger.info("Extracting device features...")
     
     features = device_df.groupby('user_id').agg({
-        'device_event_id': 'count',  # Total device events
-        'device_id': 'nunique',  # Unique devices
-        'activity_type': lambda x: x.value_counts().to_dict()  # Activity distribution
+        'device_event_id': 'count'  # Total device events
     }).reset_index()
     
-    features.columns = ['user_id', 'total_device_events', 'unique_devices_used', 'device_activities']
+    features.columns = ['user_id', 'total_device_events']
+    features['unique_devices_used'] = features['user_id'].map(distinct_counts(device_df, 'user_id', 'device_id'))  # Unique devices
+    
+    # Activity distribution
+    features = pd.merge(features, activity_columns(device_df, 'user_id', 'activity_type', 'device_activity'),
+                        on='user_id', how='left')
     
     logger.info(f"  Device features shape: {features.shape}")
     return features
 
+# Extractor of each source and the datasets it takes, main table first
+SOURCE_EXTRACTORS = {
+    'logon': (extract_logon_features, ['logon']),
+    'email': (extract_email_features, ['email', 'email_edges']),
+    'file': (extract_file_features, ['file']),
+    'device': (extract_device_features, ['device'])
+}
+
 def mark_decoy_access(features, decoy_df, file_df):
     """Mark users who accessed decoy files."""
     logger.info("Marking decoy file access...")
@@ -170,7 +238,7 @@ def mark_decoy_access(features, decoy_df, file_df):
         # Find users who accessed decoy files
         if 'filename' in file_df.columns:
             decoy_access = file_df[file_df['filename'].isin(decoy_files)]
-            suspicious_users = set(decoy_access['user_id'].unique())
+            suspicious_users = decoy_access['user_id'].unique()
             
             features['accessed_decoy'] = features['user_id'].isin(suspicious_users).astype(int)
             logger.info(f"  Found {len(suspicious_users)} users who accessed decoy files")
@@ -181,15 +249,100 @@ def mark_decoy_access(features, decoy_df, file_df):
     
     return features
 
-def combine_features(data):
-    """Combine all features into a single dataframe."""
+def extract_source(source, data=None, directory=None):
+    """Extract the features of one source, reading its tables from disk when data is None.
+    
+    Returns (features, seconds); features is None when the source's main
+    table is missing.
+    """
+    start = timer.time()
+    extractor, names = SOURCE_EXTRACTORS[source]
+    if data is None:
+        data = load_cleaned_data(names, directory)
+    if names[0] not in data:
+        return None, timer.time() - start
+    return extractor(*[data.get(name) for name in names]), timer.time() - start
+
+def extract_parallel(n_workers):
+    """Run the per-source extractors in worker processes.
+    
+    Workers read their own cleaned tables from disk, so no DataFrames are
+    pickled to them; the per-user results are joined on the interned user key.
+    """
+    by_size = sorted(SOURCE_EXTRACTORS, reverse=True, key=lambda source: sum(
+        storage.table_size(config.CLEANED_DATA_DIR, TABLES[name]) for name in SOURCE_EXTRACTORS[source][1]
+    ))
+    logger.info(f"Extracting {len(by_size)} sources with {n_workers} worker processes...")
+    results = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(extract_source, source): source for source in by_size}
+        for future in as_completed(futures):
+            source = futures[future]
+            results[source], seconds = future.result()
+            logger.info(f"  {source} features done in {seconds:.1f}s")
+    return results
+
+def extract_sharded(n_shards, n_workers):
+    """Run the per-source extractors on every user shard and concatenate them.
+    
+    The shards partition the users, so the per-user rows of the shards of a
+    source together are exactly the rows of the whole table.
+    """
+    tasks = [(source, shard) for shard in range(n_shards) for source in SOURCE_EXTRACTORS]
+    logger.info(f"Extracting {len(SOURCE_EXTRACTORS)} sources from {n_shards} user shards "
+                f"with {n_workers} worker processes...")
+    parts = {source: [] for source in SOURCE_EXTRACTORS}
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                executor.submit(extract_source, source, None, shard_dir(shard)): source
+                for source, shard in tasks
+            }
+            for future in as_completed(futures):
+                parts[futures[future]].append(future.result()[0])
+    else:
+        for source, shard in tasks:
+            parts[source].append(extract_source(source, None, shard_dir(shard))[0])
+    
+    results = {}
+    for source, frames in parts.items():
+        frames = [frame for frame in frames if frame is not None]
+        results[source] = None
+        if frames:
+            # Activity values that never occur in a shard have no columns there
+            columns = list(dict.fromkeys(col for frame in frames for col in frame.columns))
+            features = pd.concat([frame.reindex(columns=columns, fill_value=0) for frame in frames],
+                                 ignore_index=True)
+            results[source] = order_activity_columns(features).sort_values('user_id', ignore_index=True)
+    return results
+
+def combine_features(data, n_workers=None, manifest=None):
+    """Combine all features into a single dataframe.
+    
+    With more than one worker the per-source extractors run in a process
+    pool and read their tables from disk, so data only needs the users and
+    decoy tables. Given the manifest of usable user shards (see
+    sharding.usable_shards), the extractors run per shard and read the
+    shards instead.
+    """
     logger.info("\nCombining all features...")
+    if sketch_precision() is not None:
+        logger.info(f"Distinct counts are approximate: HyperLogLog relative standard error {distinct_error():.1%}")
     
     # Extract features from each data source
-    logon_features = extract_logon_features(data['logon']) if 'logon' in data else None
-    email_features = extract_email_features(data['email']) if 'email' in data else None
-    file_features = extract_file_features(data['file']) if 'file' in data else None
-    device_features = extract_device_features(data['device']) if 'device' in data else None
+    if manifest is not None:
+        n_shards = manifest['n_shards']
+        source_features = extract_sharded(
+            n_shards, extraction_workers(n_shards * len(SOURCE_EXTRACTORS), n_workers)
+        )
+    elif extraction_workers(len(SOURCE_EXTRACTORS), n_workers) > 1:
+        source_features = extract_parallel(extraction_workers(len(SOURCE_EXTRACTORS), n_workers))
+    else:
+        source_features = {source: extract_source(source, data)[0] for source in SOURCE_EXTRACTORS}
+    logon_features = source_features['logon']
+    email_features = source_features['email']
+    file_features = source_features['file']
+    device_features = source_features['device']
     
     # Start with user list
     all_features = data['users'][['user_id']].copy()
@@ -208,7 +361,10 @@ def combine_features(data):
         all_features = pd.merge(all_features, device_features, on='user_id', how='left')
     
     # Mark decoy access
-    if 'decoy' in data and 'file' in data:
+    if 'decoy' in data and 'file' not in data and storage.table_exists(config.CLEANED_DATA_DIR, TABLES['file']):
+        file_df = storage.read_table(config.CLEANED_DATA_DIR, TABLES['file'], columns=['user_id', 'filename'])
+        all_features = mark_decoy_access(all_features, data['decoy'], file_df)
+    elif 'decoy' in data and 'file' in data:
         all_features = mark_decoy_access(all_features, data['decoy'], data['file'])
     else:
         all_features['accessed_decoy'] = 0
@@ -217,44 +373,68 @@ def combine_features(data):
     numeric_cols = all_features.select_dtypes(include=[np.number]).columns
     all_features[numeric_cols] = all_features[numeric_cols].fillna(0)
     
-    # Drop non-numeric columns for ML
-    ml_features = all_features.select_dtypes(include=[np.number])
+    # Drop non-numeric columns and the interned user key for ML
+    ml_features = all_features.drop(columns=['user_id']).select_dtypes(include=[np.number])
     
     logger.info(f"\nFinal feature shape: {ml_features.shape}")
     logger.info(f"Features: {list(ml_features.columns)}")
     
     return all_features, ml_features
 
+def add_peer_features(all_features, ml_features, peers):
+    """Append the peer deviation columns (aligned to the rows of all_features) to both tables."""
+    columns = [col for col in peers.columns if col != 'user_id']
+    all_features = pd.concat([all_features, peers[columns]], axis=1)
+    ml_features = pd.concat([ml_features, peers[columns].set_axis(ml_features.index)], axis=1)
+    logger.info(f"Added {len(columns)} peer-group deviation features")
+    return all_features, ml_features
+
 def save_features(all_features, ml_features):
     """Save extracted features."""
     logger.info("\nSaving features...")
     
     os.makedirs(config.FEATURES_DIR, exist_ok=True)
     
+    # User codes are decoded only here, at the output boundary
+    all_features = EntityInterner.load().decode_frame(all_features.copy(), {'user_id': 'user'})
+    
     # Save all features (including categorical)
-    all_path = config.FEATURES_DIR / 'all_features.csv'
-    all_features.to_csv(all_path, index=False)
+    all_path = storage.write_table(all_features, config.FEATURES_DIR, 'all_features')
     logger.info(f"  Saved all features to {all_path}")
     
     # Save ML-ready features (numeric only)
-    ml_path = config.FEATURES_DIR / 'ml_features.csv'
-    ml_features.to_csv(ml_path, index=False)
+    ml_path = storage.write_table(ml_features, config.FEATURES_DIR, 'ml_features')
     logger.info(f"  Saved ML features to {ml_path}")
     
     return all_path, ml_path
 
-def main():
-    """Run feature extraction pipeline."""
+def main(incremental=False):
+    """Run feature extraction pipeline.
+    
+    With incremental=True the features come from the online per-user state,
+    which only folds in the cleaned events added since its last refresh.
+    """
     logger.info("="*60)
     logger.info("STARTING FEATURE EXTRACTION")
     logger.info("="*60)
     
     try:
-        # Load cleaned data
-        data = load_cleaned_data()
+        if incremental:
+            # Update the per-user state with new events and emit its features
+            all_features, ml_features = refresh_state().features()
+        else:
+            # Load cleaned data; parallel and per-shard extractors read the source tables themselves
+            parallel = extraction_workers(len(SOURCE_EXTRACTORS)) > 1
+            manifest = usable_shards()
+            data = load_cleaned_data(['users', 'decoy'] if parallel or manifest is not None else None)
+            
+            # Extract and combine features
+            all_features, ml_features = combine_features(data, manifest=manifest)
         
-        # Extract and combine features
-        all_features, ml_features = combine_features(data)
+        # Deviations of every user from their role, department and team peers
+        peers = refresh_peer_groups(all_features)
+        if peers is not None:
+            all_features, ml_features = add_peer_features(all_features, ml_features, peers)
         
         # Save features
         save_features(all_features, ml_features)
@@ -270,5 +450,5 @@ def main():
         return False
 
 if __name__ == "__main__":
-    success = main()
+    success = main(incremental='--incremental' in sys.argv)
     sys.exit(0 if success else 1)
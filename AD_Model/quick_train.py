@@ -17,6 +17,7 @@ import seaborn as sns
 
 sys.path.insert(0, str(Path(__file__).parent))
 from Src import config
+from Src import storage
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -25,11 +26,10 @@ def load_features():
     """Load ML-ready features."""
     logger.info("Loading features...")
     
-    features_path = config.FEATURES_DIR / 'ml_features.csv'
-    if not features_path.exists():
-        raise FileNotFoundError(f"Features file not found: {features_path}")
+    if not storage.table_exists(config.FEATURES_DIR, 'ml_features'):
+        raise FileNotFoundError(f"Features table not found in {config.FEATURES_DIR}")
     
-    df = pd.read_csv(features_path)
+    df = storage.read_table(config.FEATURES_DIR, 'ml_features')
     logger.info(f"  Loaded features: {df.shape}")
     logger.info(f"  Columns: {list(df.columns)}")
     
@@ -189,13 +189,11 @@ def save_results(model, scaler, alerts, anomaly_alerts, feature_names):
     logger.info(f"  ✓ Saved feature names to {features_path}")
     
     # Save all alerts
-    alerts_path = config.OUTPUTS_DIR / 'all_alerts.csv'
-    alerts.to_csv(alerts_path, index=False)
+    alerts_path = storage.write_table(alerts, config.OUTPUTS_DIR, 'all_alerts')
     logger.info(f"  ✓ Saved all alerts to {alerts_path}")
     
     # Save anomaly alerts only
-    anomaly_path = config.OUTPUTS_DIR / 'anomaly_alerts.csv'
-    anomaly_alerts.to_csv(anomaly_path, index=False)
+    anomaly_path = storage.write_table(anomaly_alerts, config.OUTPUTS_DIR, 'anomaly_alerts')
     logger.info(f"  ✓ Saved anomaly alerts to {anomaly_path}")
     
     # Create summary report
@@ -302,7 +300,7 @@ def main():
         logger.info(f"Detection rate: {len(anomaly_alerts)/len(alerts)*100:.2f}%")
         logger.info("\nOutput files:")
         logger.info(f"  - Model: {config.MODELS_DIR / 'isolation_forest_model.pkl'}")
-        logger.info(f"  - Alerts: {config.OUTPUTS_DIR / 'anomaly_alerts.csv'}")
+        logger.info(f"  - Alerts: {storage.parquet_path(config.OUTPUTS_DIR, 'anomaly_alerts')}")
         logger.info(f"  - Summary: {config.OUTPUTS_DIR / 'detection_summary.txt'}")
         logger.info("="*60)
         
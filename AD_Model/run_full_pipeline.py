@@ -13,6 +13,10 @@ project_root = str(Path(__file__).parent)
 sys.path.insert(0, project_root)
 
 from Src import config
+from Src import storage
+from Src import stage_cache
+from Src.stage_cache import StageCache
+from Src.Preprocessing.schema import SCHEMAS
 from Src.Preprocessing.data_cleaning import DataCleaner
 from Src.Feature_engineering.feature_extraction import FeatureExtractor
 from Src.model_training import InsiderThreatDetector
@@ -28,8 +32,62 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def run_pipeline():
-    """Execute the complete insider threat detection pipeline."""
+def stage_outputs():
+    """Files and directories written by each stage."""
+    return {
+        'clean': [config.CLEANED_DATA_DIR],
+        'features': [config.FEATURES_DIR],
+        'train': [
+            config.MODELS_DIR / "insider_threat_detector.joblib",
+            storage.parquet_path(config.OUTPUTS_DIR, "anomaly_predictions"),
+            storage.csv_path(config.OUTPUTS_DIR, "anomaly_predictions")
+        ]
+    }
+
+def stage_keys():
+    """Cache key of each stage from its inputs, upstream stages and relevant config."""
+    clean_key = stage_cache.stage_key(
+        'clean',
+        inputs=[path for path in config.RAW_FILES.values() if path.exists()],
+        params={'schemas': SCHEMAS, 'email': config.EMAIL_PARAMS, 'calendar': config.CALENDAR_PARAMS,
+                'storage': config.STORAGE_PARAMS, 'user_shards': config.CLEANING_PARAMS.get('user_shards')}
+    )
+    features_key = stage_cache.stage_key(
+        'features', upstream=[clean_key],
+        params={'features': config.FEATURE_PARAMS, 'baselines': config.BASELINE_PARAMS,
+                'feature_store': config.FEATURE_STORE_PARAMS}
+    )
+    train_key = stage_cache.stage_key(
+        'train', upstream=[clean_key, features_key],
+        params={'model': config.MODEL_PARAMS, 'feature_store': config.FEATURE_STORE_PARAMS}
+    )
+    return {'clean': clean_key, 'features': features_key, 'train': train_key}
+
+def clean_stage():
+    """Clean the raw data."""
+    cleaner = DataCleaner()
+    cleaner.run()
+
+def features_stage():
+    """Extract features from the cleaned data."""
+    extractor = FeatureExtractor()
+    extractor.run()
+
+def train_stage():
+    """Train, evaluate and save the anomaly detector."""
+    detector = InsiderThreatDetector()
+    detector.load_features()
+    detector.preprocess_data()
+    detector.train_model()
+    detector.evaluate_model()
+    detector.save_model()
+
+def run_pipeline(force=False):
+    """Execute the complete insider threat detection pipeline.
+    
+    Stages whose inputs and parameters are unchanged since a previous run
+    are skipped or restored from the stage cache; force=True reruns them all.
+    """
     start_time = time.time()
     
     try:
@@ -37,33 +95,28 @@ def run_pipeline():
         logger.info("STARTING INSIDER THREAT DETECTION PIPELINE")
         logger.info("="*80)
         
-        # Step 1: Data Cleaning
-        logger.info("\n" + "="*80)
-        logger.info("STEP 1: DATA CLEANING")
-        logger.info("="*80)
-        cleaner = DataCleaner()
-        cleaned_data = cleaner.run()
-        logger.info("✓ Data cleaning completed successfully")
-        
-        # Step 2: Feature Engineering
-        logger.info("\n" + "="*80)
-        logger.info("STEP 2: FEATURE ENGINEERING")
-        logger.info("="*80)
-        extractor = FeatureExtractor()
-        features = extractor.run()
-        logger.info("✓ Feature engineering completed successfully")
+        stages = [
+            ('clean', "STEP 1: DATA CLEANING", clean_stage, "Data cleaning"),
+            ('features', "STEP 2: FEATURE ENGINEERING", features_stage, "Feature engineering"),
+            ('train', "STEP 3: MODEL TRAINING", train_stage, "Model training")
+        ]
+        cache = StageCache() if config.CACHE_PARAMS.get('enabled', True) else None
+        outputs = stage_outputs()
         
-        # Step 3: Model Training
-        logger.info("\n" + "="*80)
-        logger.info("STEP 3: MODEL TRAINING")
-        logger.info("="*80)
-        detector = InsiderThreatDetector()
-        detector.load_features()
-        detector.preprocess_data()
-        detector.train_model()
-        detector.evaluate_model()
-        detector.save_model()
-        logger.info("✓ Model training completed successfully")
+        for stage, title, fn, label in stages:
+            logger.info("\n" + "="*80)
+            logger.info(title)
+            logger.info("="*80)
+            if cache is None:
+                fn()
+                logger.info(f"✓ {label} completed successfully")
+                continue
+            
+            # Keys of later stages depend on the outputs of earlier ones, so
+            # they are computed just before each stage runs
+            keys = stage_keys()
+            result = cache.run(stage, keys[stage], outputs[stage], fn, force=force)
+            logger.info(f"✓ {label} {'completed successfully' if result == 'ran' else result + ' (cached)'}")
         
         # Pipeline Summary
         elapsed_time = time.time() - start_time
@@ -87,5 +140,5 @@ def run_pipeline():
         return False
 
 if __name__ == "__main__":
-    success = run_pipeline()
+    success = run_pipeline(force='--force' in sys.argv)
     sys.exit(0 if success else 1)
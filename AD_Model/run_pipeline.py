@@ -28,14 +28,14 @@ def run_pipeline():
         logger.info("Starting Insider Threat Detection Pipeline")
         logger.info("="*50)
         
-        # Step 1: Data Exploration
+        # Step 1: Data Exploration (one streaming pass per file, JSON profiles)
         logger.info("\n" + "="*50)
         logger.info("Step 1: Data Exploration")
         logger.info("="*50)
-        from Src.data_exploration import explore_csv, RAW_DATA_DIR, DATA_DIR
+        from Src.data_exploration import explore_csv
         
         # List all CSV files in the Raw directory
-        csv_files = [f for f in os.listdir(RAW_DATA_DIR) if f.endswith('.csv')]
+        csv_files = [f for f in os.listdir(config.RAW_DATA_DIR) if f.endswith('.csv')]
         for csv_file in csv_files:
             explore_csv(csv_file)
         
@@ -10,7 +10,9 @@ setup(
         'scikit-learn',
         'matplotlib',
         'seaborn',
-        'joblib'
+        'joblib',
+        'scipy',
+        'pyarrow'
     ],
     python_requires='>=3.6',
 )
@@ -0,0 +1,22 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# Make the Src package importable when pytest is run from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from Src import config
+
+
+@pytest.fixture
+def data_dirs(tmp_path, monkeypatch):
+    """Point the raw and cleaned data directories at a scratch directory."""
+    raw_dir = tmp_path / 'Raw'
+    cleaned_dir = tmp_path / 'Cleaned'
+    raw_dir.mkdir()
+    cleaned_dir.mkdir()
+    monkeypatch.setattr(config, 'RAW_DATA_DIR', raw_dir)
+    monkeypatch.setattr(config, 'CLEANED_DATA_DIR', cleaned_dir)
+    monkeypatch.setitem(config.CLEANING_PARAMS, 'user_shards', None)
+    return raw_dir, cleaned_dir
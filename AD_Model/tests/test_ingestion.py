@@ -0,0 +1,78 @@
+import pandas as pd
+
+from Src import config
+from Src import storage
+from Src.Preprocessing.data_cleaning import DataCleaner
+from Src.Preprocessing.ingestion import watermarks_path
+
+LOGON_HEADER = 'id,date,user,pc,activity\n'
+EMAIL_HEADER = 'id,date,user,pc,to,cc,bcc,from,size,attachments,content\n'
+
+
+def logon_rows(day, n):
+    return ''.join(
+        f'{{L{day}-{i}}},01/{day:02d}/2010 {i % 24:02d}:{i % 60:02d}:00,U{i % 7:04d},PC-{i % 5:04d},Logon\n'
+        for i in range(n)
+    )
+
+
+def email_rows(day, n):
+    return ''.join(
+        f'{{E{day}-{i}}},01/{day:02d}/2010 {i % 24:02d}:00:00,U{i % 7:04d},PC-{i % 5:04d},'
+        f'u{(i + 1) % 7:04d}@dtaa.com;x{i}@gmail.com,,,u{i % 7:04d}@dtaa.com,100,0,hello\n'
+        for i in range(n)
+    )
+
+
+def append_day(raw_dir, day, n):
+    for name, header, rows in [('logon', LOGON_HEADER, logon_rows), ('email', EMAIL_HEADER, email_rows)]:
+        path = raw_dir / f'{name}.csv'
+        with open(path, 'a') as f:
+            if f.tell() == 0:
+                f.write(header)
+            f.write(rows(day, n))
+
+
+def table_rows(cleaned_dir, table):
+    return len(storage.read_table(cleaned_dir, table))
+
+
+def test_rebuild_resets_incremental_watermarks(data_dirs, monkeypatch):
+    raw_dir, cleaned_dir = data_dirs
+    monkeypatch.setattr(config, 'RAW_FILES', {
+        'logon': raw_dir / 'logon.csv',
+        'email': raw_dir / 'email.csv'
+    })
+
+    append_day(raw_dir, 2, 300)
+    DataCleaner().run(incremental=True)
+    assert watermarks_path().exists()
+
+    append_day(raw_dir, 3, 300)
+    DataCleaner().run(streaming=True)
+    assert not watermarks_path().exists()
+
+    append_day(raw_dir, 4, 300)
+    DataCleaner().run(incremental=True)
+    assert table_rows(cleaned_dir, 'logon_cleaned') == 900
+    assert table_rows(cleaned_dir, 'email_edges_cleaned') == 2 * 900
+
+    # Later appends continue from the watermark of the rebuilt tables
+    append_day(raw_dir, 5, 300)
+    DataCleaner().run(incremental=True)
+    logon = storage.read_table(cleaned_dir, 'logon_cleaned')
+    assert len(logon) == 1200
+    assert logon['logon_id'].is_unique
+    assert table_rows(cleaned_dir, 'email_edges_cleaned') == 2 * 1200
+
+
+def test_quick_clean_resets_incremental_watermarks(data_dirs, monkeypatch):
+    import quick_clean
+
+    raw_dir, cleaned_dir = data_dirs
+    monkeypatch.setattr(config, 'RAW_FILES', {'logon': raw_dir / 'logon.csv'})
+
+    append_day(raw_dir, 2, 300)
+    DataCleaner().run(incremental=True)
+    quick_clean.quick_clean()
+    assert not watermarks_path().exists()
@@ -192,7 +192,48 @@ def extract_users_by_type(df, file_type):
     
     return users_data[:100]  # Return up to 100 users for UI display
 
-def calculate_user_risk_score(df, user_id, file_type):
+class UserIndex:
+    """Row positions of every user in an uploaded frame.
+    
+    The user column is factorized once into integer codes, so per-user
+    lookups slice a pre-sorted position array instead of re-scanning and
+    re-hashing the whole column for every user.
+    """
+    
+    def __init__(self, df, column):
+        self.column = column
+        codes, uniques = pd.factorize(df[column])
+        self.users = pd.Index(uniques)
+        self.counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        order = np.argsort(codes, kind='stable')
+        # Missing users (code -1) sort first; drop them
+        self.order = order[(codes < 0).sum():]
+    
+    def rows(self, df, user_id):
+        """Return the rows belonging to user_id."""
+        code = self.users.get_indexer([user_id])[0]
+        if code < 0:
+            return df.iloc[0:0]
+        return df.iloc[self.order[self.offsets[code]:self.offsets[code + 1]]]
+
+def build_user_index(df, file_type):
+    """Build the UserIndex for the user column of a raw activity file, if any."""
+    if file_type in ('logon', 'file', 'device') and 'user' in df.columns:
+        return UserIndex(df, 'user')
+    if file_type == 'email':
+        for col in ['user', 'from']:
+            if col in df.columns:
+                return UserIndex(df, col)
+    return None
+
+def user_rows(df, user_id, user_index, default):
+    """Rows of user_id via the index, or default when the file has no user column."""
+    if user_index is None:
+        return default
+    return user_index.rows(df, user_id)
+
+def calculate_user_risk_score(df, user_id, file_type, user_index=None):
     """Calculate risk score based on user activity patterns in the data."""
     try:
         if file_type == 'ml_features':
@@ -250,14 +291,15 @@ def calculate_user_risk_score(df, user_id, file_type):
             
         elif file_type == 'logon':
             # Count user activities, unusual hours, etc.
-            user_data = df[df['user'] == user_id] if 'user' in df.columns else df
+            user_data = user_rows(df, user_id, user_index, df)
             activity_count = len(user_data)
+            mean_activity = user_index.counts.mean() if user_index is not None else np.nan
             # Higher activity might indicate higher risk in some cases
-            risk_score = -0.1 if activity_count > df.groupby('user')['user'].count().mean() else 0.1
+            risk_score = -0.1 if activity_count > mean_activity else 0.1
             
         elif file_type == 'file':
             # File operations - look for removable media usage
-            user_data = df[df['user'] == user_id] if 'user' in df.columns else df
+            user_data = user_rows(df, user_id, user_index, df)
             removable_ops = 0
             if 'to_removable_media' in df.columns:
                 removable_ops = len(user_data[user_data['to_removable_media'] == True])
@@ -265,7 +307,7 @@ def calculate_user_risk_score(df, user_id, file_type):
             
         elif file_type == 'device':
             # Device connections
-            user_data = df[df['user'] == user_id] if 'user' in df.columns else df
+            user_data = user_rows(df, user_id, user_index, df)
             device_count = len(user_data)
             risk_score = -0.2 if device_count > 10 else 0.1
             
@@ -275,7 +317,7 @@ def calculate_user_risk_score(df, user_id, file_type):
             
         elif file_type == 'email':
             # Email patterns
-            user_data = df[df.get('user', df.get('from', '')) == user_id] if any(col in df.columns for col in ['user', 'from']) else df
+            user_data = user_rows(df, user_id, user_index, df)
             email_count = len(user_data)
             risk_score = -0.1 if email_count > 100 else 0.1
             
@@ -288,7 +330,7 @@ def calculate_user_risk_score(df, user_id, file_type):
     
     return risk_score
 
-def generate_features_by_type(df, user_id, file_type, risk_level):
+def generate_features_by_type(df, user_id, file_type, risk_level, user_index=None):
     """Generate realistic features based on file type and user data."""
     features = {}
     
@@ -328,7 +370,7 @@ def generate_features_by_type(df, user_id, file_type, risk_level):
                 return features
                 
         elif file_type == 'logon':
-            user_data = df[df['user'] == user_id] if 'user' in df.columns else df.head(1)
+            user_data = user_rows(df, user_id, user_index, df.head(1))
             features = {
                 'total_logons': len(user_data) if len(user_data) > 0 else np.random.randint(20, 200),
                 'unique_devices_logon': len(user_data['pc'].unique()) if 'pc' in df.columns and len(user_data) > 0 else np.random.randint(1, 8),
@@ -339,7 +381,7 @@ def generate_features_by_type(df, user_id, file_type, risk_level):
             }
             
         elif file_type == 'file':
-            user_data = df[df['user'] == user_id] if 'user' in df.columns else df.head(1)
+            user_data = user_rows(df, user_id, user_index, df.head(1))
             features = {
                 'total_file_ops': len(user_data) if len(user_data) > 0 else np.random.randint(100, 1000),
                 'unique_files': len(user_data['filename'].unique()) if 'filename' in df.columns and len(user_data) > 0 else np.random.randint(50, 500),
@@ -349,7 +391,7 @@ def generate_features_by_type(df, user_id, file_type, risk_level):
             }
             
         elif file_type == 'device':
-            user_data = df[df['user'] == user_id] if 'user' in df.columns else df.head(1)
+            user_data = user_rows(df, user_id, user_index, df.head(1))
             features = {
                 'total_device_events': len(user_data) if len(user_data) > 0 else np.random.randint(200, 2000),
                 'unique_devices': np.random.randint(1, 6),
@@ -409,13 +451,14 @@ def generate_mock_analysis(df, filename=None):
     # Extract users based on file type
     users_data = extract_users_by_type(df, file_type)
     num_users = min(len(users_data), 100)  # Analyze up to 100 users for UI display
+    user_index = build_user_index(df, file_type)
     
     users = []
     anomaly_count = 0
     
     for i, user_id in enumerate(users_data[:num_users]):
         # Generate anomaly score based on user activity patterns in the data
-        user_activity_score = calculate_user_risk_score(df, user_id, file_type)
+        user_activity_score = calculate_user_risk_score(df, user_id, file_type, user_index)
         base_score = user_activity_score
         noise = np.random.uniform(-0.2, 0.2)
         anomaly_score = np.clip(base_score + noise, -0.8, 0.2)
@@ -430,7 +473,7 @@ def generate_mock_analysis(df, filename=None):
             risk_level = 'Low'
         
         # Generate file-type-specific features
-        features = generate_features_by_type(df, user_id, file_type, risk_level)
+        features = generate_features_by_type(df, user_id, file_type, risk_level, user_index)
         
         users.append({
             'user_id': user_id,